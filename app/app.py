@@ -1,141 +1,251 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from flask_cors import CORS
+from flask_socketio import SocketIO
 import sqlite3
 import os
-import json
-import subprocess
-import time
-import pandas as pd
+import concurrent.futures
+import hashlib
+from datetime import datetime
+
+from engine import ScanEngine
+from export import FORMATS, export_filename, stream_export
+from importer import (ImportFormatError, import_sims, iter_csv_rows,
+                      iter_xlsx_rows)
+from leases import LeaseManager
+from listener import SmsListener
+import main
+from main import metrics, pin_directory
+from store import normalize_iccid
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
+
+# Scans run in-process on a long-lived worker pool, or on SCAN_WORKERS
+# worker processes that each own a share of the ports
+scan_workers = int(os.environ.get('SCAN_WORKERS') or 0)
+if scan_workers:
+    from shards import ShardedScheduler
+    main.scheduler = ShardedScheduler(workers=scan_workers)
+engine = ScanEngine()
+
+
+def push_new_sms(port, index, message):
+    socketio.emit('new_sms', {'port': port, **message})
+
+
+# Pushes +CMTI notifications to dashboard clients as 'new_sms' events
+listener = SmsListener(push_new_sms, baud_rate=engine.baud_rate)
+
+# Free numbers handed out to clients, persisted in the leases table
+leases = LeaseManager(engine.scan_store)
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+SIM_FIELDS = ("iccid", "imsi", "msisdn", "operator", "port", "updated_at", "version")
+MESSAGE_FIELDS = ("id", "iccid", "port", "index", "sender", "timestamp", "message",
+                  "received_at", "on_sim", "version", "code")
+DEFAULT_CODE_WAIT = 30
+MAX_CODE_WAIT = 120
+
+
+def data_version():
+    """The shared change counter: unlike the newest row version it also
+    moves when rows are deleted, so an ETag never comes back after a change."""
+    return engine.scan_store.current_version()
+
+
+def not_modified(version):
+    """ETag for this URL at ``version``, and a 304 response if the client has it."""
+    etag = hashlib.sha1(f'{version}:{request.full_path}'.encode()).hexdigest()[:20]
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return etag, response
+    return etag, None
+
+
+def query_page(fields, query):
+    """Serve a filtered, paginated query with ETag and ``changed_since`` support.
+
+    The version is read before the query, so a row written meanwhile is at
+    worst sent again with the next delta, never missed.
+    """
+    version = data_version()
+    etag, response = not_modified(version)
+    if response is not None:
+        return response
+    args = request.args
+    selected = args.get('fields', '').split(',') if args.get('fields') else fields
+    unknown = [f for f in selected if f not in fields]
+    if unknown:
+        return jsonify({'error': f'Unknown fields: {", ".join(unknown)}'}), 400
+    if args.get('iccid') and normalize_iccid(args['iccid']) is None:
+        return jsonify({'error': 'ICCID must be numeric'}), 400
+    limit = min(max(args.get('limit', DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    items, next_cursor = query(cursor=args.get('cursor', type=int),
+                               changed_since=args.get('changed_since', type=int),
+                               since=args.get('since'), limit=limit)
+    response = jsonify({
+        'items': [{f: item[f] for f in selected} for item in items],
+        'next_cursor': next_cursor,
+        'version': version,
+    })
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
-# Dynamically set paths relative to the current file location
-base_dir = os.path.dirname(os.path.abspath(__file__))
-json_file = 'sim_data.json'
-main_script = os.path.join(base_dir, 'main.py')
-db_file = os.path.join(base_dir, '../data/sim_cards.db')
 
-# Function to initialize the SQLite database
-
-
-# Function to initialize the SQLite database
-def initialize_database():
-    try:
-        # Ensure directory for database exists
-        os.makedirs(os.path.dirname(db_file), exist_ok=True)
-        
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS sim_cards (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                iccid INTEGER UNIQUE,
-                pin TEXT
-            )
-        ''')
-        conn.commit()
-    except sqlite3.Error as e:
-        print(f"SQLite error: {e}")
-    finally:
-        if conn:
-            conn.close()
-
-# Call to initialize the database
-initialize_database()
-
-
-
-def is_json_empty_or_not_exist():
-    return not os.path.exists(json_file) or os.stat(json_file).st_size == 0
-
-
-def load_json_data():
-    if is_json_empty_or_not_exist():
-        return []
-    try:
-        with open(json_file, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (json.JSONDecodeError, IOError) as e:
-        print(f"Error loading JSON data: {e}")
-        return []
-
-
-def save_json_data(data):
+@app.route('/api/run_main_and_get_data')
+def run_main_and_get_data():
+    """Scan all ports on first call and return the SIM data."""
+    if not engine.has_results():
+        try:
+            engine.scan_all(pin_directory)
+        except concurrent.futures.TimeoutError:
+            return jsonify({'error': 'Timed out scanning SIM cards'}), 500
+
+    etag, response = not_modified(data_version())
+    if response is not None:
+        return response
+    sim_data = engine.get_results()
+
+    response = jsonify(sim_data)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@app.route('/api/sims')
+def query_sims():
+    """SIMs filtered by port, iccid, msisdn, since (ISO time) or changed_since
+    (a ``version`` from an earlier response), paged with cursor/limit."""
+    args = request.args
+    return query_page(SIM_FIELDS, lambda **kwargs: engine.scan_store.query_sims(
+        port=args.get('port'), iccid=args.get('iccid'), msisdn=args.get('msisdn'),
+        **kwargs))
+
+
+@app.route('/api/messages')
+def query_messages():
+    """SMS filtered like ``/api/sims`` plus sender. A ``changed_since`` delta
+    also returns messages that left the SIM, with on_sim false."""
+    args = request.args
+    return query_page(MESSAGE_FIELDS,
+                      lambda **kwargs: engine.scan_store.message_store.query_messages(
+                          port=args.get('port'), iccid=args.get('iccid'),
+                          msisdn=args.get('msisdn'), sender=args.get('sender'),
+                          **kwargs))
+
+
+@app.route('/api/ports')
+def get_ports():
+    return jsonify({'ports': engine.inventory()})
+
+
+@app.route('/api/metrics')
+def get_metrics():
+    """AT command latency, error and unlock counters for Prometheus.
+
+    With ``SCAN_WORKERS`` the commands run in the workers, whose counters
+    are collected and added up on each request.
+    """
+    registry = main.scheduler.metrics() if scan_workers else metrics
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/api/export/<kind>')
+def export_data(kind):
+    """Stream ``sims``, ``scans`` or ``messages`` as ``format`` csv or ndjson.
+
+    ``port`` (repeatable or comma separated), ``since`` and ``until`` (ISO
+    times) filter the rows; ``gzip=1`` compresses the download. ``scans``
+    has one row per state recorded in the scan history.
+    """
+    args = request.args
+    fmt = args.get('format', 'ndjson')
+    compress = args.get('gzip', '').lower() in ('1', 'true', 'yes')
+    ports = [p for value in args.getlist('port') for p in value.split(',') if p] or None
     try:
-        with open(json_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=4)
-    except IOError as e:
-        print(f"Error saving JSON data: {e}")
+        chunks = stream_export(engine.scan_store, kind, fmt, ports=ports,
+                               since=args.get('since'), until=args.get('until'),
+                               compress=compress)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    filename = export_filename(kind, fmt, compress)
+    return Response(chunks, mimetype='application/gzip' if compress else FORMATS[fmt],
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
 
 
-def load_iccid_pin_data():
-    """Load ICCID and PIN data dynamically from the database."""
-    iccid_pin_data = {}
-    try:
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
-        cursor.execute("SELECT iccid, pin FROM sim_cards")
-        rows = cursor.fetchall()
-        for row in rows:
-            iccid = str(row[0])
-            pin = row[1]
-            iccid_pin_data[iccid] = pin
-    except sqlite3.Error as e:
-        print(f"SQLite error: {e}")
-    finally:
-        if conn:
-            conn.close()
-
-    return iccid_pin_data
+@app.route('/api/history/<port>')
+def port_history(port):
+    """What was in a port at ``at`` (ISO time, default now)."""
+    state = engine.scan_store.history.state_at(port, request.args.get('at'))
+    if state is None:
+        return jsonify({'error': 'No history for this port at that time'}), 404
+    return jsonify(state)
 
 
-@app.route('/api/run_main_and_get_data')
-def run_main_and_get_data():
-    """Run the main script and fetch SIM data dynamically."""
-    iccid_pin_data = load_iccid_pin_data()
+@app.route('/api/history/<port>/changes')
+def port_history_changes(port):
+    """Changes recorded for a port between ``since`` and ``until`` (ISO times)."""
+    args = request.args
+    limit = min(max(args.get('limit', DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    return jsonify({'port': port, 'changes': engine.scan_store.history.changes(
+        port, since=args.get('since'), until=args.get('until'), limit=limit)})
 
-    if is_json_empty_or_not_exist():
-        try:
-            subprocess.run(['python', main_script], check=True)
-        except subprocess.CalledProcessError as e:
-            return jsonify({'error': f'Error running {main_script}: {e}'}), 500
-        while is_json_empty_or_not_exist():
-            print(f"Waiting for {json_file} to be populated...")
-            time.sleep(1)
 
-    sim_data = load_json_data()
+@app.route('/api/health')
+def port_health():
+    """Per-port health: circuit state, score, failures and time to next probe."""
+    return jsonify({'ports': main.port_health.snapshot()})
 
-    for sim in sim_data:
-        port = sim.get('port')
-        if port and port in iccid_pin_data:
-            print(f"Unlocking SIM on port {port} with ICCID {
-                  sim['iccid']} using PIN.")
 
-    return jsonify(sim_data)
+@app.route('/api/health/<port>/reset', methods=['POST'])
+def reset_port_health(port):
+    """Close a port's circuit so the next full scan includes it again."""
+    if not main.port_health.reset(port):
+        return jsonify({'error': 'No health data for this port'}), 404
+    return jsonify({'message': f'Health of port {port} reset.'})
 
 
 @app.route('/api/reset_data', methods=['POST'])
 def reset_data():
-    if os.path.exists(json_file):
-        os.remove(json_file)
+    engine.reset()
     return jsonify({'message': 'Data reset successfully.'})
 
 
 @app.route('/api/delete_sms', methods=['POST'])
 def delete_sms():
+    """Delete read SMS on one ``port``, or on many ``ports`` and/or ``iccids``."""
     data = request.get_json()
     port = data.get('port')
-    if not port:
+    if port:
+        try:
+            deleted = engine.delete_sms(port)
+        except concurrent.futures.TimeoutError:
+            return jsonify({'error': f'Timed out deleting SMS on port {port}'}), 500
+        if deleted is None:
+            return jsonify({'error': f'Error deleting SMS on port {port}'}), 500
+        return jsonify({'message': f'{deleted} SMS deleted on port {port}.',
+                        'deleted': deleted})
+
+    ports = list(data.get('ports') or [])
+    iccids = data.get('iccids') or []
+    if not ports and not iccids:
         return jsonify({'error': 'Port not specified'}), 400
+    iccid_ports = engine.scan_store.ports_for_iccids(iccids)
+    unknown = [i for i in iccids if normalize_iccid(i) not in iccid_ports]
+    ports = list(dict.fromkeys(ports + list(iccid_ports.values())))
     try:
-        result = subprocess.run(
-            ['python', main_script, '--port', port, '--delete-sms'],
-            capture_output=True, text=True, check=True
-        )
-        return jsonify({'message': f'All SMS deleted on port {port}.'})
-    except subprocess.CalledProcessError as e:
-        return jsonify({'error': f'Error deleting SMS on port {port}: {e.stderr}'}), 500
+        results = engine.delete_sms_many(ports)
+    except concurrent.futures.TimeoutError:
+        return jsonify({'error': 'Timed out deleting SMS'}), 500
+    return jsonify({
+        'deleted': {p: n for p, n in results.items() if n is not None},
+        'failed': [p for p, n in results.items() if n is None],
+        'unknown_iccids': unknown,
+    })
 
 
 @app.route('/api/sms_count', methods=['POST'])
@@ -145,43 +255,119 @@ def get_sms_count():
     if not port:
         return jsonify({'error': 'Port not specified'}), 400
     try:
-        result = subprocess.run(
-            ['python', main_script, '--port', port, '--count-sms'],
-            capture_output=True, text=True, check=True
-        )
-        response = json.loads(result.stdout.strip())
-        return jsonify(response)
-    except json.JSONDecodeError:
-        return jsonify({'error': 'Failed to decode the SMS count response as JSON.'}), 500
-    except subprocess.CalledProcessError as e:
-        return jsonify({'error': f'Error getting SMS count for port {port}: {e.stderr}'}), 500
+        used_sms, total_sms = engine.count_sms(port)
+    except concurrent.futures.TimeoutError:
+        return jsonify({'error': f'Timed out getting SMS count for port {port}'}), 500
+    if used_sms is None:
+        return jsonify({'error': f'Error getting SMS count for port {port}'}), 500
+    return jsonify({'port': port, 'used': used_sms, 'total': total_sms})
 
 
 @app.route('/api/get_last_sms', methods=['POST'])
 def get_last_sms():
     data = request.get_json()
     port = data.get('port')
-    sim_data = load_json_data()
+    if not port:
+        return jsonify({'error': 'Port not specified'}), 400
     try:
-        subprocess.run(['python', main_script, '--port', port], check=True)
-    except subprocess.CalledProcessError as e:
-        return jsonify({'error': f'Error running {main_script} for port {port}: {e}'}), 500
-    updated_data = load_json_data()
-    updated_port_data = next(
-        (item for item in updated_data if item['port'] == port), None)
-    if updated_port_data:
-        existing_port_data_index = next(
-            (index for (index, d) in enumerate(sim_data) if d['port'] == port), None)
-        if existing_port_data_index is not None:
-            sim_data[existing_port_data_index] = updated_port_data
-        else:
-            sim_data.append(updated_port_data)
-    save_json_data(sim_data)
+        updated_port_data = engine.scan_port(port)
+    except concurrent.futures.TimeoutError:
+        return jsonify({'error': f'Timed out reading SMS on port {port}'}), 500
     if updated_port_data:
         return jsonify(updated_port_data)
     return jsonify({'message': 'No data found for this port.'})
 
 
+@app.route('/api/wait_for_code')
+def wait_for_code():
+    """Long-poll for a verification code sent to ``msisdn`` or ``iccid``.
+
+    Optional ``sender`` and ``after`` (ISO time, default now) narrow the
+    match; ``timeout`` is in seconds. The SIM's port is added to the SMS
+    listener so the code is stored the moment it arrives. With
+    ``SCAN_WORKERS`` there is no listener: the code is returned shortly after
+    a worker's scan stores it. Returns 204 when nothing came in time.
+    """
+    args = request.args
+    iccid, msisdn = args.get('iccid'), args.get('msisdn')
+    if not iccid and not msisdn:
+        return jsonify({'error': 'ICCID or MSISDN required'}), 400
+    if iccid and normalize_iccid(iccid) is None:
+        return jsonify({'error': 'ICCID must be numeric'}), 400
+    after = args.get('after') or datetime.now().isoformat()
+    timeout = min(max(args.get('timeout', DEFAULT_CODE_WAIT, type=float), 0), MAX_CODE_WAIT)
+
+    if iccid:
+        port = engine.scan_store.ports_for_iccids([iccid]).get(normalize_iccid(iccid))
+    else:
+        sims, _ = engine.scan_store.query_sims(msisdn=msisdn, limit=1)
+        port = sims[0]["port"] if sims else None
+    if port and port not in listener.ports and not scan_workers:
+        listener.start([port])
+
+    found = engine.scan_store.message_store.wait_for_code(
+        iccid=iccid or None, msisdn=msisdn or None, sender=args.get('sender'),
+        after=after, timeout=timeout)
+    if found is None:
+        return '', 204
+    return jsonify(found)
+
+
+@app.route('/api/leases', methods=['GET'])
+def list_leases():
+    return jsonify({'leases': leases.leases()})
+
+
+@app.route('/api/leases', methods=['POST'])
+def allocate_lease():
+    """Lease a free number: optional ``operator``, ``ttl`` (seconds), ``client``."""
+    data = request.get_json(silent=True) or {}
+    try:
+        lease = leases.allocate(operator=data.get('operator'), ttl=data.get('ttl'),
+                                client=data.get('client'))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'ttl must be a number of seconds'}), 400
+    if lease is None:
+        return jsonify({'error': 'No free number available'}), 409
+    return jsonify(lease)
+
+
+@app.route('/api/leases/<lease_id>/renew', methods=['POST'])
+def renew_lease(lease_id):
+    data = request.get_json(silent=True) or {}
+    try:
+        lease = leases.renew(lease_id, ttl=data.get('ttl'))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'ttl must be a number of seconds'}), 400
+    if lease is None:
+        return jsonify({'error': 'Lease not found'}), 404
+    return jsonify(lease)
+
+
+@app.route('/api/leases/<lease_id>', methods=['DELETE'])
+def release_lease(lease_id):
+    if not leases.release(lease_id):
+        return jsonify({'error': 'Lease not found'}), 404
+    return jsonify({'message': 'Lease released.'})
+
+
+@app.route('/api/start_listener', methods=['POST'])
+def start_listener():
+    if scan_workers:
+        # The ports belong to the scan worker processes.
+        return jsonify({'error': 'The SMS listener is not available with SCAN_WORKERS'}), 400
+    data = request.get_json(silent=True) or {}
+    ports = data.get('ports') or engine.inventory()
+    enabled = listener.start(ports)
+    return jsonify({'message': 'Listening for new SMS.', 'ports': enabled})
+
+
+@app.route('/api/stop_listener', methods=['POST'])
+def stop_listener():
+    listener.stop()
+    return jsonify({'message': 'Stopped listening for new SMS.'})
+
+
 @app.route('/api/add_sim', methods=['POST'])
 def add_sim():
     data = request.get_json()
@@ -190,19 +376,14 @@ def add_sim():
     if not iccid or not pin:
         return jsonify({'error': 'ICCID and PIN are required'}), 400
     try:
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
-        cursor.execute(
-            'INSERT INTO sim_cards (iccid, pin) VALUES (?, ?)', (iccid, pin))
-        conn.commit()
+        pin_directory.add(iccid, pin)
         return jsonify({'message': 'SIM card added successfully.'})
+    except ValueError:
+        return jsonify({'error': 'ICCID must be numeric'}), 400
     except sqlite3.IntegrityError:
         return jsonify({'error': 'ICCID already exists'}), 400
     except sqlite3.Error as e:
         return jsonify({'error': f'SQLite error: {e}'}), 500
-    finally:
-        if conn:
-            conn.close()
 
 
 @app.route('/api/bulk_add_sim', methods=['POST'])
@@ -218,32 +399,17 @@ def bulk_add_sim():
         return jsonify({'error': 'Invalid file format'}), 400
 
     try:
-        if file and file.filename and file.filename.endswith('.csv'):
-            df = pd.read_csv(file.stream, delimiter=';')
-        elif file and file.filename and file.filename.endswith('.xlsx'):
-            df = pd.read_excel(file)
-
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
-
-        for _, row in df.iterrows():
-            try:
-                iccid = int(row['ICCID'])
-                pin = int(row['PIN'])
-                cursor.execute(
-                    'INSERT OR IGNORE INTO sim_cards (iccid, pin) VALUES (?, ?)', (iccid, pin))
-            except ValueError:
-                # type: ignore
-                return jsonify({'error': f'Invalid ICCID or PIN value at row {_ + 1}'}), 400 # type: ignore
-
-        conn.commit()
-        return jsonify({'message': 'Bulk SIM cards added successfully.'})
-
+        if file.filename.endswith('.csv'):
+            rows = iter_csv_rows(file.stream, delimiter=';')
+        else:
+            rows = iter_xlsx_rows(file.stream)
+        report = import_sims(rows, pin_directory)
+    except ImportFormatError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': f'Error processing file: {str(e)}'}), 500
-    finally:
-        if conn:
-            conn.close()
+
+    return jsonify({'message': 'Bulk SIM cards added successfully.', **report})
 
 
 @app.route('/api/contact_developer')
@@ -253,5 +419,25 @@ def contact_developer():
     return jsonify({'url': telegram_desktop_url})
 
 
+def initialize_database():
+    """Create and migrate every table before serving, not at import time.
+
+    The stores would do it on first use anyway; this keeps the migration
+    out of the first request.
+    """
+    try:
+        for store in (pin_directory, engine.scan_store.message_store,
+                      engine.scan_store, engine.scan_store.history,
+                      leases.lease_store):
+            store.connection()
+    except sqlite3.Error as e:
+        print(f"SQLite error: {e}")
+
+
 if __name__ == '__main__':
-    app.run(debug=True)
+    initialize_database()
+    debug = True
+    # The debug reloader runs this script twice, only its child serves.
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        engine.start()
+    socketio.run(app, debug=debug, allow_unsafe_werkzeug=True)
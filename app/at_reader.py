@@ -0,0 +1,133 @@
+import threading
+import time
+from collections import deque
+
+
+FINAL_RESULT_CODES = (b'OK', b'ERROR')
+FINAL_RESULT_PREFIXES = (b'+CME ERROR:', b'+CMS ERROR:')
+
+# Upper bounds used until enough latency samples exist for a modem model.
+DEFAULT_TIMEOUT = 1.0
+DEFAULT_COMMAND_TIMEOUTS = {
+    'AT+CUSD': 3.0,
+}
+
+
+def response_lines(buffer):
+    """Split a raw reply into complete lines, dropping the unfinished tail.
+
+    Only CRLF ends a line: USSD payloads carry bare CRs inside the quotes.
+    """
+    lines = buffer.split(b'\r\n')
+    return [line.strip() for line in lines[:-1] if line.strip()]
+
+
+def is_final_line(line):
+    return line in FINAL_RESULT_CODES or line.startswith(FINAL_RESULT_PREFIXES)
+
+
+def is_error_line(line):
+    return line == b'ERROR' or line.startswith(FINAL_RESULT_PREFIXES)
+
+
+def has_error(buffer):
+    return any(is_error_line(line) for line in response_lines(buffer))
+
+
+def is_complete(buffer, expect=None):
+    """True once the reply holds a final result code and, unless the command
+    failed, a line starting with ``expect``."""
+    if isinstance(expect, str):
+        expect = expect.encode('ascii')
+    lines = response_lines(buffer)
+    final = [line for line in lines if is_final_line(line)]
+    if not final:
+        return False
+    if expect is None or any(is_error_line(line) for line in final):
+        return True
+    return any(line.startswith(expect) for line in lines)
+
+
+def read_response(ser, timeout, expect=None, buffer=b''):
+    """Read from ``ser`` until the reply is complete or ``timeout`` expires.
+
+    ``expect`` names an unsolicited result (e.g. ``b'+CUSD:'``) that still
+    has to arrive after the final ``OK``. The timeout is only an upper
+    bound, a modem that answers in 5ms is done in 5ms. ``buffer`` is the
+    part of the reply already read, to continue a reply that ran late.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        ser.timeout = remaining
+        chunk = ser.read(max(1, ser.in_waiting))
+        if not chunk:
+            break
+        buffer += chunk
+        if is_complete(buffer, expect):
+            break
+    return buffer
+
+
+def command_key(command):
+    """Reduce ``b'AT+CRSM=176,...\\r'`` to ``'AT+CRSM'`` for latency stats."""
+    if isinstance(command, bytes):
+        command = command.decode('ascii', errors='ignore')
+    command = command.strip()
+    for separator in ('=', '?'):
+        command = command.split(separator, 1)[0]
+    return command.upper()
+
+
+class LatencyTracker:
+    """Observed command latencies per modem model, used to size timeouts.
+
+    A learned limit is the slowest recent sample times ``headroom``,
+    clamped to ``[floor, ceiling]``. Replies that ran into the timeout are
+    recorded at the timeout so a too-tight limit grows on the next scans.
+    """
+
+    def __init__(self, window=50, min_samples=5, headroom=3.0, floor=0.05,
+                 ceiling=5.0):
+        self.window = window
+        self.min_samples = min_samples
+        self.headroom = headroom
+        self.floor = floor
+        self.ceiling = ceiling
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, model, command, seconds):
+        key = (model, command_key(command))
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def default_timeout(self, command):
+        return DEFAULT_COMMAND_TIMEOUTS.get(command_key(command), DEFAULT_TIMEOUT)
+
+    def timeout_for(self, model, command):
+        key = (model, command_key(command))
+        with self._lock:
+            samples = list(self._samples.get(key, ()))
+        if len(samples) < self.min_samples:
+            return self.default_timeout(command)
+        limit = max(samples) * self.headroom
+        return min(self.ceiling, max(self.floor, limit))
+
+    def snapshot(self):
+        """Return ``{model: {command: {count, max, mean}}}`` for reporting."""
+        with self._lock:
+            items = [(key, list(samples)) for key, samples in self._samples.items()]
+        stats = {}
+        for (model, command), samples in items:
+            stats.setdefault(model, {})[command] = {
+                "count": len(samples),
+                "max": max(samples),
+                "mean": sum(samples) / len(samples),
+            }
+        return stats
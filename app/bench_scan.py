@@ -0,0 +1,178 @@
+"""Scan benchmark against a simulated modem rack.
+
+Runs a full scan, a rescan of known SIMs and an SMS-only scan over 16, 64 and 256 simulated ports
+(by default) and prints wall times plus per-command latency, so scheduling
+and I/O changes can be compared with numbers:
+
+    python app/bench_scan.py --ports 16 64 256 --latency 0.02
+
+``--workers N`` runs the scans through ``ShardedScheduler`` worker processes
+instead; per-command latency is then only collected inside the workers, so
+just wall times are printed.
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import os
+import statistics
+import tempfile
+import time
+
+import main
+from at_reader import command_key
+from modem_sim import (DEFAULT_LATENCY, DEFAULT_USSD_LATENCY, SimulatedTransport,
+                       build_rack, load_capture)
+from scheduler import PRIORITY_SCAN
+from shards import ShardedScheduler
+from store import MessageStore, PinDirectory, ScanStore
+
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+default_capture = os.path.join(base_dir, '../sim_data.json')
+
+
+class CommandTimer:
+    """Wraps ``SessionPool.execute`` to collect per-command latency."""
+
+    def __init__(self, pool):
+        self.samples = {}
+        self._execute = pool.execute
+        pool.execute = self.execute
+
+    def execute(self, port, baud_rate, command, timeout, expect=None,
+                retry_timeout=None):
+        started = time.perf_counter()
+        try:
+            return self._execute(port, baud_rate, command, timeout, expect,
+                                 retry_timeout)
+        finally:
+            key = command_key(command)
+            self.samples.setdefault(key, []).append(time.perf_counter() - started)
+
+    def reset(self):
+        self.samples = {}
+
+
+def use_rack(modems, db_file):
+    """Point ``main`` at a simulated rack and a throwaway database.
+
+    Everything ``main`` keeps per port (sessions, models, identities, PDU
+    mode, health, USSD requests) is dropped first: rack sizes reuse port
+    names and ICCIDs, and must not start warm from the previous run.
+    """
+    for port in (set(main.modem_models) | set(main.port_iccids)
+                 | set(main.identity_cache) | main.pdu_mode_ports | set(modems)):
+        main.forget_port(port)
+    main.session_pool.close_all()
+    main.session_pool.transport = SimulatedTransport(modems)
+    main.message_store = MessageStore(db_file)
+    main.scan_store = ScanStore(main.message_store)
+    main.pin_directory = PinDirectory(db_file)
+    main.pin_directory.add_many(
+        [(modem.iccid, modem.pin) for modem in modems.values() if modem.pin])
+
+
+def rack_transport(count, capture, latency, ussd_latency, locked_every):
+    """The benchmark rack, rebuilt identically inside each scan worker."""
+    return SimulatedTransport(build_rack(count, load_capture(capture), latency,
+                                         ussd_latency, locked_every))
+
+
+def run_scan(ports, full_scan, use_identity_cache=False, verbose=False):
+    output = contextlib.nullcontext() if verbose else \
+        contextlib.redirect_stdout(io.StringIO())
+    started = time.perf_counter()
+    with output:
+        futures = [main.scheduler.submit(p, main.process_single_sim_card, p,
+                                         115200, main.pin_directory, full_scan,
+                                         True, use_identity_cache,
+                                         priority=PRIORITY_SCAN)
+                   for p in ports]
+        results = [f.result() for f in concurrent.futures.as_completed(futures)]
+    return time.perf_counter() - started, sum(1 for r in results if r)
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+def print_command_stats(samples):
+    print(f"    {'command':<12} {'count':>6} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8}")
+    for key in sorted(samples):
+        values = samples[key]
+        print(f"    {key:<12} {len(values):>6} "
+              f"{statistics.median(values) * 1000:>8.1f} "
+              f"{percentile(values, 0.95) * 1000:>8.1f} {max(values) * 1000:>8.1f}")
+
+
+def run_benchmark(port_counts, capture, latency, ussd_latency, locked_every,
+                  rounds, verbose=False, workers=0):
+    profiles = load_capture(capture)
+    timer = CommandTimer(main.session_pool)
+    local_scheduler = main.scheduler
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in port_counts:
+            db_file = os.path.join(tmp, f'bench_{count}.db')
+            modems = build_rack(count, profiles, latency, ussd_latency, locked_every)
+            use_rack(modems, db_file)
+            ports = list(modems)
+            if workers:
+                main.scheduler = ShardedScheduler(
+                    workers, local_scheduler.max_concurrency, db_file=db_file,
+                    transport=(rack_transport, (count, capture, latency,
+                                                ussd_latency, locked_every)),
+                    quiet=not verbose)
+                main.scheduler.start()
+            print(f"\n{count} ports (latency {latency * 1000:.0f} ms, "
+                  f"USSD {ussd_latency * 1000:.0f} ms, "
+                  f"concurrency {main.scheduler.max_concurrency}"
+                  + (f" x {workers} workers)" if workers else ")"))
+            try:
+                for label, full_scan, cached in (("full scan", True, False),
+                                                 ("rescan (identity cache)", True, True),
+                                                 ("SMS-only scan", False, False)):
+                    times = []
+                    timer.reset()
+                    for _ in range(rounds):
+                        elapsed, scanned = run_scan(ports, full_scan, cached, verbose)
+                        times.append(elapsed)
+                    print(f"  {label}: best {min(times):.3f}s, "
+                          f"mean {statistics.mean(times):.3f}s, {scanned}/{count} ports")
+                    if not workers:
+                        print_command_stats(timer.samples)
+            finally:
+                if workers:
+                    main.scheduler.shutdown()
+                    main.scheduler = local_scheduler
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark scans on simulated modems')
+    parser.add_argument('--ports', type=int, nargs='+', default=[16, 64, 256])
+    parser.add_argument('--capture', default=default_capture,
+                        help='sim_data.json or output.csv to seed SIM profiles')
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY)
+    parser.add_argument('--ussd-latency', type=float, default=DEFAULT_USSD_LATENCY)
+    parser.add_argument('--locked-every', type=int, default=0,
+                        help='Make every n-th SIM start PIN locked')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--max-concurrency', type=int,
+                        default=main.scheduler.max_concurrency)
+    parser.add_argument('--verbose', action='store_true',
+                        help='Show the scanner output')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Scan in this many worker processes')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    main.scheduler.max_concurrency = args.max_concurrency
+    try:
+        run_benchmark(args.ports, args.capture, args.latency, args.ussd_latency,
+                      args.locked_every, args.rounds, args.verbose, args.workers)
+    finally:
+        main.scheduler.shutdown()
+        main.session_pool.close_all()
@@ -0,0 +1,102 @@
+"""Cold-start benchmark for the API server and the CLI.
+
+Starts a fresh interpreter per round and times ``import app`` (the API
+server) and ``import main`` (the CLI and every scan worker), and prints
+the slowest imports. A round fails when importing opens a SQLite
+connection or loads a module that should only load when used, and
+``--max-ms`` fails when the median import time goes over budget:
+
+    python app/bench_startup.py --rounds 10 --max-ms 600
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+
+TARGETS = {"api": "app", "cli": "main"}
+# Only needed by one endpoint or code path, never at import.
+LAZY_MODULES = ('pandas', 'numpy', 'openpyxl', 'serial.tools.list_ports')
+
+IMPORT_PROBE = '''
+import sqlite3, sys, time
+connections = []
+connect = sqlite3.connect
+sqlite3.connect = lambda *a, **k: connections.append(a) or connect(*a, **k)
+started = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - started
+loaded = [m for m in {lazy!r} if m in sys.modules]
+print(elapsed, len(connections), ','.join(loaded) or '-')
+'''
+
+
+def probe(module):
+    """Import ``module`` in a fresh interpreter.
+
+    Returns ``(process seconds, import seconds, connections, eager modules)``.
+    """
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-c', IMPORT_PROBE.format(module=module, lazy=LAZY_MODULES)],
+        cwd=base_dir, capture_output=True, text=True, check=True)
+    wall = time.perf_counter() - started
+    elapsed, connections, loaded = result.stdout.strip().splitlines()[-1].split(' ')
+    return wall, float(elapsed), int(connections), [m for m in loaded.split(',') if m != '-']
+
+
+def slowest_imports(module, count=10):
+    """Top ``count`` modules by cumulative import time, from ``-X importtime``."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=base_dir, capture_output=True, text=True, check=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        rows.append((int(cumulative), name.rstrip()))
+    return sorted(rows, reverse=True)[:count]
+
+
+def run_benchmark(targets, rounds, max_ms=None):
+    ok = True
+    for label in targets:
+        module = TARGETS[label]
+        walls, imports = [], []
+        for _ in range(rounds):
+            wall, elapsed, connections, loaded = probe(module)
+            walls.append(wall)
+            imports.append(elapsed)
+            if connections or loaded:
+                ok = False
+                print(f"  {label}: import {module} opened {connections} SQLite "
+                      f"connection(s), loaded {', '.join(loaded) or 'nothing lazy'}")
+        median = statistics.median(imports) * 1000
+        print(f"\n{label} (import {module}): median {median:.0f} ms, "
+              f"best {min(imports) * 1000:.0f} ms, "
+              f"process {statistics.median(walls) * 1000:.0f} ms")
+        for cumulative, name in slowest_imports(module):
+            print(f"    {cumulative / 1000:>8.1f} ms  {name}")
+        if max_ms is not None and median > max_ms:
+            ok = False
+            print(f"  {label}: median {median:.0f} ms is over the {max_ms:.0f} ms budget")
+    return ok
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark API and CLI cold start')
+    parser.add_argument('--targets', nargs='+', choices=sorted(TARGETS),
+                        default=sorted(TARGETS))
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--max-ms', type=float,
+                        help='Fail when a median import time is over this')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    sys.exit(0 if run_benchmark(args.targets, args.rounds, args.max_ms) else 1)
@@ -0,0 +1,178 @@
+import concurrent.futures
+import threading
+
+import main
+from port_watcher import PortWatcher
+from scheduler import PRIORITY_INTERACTIVE, PRIORITY_SCAN, PRIORITY_HOUSEKEEPING
+
+
+DEFAULT_BAUD_RATE = 115200
+DEFAULT_JOB_TIMEOUT = 120
+# How often ports with an open circuit are checked for a due probe.
+DEFAULT_PROBE_INTERVAL = 10.0
+
+
+class ScanEngine:
+    """In-process scanner owned by the API server.
+
+    Jobs go through the process-wide ``PortScheduler`` and serial session
+    pool from ``main``: requests queue per port instead of fighting over the
+    COM port, and interactive jobs run ahead of scans and deletes. Results
+    are saved per port in the ``ScanStore`` tables. A ``PortWatcher`` keeps
+    the port inventory: plugged-in ports are scanned on their own, removed
+    ones are marked stale. Ports that keep failing are left out of full
+    scans (see ``PortHealth``) and probed on their own slower schedule.
+    """
+
+    def __init__(self, baud_rate=DEFAULT_BAUD_RATE, scheduler=None,
+                 scan_store=None):
+        self.baud_rate = baud_rate
+        self.scheduler = scheduler or main.scheduler
+        self.scan_store = scan_store or main.scan_store
+        self.watcher = PortWatcher(main.detect_ports, self.port_added,
+                                   self.port_removed)
+        self.probe_interval = DEFAULT_PROBE_INTERVAL
+        self._prober = None
+        self._stop_probing = threading.Event()
+
+    def submit(self, port, fn, *args, priority=PRIORITY_INTERACTIVE):
+        return self.scheduler.submit(port, fn, *args, priority=priority)
+
+    def start(self):
+        """Watch for hot-plugged ports and probe failing ones, until shutdown."""
+        self.watcher.start()
+        self.start_probing()
+
+    def inventory(self):
+        """Live ports from the watcher, without listing them per request."""
+        return self.watcher.ports()
+
+    def start_probing(self):
+        if self._prober is None:
+            self._prober = threading.Thread(target=self._probe_loop, name="port-prober",
+                                            daemon=True)
+            self._prober.start()
+
+    def _probe_loop(self):
+        while not self._stop_probing.wait(self.probe_interval):
+            try:
+                self.probe_due()
+            except Exception as e:
+                print(f"Error probing failed ports: {e}")
+
+    def probe_due(self):
+        """Rescan open-circuit ports whose backoff is over, behind other work."""
+        probed = []
+        for port in main.port_health.due(set(self.watcher.ports())):
+            if main.port_health.allow(port):
+                future = self.submit(port, main.process_single_sim_card, port,
+                                     self.baud_rate, main.pin_directory, True,
+                                     priority=PRIORITY_HOUSEKEEPING)
+                future.add_done_callback(self._save_scan)
+                probed.append(port)
+        return probed
+
+    def port_added(self, port):
+        future = self.submit(port, main.process_single_sim_card, port,
+                             self.baud_rate, main.pin_directory, True,
+                             priority=PRIORITY_SCAN)
+        future.add_done_callback(self._save_scan)
+
+    def _save_scan(self, future):
+        if not future.cancelled() and future.exception() is None and future.result():
+            self.scan_store.save_port_data(future.result())
+
+    def port_removed(self, port):
+        main.forget_port(port)
+        self.scan_store.mark_stale(port)
+
+    def has_results(self):
+        return self.scan_store.has_ports()
+
+    def get_results(self):
+        return self.scan_store.get_ports()
+
+    def reset(self):
+        self.scan_store.clear()
+
+    def scan_all(self, iccid_pin_data=None, timeout=DEFAULT_JOB_TIMEOUT,
+                 use_identity_cache=True):
+        """Full scan of every detected port, replacing the stored results.
+
+        Ports whose SIM is unchanged since the last scan only get their SMS
+        re-read unless ``use_identity_cache`` is False.
+        """
+        if iccid_pin_data is None:
+            iccid_pin_data = main.pin_directory
+        ports = self.inventory()
+        skipped = [p for p in ports if not main.port_health.allow(p)]
+        if skipped:
+            print(f"Skipping failing ports until their next probe: {', '.join(skipped)}")
+        futures = [self.submit(p, main.process_single_sim_card, p, self.baud_rate,
+                               iccid_pin_data, True, True, use_identity_cache,
+                               priority=PRIORITY_SCAN)
+                   for p in ports if p not in skipped]
+        data = []
+        try:
+            for future in concurrent.futures.as_completed(futures, timeout=timeout):
+                port_data = future.result()
+                if port_data:
+                    data.append(port_data)
+        except concurrent.futures.TimeoutError:
+            for future in futures:
+                future.cancel()
+            raise
+        self.scan_store.replace_ports(data)
+        return self.scan_store.get_ports()
+
+    def scan_port(self, port, iccid_pin_data=None, full_scan=False,
+                  timeout=DEFAULT_JOB_TIMEOUT):
+        """Refresh one port, by default only its SMS listing."""
+        if iccid_pin_data is None:
+            iccid_pin_data = main.pin_directory
+        future = self.submit(port, main.process_single_sim_card, port,
+                             self.baud_rate, iccid_pin_data, full_scan)
+        port_data = future.result(timeout=timeout)
+        if port_data:
+            self.scan_store.save_port_data(port_data)
+            return self.scan_store.get_port(port)
+        return port_data
+
+    def delete_sms(self, port, timeout=DEFAULT_JOB_TIMEOUT):
+        """Delete the read SMS on one port, returns how many or None on failure."""
+        return self.delete_sms_many([port], timeout)[port]
+
+    def delete_sms_many(self, ports, timeout=DEFAULT_JOB_TIMEOUT):
+        """Delete the read SMS on many ports in parallel.
+
+        Each port gets an SMS-only scan that ends with ``delete_read_sms``,
+        so messages are stored before they are deleted. Returns
+        ``{port: deleted count or None}``.
+        """
+        futures = {port: self.submit(port, main.process_single_sim_card, port,
+                                     self.baud_rate, main.pin_directory, False,
+                                     True, True, True,
+                                     priority=PRIORITY_HOUSEKEEPING)
+                   for port in ports}
+        _, not_done = concurrent.futures.wait(futures.values(), timeout=timeout)
+        if not_done:
+            for future in not_done:
+                future.cancel()
+            raise concurrent.futures.TimeoutError()
+        results = {}
+        for port, future in futures.items():
+            port_data = future.result()
+            if port_data:
+                self.scan_store.save_port_data(port_data)
+            results[port] = port_data.get("deleted") if port_data else None
+        return results
+
+    def count_sms(self, port, timeout=DEFAULT_JOB_TIMEOUT):
+        future = self.submit(port, main.count_sms_in_sim, port, self.baud_rate)
+        return future.result(timeout=timeout)
+
+    def shutdown(self):
+        self._stop_probing.set()
+        self.watcher.stop()
+        self.scheduler.shutdown()
+        main.session_pool.close_all()
@@ -0,0 +1,96 @@
+"""Streaming CSV/NDJSON exports of the SIM inventory, scan and SMS history.
+
+Rows come from the stores in keyset-paged batches and are encoded into
+chunks of about ``CHUNK_SIZE`` bytes, optionally gzipped on the fly, so an
+export of any size runs in constant memory.
+"""
+import csv
+import io
+import json
+import sys
+import zlib
+
+
+CHUNK_SIZE = 64 * 1024
+
+EXPORT_KINDS = {
+    "sims": ("iccid", "imsi", "msisdn", "operator", "port", "updated_at"),
+    "scans": ("port", "iccid", "recorded_at", "stale", "responses", "messages"),
+    "messages": ("id", "iccid", "port", "index", "sender", "timestamp", "message",
+                 "received_at", "on_sim", "parts", "code"),
+}
+FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+def export_rows(scan_store, kind, ports=None, since=None, until=None):
+    if kind == "sims":
+        return scan_store.export_sims(ports, since, until)
+    if kind == "scans":
+        return scan_store.history.export_states(ports, since, until)
+    if kind == "messages":
+        return scan_store.message_store.export_messages(ports, since, until)
+    raise ValueError(f"Unknown export: {kind}")
+
+
+def csv_cell(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+def encode_chunks(rows, kind, fmt):
+    """Encode rows as CSV (with a header) or NDJSON, in chunks of bytes."""
+    buffer = io.StringIO()
+    if fmt == "csv":
+        columns = EXPORT_KINDS[kind]
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        write = lambda row: writer.writerow([csv_cell(row[c]) for c in columns])
+    elif fmt == "ndjson":
+        write = lambda row: buffer.write(json.dumps(row, ensure_ascii=False) + '\n')
+    else:
+        raise ValueError(f"Unknown format: {fmt}")
+    for row in rows:
+        write(row)
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def stream_export(scan_store, kind, fmt="ndjson", ports=None, since=None, until=None,
+                  compress=False):
+    """Bytes of an export, produced lazily. ``since``/``until`` are ISO times."""
+    if kind not in EXPORT_KINDS:
+        raise ValueError(f"Unknown export: {kind}")
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format: {fmt}")
+    chunks = encode_chunks(export_rows(scan_store, kind, ports, since, until), kind, fmt)
+    return gzip_chunks(chunks) if compress else chunks
+
+
+def export_filename(kind, fmt, compress=False):
+    return f"{kind}.{fmt}" + (".gz" if compress else "")
+
+
+def write_export(scan_store, kind, output=None, **options):
+    """Write an export to the file ``output``, or to stdout."""
+    if output is None or output == '-':
+        for chunk in stream_export(scan_store, kind, **options):
+            sys.stdout.buffer.write(chunk)
+        sys.stdout.buffer.flush()
+        return
+    with open(output, 'wb') as f:
+        for chunk in stream_export(scan_store, kind, **options):
+            f.write(chunk)
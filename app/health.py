@@ -0,0 +1,153 @@
+import threading
+import time
+
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+# Faults that mean the modem or its SIM slot is not answering. PIN problems
+# are not faults: the modem answered, the SIM just needs a PIN we lack.
+FAULT_SERIAL = "serial"
+FAULT_NO_RESPONSE = "no_response"
+FAULT_SIM_STATUS = "sim_status"
+
+
+class PortHealth:
+    """Per-port health with exponential backoff and a circuit breaker.
+
+    Each scan of a port ends in a success or a failure (a fault noted by
+    ``send_at_command`` or the SIM status check). After
+    ``failure_threshold`` consecutive failures the port's circuit opens and
+    full scans skip it; it is probed again after a backoff that doubles
+    with every further failure, up to ``max_backoff`` seconds. A probe
+    (half-open) that succeeds closes the circuit. The score is a moving
+    average of scan outcomes, 1.0 for a port that always answers.
+
+    ``on_outcome(port, ok, fault)`` is called with every scan outcome; scan
+    workers use it to report to the coordinator, which applies them with
+    ``record`` and so decides which ports full scans skip.
+    """
+
+    def __init__(self, failure_threshold=3, base_backoff=30.0, max_backoff=1800.0,
+                 smoothing=0.3, on_outcome=None):
+        self.failure_threshold = failure_threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.smoothing = smoothing
+        self.on_outcome = on_outcome
+        self._ports = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, port):
+        entry = self._ports.get(port)
+        if entry is None:
+            entry = self._ports[port] = {
+                "state": STATE_CLOSED, "score": 1.0, "consecutive_failures": 0,
+                "failures": 0, "successes": 0, "last_error": None,
+                "last_failure_at": None, "last_success_at": None,
+                "retry_at": 0.0, "fault": None,
+            }
+        return entry
+
+    def begin_scan(self, port):
+        with self._lock:
+            self._entry(port)["fault"] = None
+
+    def fault(self, port, reason):
+        """Note why the current scan of ``port`` is failing."""
+        with self._lock:
+            entry = self._entry(port)
+            if entry["fault"] is None:
+                entry["fault"] = entry["last_error"] = reason
+
+    def port_down(self, port):
+        """True once the port failed at the serial level during this scan, so
+        the remaining commands need not wait for their timeouts."""
+        with self._lock:
+            entry = self._ports.get(port)
+            return entry is not None and entry["fault"] == FAULT_SERIAL
+
+    def end_scan(self, port, ok):
+        """Record a scan outcome; returns True if it opened the circuit."""
+        with self._lock:
+            entry = self._entry(port)
+            fault, entry["fault"] = entry["fault"], None
+        if self.on_outcome is not None:
+            self.on_outcome(port, ok, fault)
+        return self.record(port, ok, fault)
+
+    def record(self, port, ok, fault=None):
+        """Apply a scan outcome; a failure needs the ``fault`` behind it."""
+        with self._lock:
+            entry = self._entry(port)
+            if ok or fault is None:
+                entry["consecutive_failures"] = 0
+                entry["successes"] += 1
+                entry["score"] += self.smoothing * (1.0 - entry["score"])
+                entry["last_success_at"] = time.time()
+                entry["state"] = STATE_CLOSED
+                return False
+            entry["last_error"] = fault
+            entry["consecutive_failures"] += 1
+            entry["failures"] += 1
+            entry["score"] -= self.smoothing * entry["score"]
+            entry["last_failure_at"] = time.time()
+            failures = entry["consecutive_failures"]
+            if entry["state"] == STATE_CLOSED and failures < self.failure_threshold:
+                return False
+            backoff = min(self.max_backoff,
+                          self.base_backoff * 2 ** (failures - self.failure_threshold))
+            opened = entry["state"] == STATE_CLOSED
+            entry["state"] = STATE_OPEN
+            entry["retry_at"] = time.monotonic() + backoff
+            if opened:
+                print(f"Port {port} failed {failures} scans in a row "
+                      f"({fault}), skipping it for {backoff:.0f}s")
+            return opened
+
+    def allow(self, port):
+        """Whether a full scan should include ``port``.
+
+        Once its backoff is over an open port is let through as a probe
+        (half-open). The next probe is allowed one base backoff later in
+        case this one never reports back.
+        """
+        with self._lock:
+            entry = self._ports.get(port)
+            if entry is None or entry["state"] == STATE_CLOSED:
+                return True
+            now = time.monotonic()
+            if now < entry["retry_at"]:
+                return False
+            entry["state"] = STATE_HALF_OPEN
+            entry["retry_at"] = now + self.base_backoff
+            return True
+
+    def due(self, ports=None):
+        """Open ports whose backoff is over, for the slow probe schedule."""
+        now = time.monotonic()
+        with self._lock:
+            return sorted(port for port, entry in self._ports.items()
+                          if entry["state"] != STATE_CLOSED and now >= entry["retry_at"]
+                          and (ports is None or port in ports))
+
+    def reset(self, port):
+        """Forget a port's history, closing its circuit."""
+        with self._lock:
+            return self._ports.pop(port, None) is not None
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            items = [(port, dict(entry)) for port, entry in sorted(self._ports.items())]
+        return [{"port": port, "state": entry["state"],
+                 "score": round(entry["score"], 3),
+                 "consecutive_failures": entry["consecutive_failures"],
+                 "failures": entry["failures"], "successes": entry["successes"],
+                 "last_error": entry["last_error"],
+                 "last_failure_at": entry["last_failure_at"],
+                 "last_success_at": entry["last_success_at"],
+                 "retry_in": (round(max(0.0, entry["retry_at"] - now), 1)
+                              if entry["state"] != STATE_CLOSED else None)}
+                for port, entry in items]
@@ -0,0 +1,101 @@
+import codecs
+import csv
+import itertools
+
+from store import normalize_iccid
+
+
+DEFAULT_CHUNK_SIZE = 5000
+MAX_REPORTED_ERRORS = 1000
+
+
+class ImportFormatError(ValueError):
+    pass
+
+
+def iter_csv_rows(stream, delimiter=';'):
+    """Yield rows of a binary CSV upload without reading it all into memory."""
+    reader = codecs.getreader('utf-8-sig')(stream, errors='replace')
+    yield from csv.reader(reader, delimiter=delimiter)
+
+
+def iter_xlsx_rows(stream):
+    """Yield the rows of the first sheet, streamed by openpyxl's read-only mode."""
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(stream, read_only=True, data_only=True)
+    try:
+        yield from workbook.worksheets[0].iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def cell_text(value):
+    """Spreadsheet cells come back as int/float/str, make them digit strings."""
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def parse_sim_rows(rows):
+    """Yield ``(row_number, iccid, pin, error)`` for every data row.
+
+    The first row must name the ICCID and PIN columns. Row numbers count the
+    header as row 1, like a spreadsheet.
+    """
+    rows = iter(rows)
+    header = [cell_text(c).upper() for c in next(rows, [])]
+    if 'ICCID' not in header or 'PIN' not in header:
+        raise ImportFormatError('File must have ICCID and PIN columns')
+    iccid_col, pin_col = header.index('ICCID'), header.index('PIN')
+    width = max(iccid_col, pin_col) + 1
+
+    for row_number, row in enumerate(rows, start=2):
+        if not row or all(cell_text(c) == '' for c in row):
+            continue
+        if len(row) < width:
+            yield row_number, None, None, 'Missing ICCID or PIN'
+            continue
+        iccid_text, pin = cell_text(row[iccid_col]), cell_text(row[pin_col])
+        iccid = normalize_iccid(iccid_text) if iccid_text.isdigit() else None
+        if iccid is None:
+            yield row_number, None, None, f'Invalid ICCID {iccid_text!r}'
+        elif not pin.isdigit():
+            yield row_number, None, None, f'Invalid PIN {pin!r}'
+        else:
+            yield row_number, iccid, pin, None
+
+
+def import_sims(rows, pin_directory, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Insert ICCID/PIN rows in chunks inside a single transaction.
+
+    Bad rows are reported and skipped instead of aborting the import;
+    ICCIDs already in the database count as duplicates. Only the first
+    ``MAX_REPORTED_ERRORS`` errors are listed so memory stays flat.
+    """
+    report = {'inserted': 0, 'duplicates': 0, 'rejected': 0, 'errors': []}
+    conn = pin_directory.connection()
+    parsed = parse_sim_rows(rows)
+    with conn:
+        while True:
+            batch = list(itertools.islice(parsed, chunk_size))
+            if not batch:
+                break
+            chunk = []
+            for row_number, iccid, pin, error in batch:
+                if error is None:
+                    chunk.append((iccid, pin))
+                    continue
+                report['rejected'] += 1
+                if len(report['errors']) < MAX_REPORTED_ERRORS:
+                    report['errors'].append({'row': row_number, 'error': error})
+            if chunk:
+                inserted = pin_directory.add_many(chunk, conn)
+                report['inserted'] += inserted
+                report['duplicates'] += len(chunk) - inserted
+    # Lookups during the import saw the old rows; only now are they visible.
+    pin_directory.forget_misses()
+    report['errors_truncated'] = report['rejected'] > len(report['errors'])
+    return report
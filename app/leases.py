@@ -0,0 +1,205 @@
+import heapq
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from store import LeaseStore
+
+
+DEFAULT_LEASE_TTL = 300.0
+MAX_LEASE_TTL = 24 * 3600.0
+
+
+class LeaseManager:
+    """Hands out free SIM numbers to API clients for a limited time.
+
+    Free SIMs sit in one heap per operator plus one for any operator, ordered
+    by when they were last released so numbers rotate. Heap entries are
+    invalidated lazily: an entry counts only while its SIM is still free
+    with the same sequence number, so allocate, release and expiry are all
+    O(log n). Active leases also sit in a deadline heap that a background
+    thread drains when leases expire.
+
+    Every change is written to the ``leases`` table under the same lock, so
+    concurrent clients never get the same SIM and leases survive restarts.
+    The inventory (live SIMs with an MSISDN) is loaded once; after that
+    only the SIM and port rows whose data version moved are read again and
+    applied one SIM at a time.
+    """
+
+    def __init__(self, scan_store, lease_store=None, default_ttl=DEFAULT_LEASE_TTL):
+        self.scan_store = scan_store
+        self.lease_store = lease_store or LeaseStore(scan_store.db_file)
+        self.default_ttl = default_ttl
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._sims = {}
+        self._by_port = {}
+        self._free = {}
+        self._free_heaps = {}
+        self._sequence = 0
+        self._leases = {}
+        self._by_iccid = {}
+        self._deadlines = []
+        self._version = None
+        self._thread = None
+        self._loaded = False
+
+    def _load(self):
+        now = time.time()
+        expired = []
+        for lease in self.lease_store.load():
+            if lease["expires_at"] <= now:
+                expired.append(lease["lease_id"])
+                continue
+            self._leases[lease["lease_id"]] = lease
+            self._by_iccid[lease["iccid"]] = lease["lease_id"]
+            heapq.heappush(self._deadlines, (lease["expires_at"], lease["lease_id"]))
+        if expired:
+            self.lease_store.delete(expired)
+        self._loaded = True
+        if self._deadlines:
+            self._start_reaper()
+
+    def _inventory_version(self):
+        return max(self.scan_store.max_version('ports'),
+                   self.scan_store.max_version('sims'))
+
+    def _sync(self, version):
+        """Apply inventory changes to the free heaps. Caller holds the lock."""
+        if not self._loaded:
+            self._load()
+        if version == self._version:
+            return
+        if self._version is None:
+            for sim in self.scan_store.live_sims():
+                self._update_sim(sim["iccid"], sim)
+        else:
+            sims, iccids, ports = self.scan_store.live_sims_since(self._version)
+            live = {sim["iccid"]: sim for sim in sims}
+            # A SIM that left a changed port has no changed row of its own.
+            iccids.update(self._by_port[port] for port in ports if port in self._by_port)
+            for iccid in iccids | live.keys():
+                self._update_sim(iccid, live.get(iccid))
+        self._version = version
+
+    def _update_sim(self, iccid, sim):
+        """Record a SIM's live row, or None once it is no longer live."""
+        old = self._sims.pop(iccid, None)
+        if old is not None and self._by_port.get(old["port"]) == iccid:
+            del self._by_port[old["port"]]
+        if sim is None:
+            # Its heap entries are skipped from now on.
+            self._free.pop(iccid, None)
+            return
+        self._sims[iccid] = sim
+        self._by_port[sim["port"]] = iccid
+        if iccid in self._by_iccid:
+            return
+        if iccid not in self._free or old["operator"] != sim["operator"]:
+            self._push_free(iccid)
+
+    def _push_free(self, iccid):
+        self._sequence += 1
+        self._free[iccid] = self._sequence
+        entry = (self._sequence, iccid)
+        operator = self._sims[iccid]["operator"]
+        heapq.heappush(self._free_heaps.setdefault(None, []), entry)
+        heapq.heappush(self._free_heaps.setdefault(operator, []), entry)
+
+    def _pop_free(self, operator):
+        heap = self._free_heaps.get(operator, [])
+        while heap:
+            sequence, iccid = heapq.heappop(heap)
+            if self._free.get(iccid) == sequence:
+                del self._free[iccid]
+                return iccid
+        return None
+
+    def allocate(self, operator=None, ttl=None, client=None):
+        """Lease a free number, optionally of one operator, or return None."""
+        ttl = min(max(float(ttl or self.default_ttl), 1.0), MAX_LEASE_TTL)
+        version = self._inventory_version()
+        with self._lock:
+            self._sync(version)
+            self._expire(time.time())
+            iccid = self._pop_free(operator)
+            if iccid is None:
+                return None
+            sim = self._sims[iccid]
+            lease = {"lease_id": uuid.uuid4().hex, "iccid": iccid,
+                     "msisdn": sim["msisdn"], "operator": sim["operator"],
+                     "port": sim["port"], "client": client,
+                     "started_at": datetime.now().isoformat(),
+                     "expires_at": time.time() + ttl}
+            self.lease_store.save(lease)
+            self._leases[lease["lease_id"]] = lease
+            self._by_iccid[iccid] = lease["lease_id"]
+            heapq.heappush(self._deadlines, (lease["expires_at"], lease["lease_id"]))
+            self._start_reaper()
+            self._wakeup.notify()
+            return dict(lease)
+
+    def renew(self, lease_id, ttl=None):
+        """Push a lease's expiry out by ``ttl`` seconds from now."""
+        ttl = min(max(float(ttl or self.default_ttl), 1.0), MAX_LEASE_TTL)
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            lease = self._leases.get(lease_id)
+            if lease is None:
+                return None
+            lease["expires_at"] = time.time() + ttl
+            self.lease_store.save(lease)
+            heapq.heappush(self._deadlines, (lease["expires_at"], lease_id))
+            return dict(lease)
+
+    def release(self, lease_id):
+        """End a lease and return its SIM to the free pool."""
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            if lease_id not in self._leases:
+                return False
+            self._end([lease_id])
+            return True
+
+    def leases(self):
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            return [dict(lease) for lease in self._leases.values()]
+
+    def _end(self, lease_ids):
+        self.lease_store.delete(lease_ids)
+        for lease_id in lease_ids:
+            lease = self._leases.pop(lease_id)
+            del self._by_iccid[lease["iccid"]]
+            if lease["iccid"] in self._sims:
+                self._push_free(lease["iccid"])
+
+    def _expire(self, now):
+        expired = []
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, lease_id = heapq.heappop(self._deadlines)
+            lease = self._leases.get(lease_id)
+            # Renewed leases leave their old deadline behind in the heap.
+            if lease is not None and lease["expires_at"] == deadline:
+                expired.append(lease_id)
+        if expired:
+            print(f"Expired {len(expired)} number lease(s)")
+            self._end(expired)
+
+    def _start_reaper(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="lease-reaper",
+                                            daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        with self._lock:
+            while True:
+                self._expire(time.time())
+                timeout = self._deadlines[0][0] - time.time() if self._deadlines else None
+                self._wakeup.wait(timeout)
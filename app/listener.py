@@ -0,0 +1,168 @@
+import threading
+import time
+
+import main
+from pdu import concat_key, join_parts, parse_cmgr, reassemble
+from scheduler import PRIORITY_INTERACTIVE
+
+
+CMTI_PREFIX = b'+CMTI:'
+# Route new-message indications to the TE as +CMTI: <mem>,<index>.
+ENABLE_INDICATIONS_COMMAND = b'AT+CNMI=2,1,0,0,0\r'
+DISABLE_INDICATIONS_COMMAND = b'AT+CNMI=0,0,0,0,0\r'
+
+DEFAULT_POLL_INTERVAL = 0.05
+DEFAULT_REOPEN_INTERVAL = 10.0
+
+
+def parse_cmti(line):
+    """``b'+CMTI: "SM",3'`` -> ``("SM", 3)``."""
+    try:
+        storage, index = line.decode('utf-8').split(':', 1)[1].split(',')
+        return storage.strip().strip('"'), int(index)
+    except (UnicodeDecodeError, ValueError) as e:
+        print(f"Error parsing new message indication {line!r}: {e}")
+        return None, None
+
+
+class SmsListener:
+    """Keeps modem ports open and pushes new SMS as soon as they arrive.
+
+    Each port gets ``AT+CNMI`` so the modem announces new messages with
+    ``+CMTI``; the listener thread polls the pinned sessions for those
+    lines and queues an interactive ``AT+CMGR`` for just that index.
+    Parts of a concatenated message are held until the last one arrives.
+    ``on_message(port, index, message)`` is called from a scheduler worker.
+    """
+
+    def __init__(self, on_message, baud_rate=115200,
+                 poll_interval=DEFAULT_POLL_INTERVAL,
+                 reopen_interval=DEFAULT_REOPEN_INTERVAL):
+        self.on_message = on_message
+        self.baud_rate = baud_rate
+        self.poll_interval = poll_interval
+        self.reopen_interval = reopen_interval
+        self.ports = set()
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._parts = {}
+
+    def is_running(self):
+        return self._thread is not None
+
+    def start(self, ports=None):
+        ports = ports or main.detect_ports()
+        futures = [main.scheduler.submit(p, self.enable, p,
+                                         priority=PRIORITY_INTERACTIVE)
+                   for p in ports]
+        enabled = [p for p, f in zip(ports, futures) if f.result()]
+        with self._lock:
+            self.ports.update(enabled)
+            if self._thread is None:
+                main.session_pool.add_unsolicited_handler(CMTI_PREFIX, self._on_cmti)
+                self._stop.clear()
+                self._thread = threading.Thread(
+                    target=self._run, name="sms-listener", daemon=True)
+                self._thread.start()
+        return enabled
+
+    def stop(self):
+        with self._lock:
+            ports, self.ports = self.ports, set()
+            thread, self._thread = self._thread, None
+        self._stop.set()
+        if thread is not None:
+            main.session_pool.remove_unsolicited_handler(CMTI_PREFIX, self._on_cmti)
+            thread.join()
+        for port in ports:
+            main.send_at_command(port, self.baud_rate, DISABLE_INDICATIONS_COMMAND)
+            main.session_pool.pin(port, self.baud_rate, pinned=False)
+
+    def enable(self, port):
+        main.session_pool.pin(port, self.baud_rate)
+        response = None
+        if main.set_pdu_mode(port, self.baud_rate):
+            response = main.send_at_command(port, self.baud_rate,
+                                            ENABLE_INDICATIONS_COMMAND)
+        if not response or b'OK' not in response:
+            print(f"Failed to enable new message indications on port {port}")
+            main.session_pool.pin(port, self.baud_rate, pinned=False)
+            return False
+        if self.port_iccid(port) is None:
+            print(f"Unknown SIM on port {port}, its SMS will not be stored")
+        print(f"Listening for new SMS on port {port}")
+        return True
+
+    def port_iccid(self, port):
+        """ICCID of the SIM in ``port``, also before the first scan.
+
+        After a restart ``main.port_iccids`` is empty until the port is
+        scanned, so the card is asked, or else the last stored scan is used.
+        """
+        iccid = main.port_iccids.get(port)
+        if iccid is None:
+            iccid = main.read_iccid(port, self.baud_rate)
+            if iccid is None:
+                port_data = main.scan_store.get_port(port)
+                if port_data and not port_data.get("stale"):
+                    iccid = port_data["responses"].get("ICCID")
+            if iccid is not None:
+                main.port_iccids[port] = iccid
+        return iccid
+
+    def _on_cmti(self, port, line):
+        if port not in self.ports:
+            return
+        storage, index = parse_cmti(line)
+        if index is not None:
+            main.scheduler.submit(port, self.fetch_message, port, index,
+                                  priority=PRIORITY_INTERACTIVE)
+
+    def fetch_message(self, port, index):
+        response = main.send_at_command(
+            port, self.baud_rate, f'AT+CMGR={index}\r'.encode('utf-8'))
+        try:
+            part = parse_cmgr(response, index) if response else None
+        except ValueError as e:
+            print(f"Invalid SMS PDU {index} on port {port}: {e}")
+            part = None
+        if part is None:
+            print(f"Failed to read SMS {index} on port {port}")
+            return None
+        message = self.assemble(port, part)
+        if message is None:
+            return None
+        iccid = self.port_iccid(port)
+        if iccid is not None:
+            main.message_store.add_messages(iccid, port, [message])
+        self.on_message(port, message["index"], message)
+        return message
+
+    def assemble(self, port, part):
+        """Return the whole message, or None while parts are missing."""
+        if part["concat"] is None:
+            return reassemble([part])[0]
+        key = (port,) + concat_key(part)
+        with self._lock:
+            parts = self._parts.setdefault(key, {})
+            parts.setdefault(part["concat"][2], part)
+            if len(parts) < part["concat"][1]:
+                return None
+            del self._parts[key]
+        return join_parts(list(parts.values()))
+
+    def _run(self):
+        last_reopen = time.monotonic()
+        while not self._stop.wait(self.poll_interval):
+            with self._lock:
+                ports = list(self.ports)
+            for port in ports:
+                main.session_pool.poll(port)
+            if time.monotonic() - last_reopen >= self.reopen_interval:
+                last_reopen = time.monotonic()
+                for port in ports:
+                    # A handle dropped after a serial error loses its CNMI setting.
+                    if not main.session_pool.is_open(port):
+                        main.scheduler.submit(port, self.enable, port,
+                                              priority=PRIORITY_INTERACTIVE)
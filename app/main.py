@@ -1,30 +1,119 @@
-import argparse
-import serial.tools.list_ports
 import serial
-import json
 from datetime import datetime
 import concurrent.futures
-import sqlite3
-
-
-db_file = 'data/sim_cards.db'
-conn = sqlite3.connect(db_file)
-cursor = conn.cursor()
-
-
-def send_at_command(port, baud_rate, command, timeout=1.7):
+import time
+
+from at_reader import LatencyTracker, command_key, has_error, is_complete
+from health import FAULT_NO_RESPONSE, FAULT_SERIAL, FAULT_SIM_STATUS, PortHealth
+from metrics import scanner_metrics
+from pdu import LIST_STATUS, parse_cmgl, reassemble
+from scheduler import PortScheduler, DEFAULT_MAX_CONCURRENCY, PRIORITY_SCAN
+from sessions import SessionPool, DEFAULT_IDLE_TTL
+from store import MessageStore, ScanStore, PinDirectory
+from ussd import DEFAULT_MSISDN_TTL, MSISDN_REQUEST, UssdResolver
+
+session_pool = SessionPool(idle_ttl=DEFAULT_IDLE_TTL)
+latency_tracker = LatencyTracker()
+metrics = scanner_metrics()
+port_health = PortHealth()
+scheduler = PortScheduler(max_concurrency=DEFAULT_MAX_CONCURRENCY)
+modem_models = {}
+message_store = MessageStore()
+scan_store = ScanStore(message_store)
+pin_directory = PinDirectory()
+port_iccids = {}
+identity_cache = {}
+pdu_mode_ports = set()
+
+# Storage slots deleted per concatenated AT+CMGD command line.
+DELETE_BATCH_SIZE = 10
+
+# Scan responses that only change when the SIM in the port changes.
+IDENTITY_KEYS = ("Check SIM status", "Get IMSI", "MSISDN",
+                 "Phone Number (USSD)", "Get Operator", "ICCID")
+
+# Extra AT+CMGL time per stored message: a PDU line is up to ~350 bytes,
+# about 30ms at 115200 baud.
+CMGL_TIMEOUT_PER_MESSAGE = 0.05
+
+
+def send_at_command(port, baud_rate, command, timeout=None, expect=None,
+                    retry_timeout=None):
+    """Send one command and return its reply, or None if none came in full.
+
+    A learned timeout can be too tight for a slow reply; such a reply is
+    read on up to ``retry_timeout``, by default the command's default timeout.
+    """
+    if metrics.current_scan() is not None and port_health.port_down(port):
+        return None
+    model = modem_models.get(port, 'unknown')
+    if timeout is None:
+        timeout = latency_tracker.timeout_for(model, command)
+    if retry_timeout is None:
+        retry_timeout = max(timeout, latency_tracker.default_timeout(command))
+    key = command_key(command)
+    started = time.monotonic()
     try:
-        with serial.Serial(port, baud_rate, timeout=timeout) as ser:
-            ser.write(command)
-            response = ser.readall()
-        return response
+        response = session_pool.execute(
+            port, baud_rate, command, timeout, expect, retry_timeout)
     except serial.SerialException as e:
         print(f"Error communicating with port {port}: {e}")
+        metrics.inc('sim_at_command_errors_total', port, key, 'serial')
+        port_health.fault(port, FAULT_SERIAL)
         return None
+    elapsed = time.monotonic() - started
+    latency_tracker.record(model, command, elapsed)
+    record_command(port, key, response, elapsed, expect)
+    if not is_complete(response, expect):
+        if response:
+            print(f"Incomplete reply to {key} on port {port} after {elapsed:.2f}s")
+        return None
+    return response
+
+
+def record_command(port, key, response, elapsed, expect=None):
+    metrics.observe('sim_at_command_duration_seconds', elapsed, port, key)
+    metrics.inc('sim_serial_bytes_read_total', port, amount=len(response))
+    if not is_complete(response, expect):
+        metrics.inc('sim_at_command_timeouts_total', port, key)
+    elif has_error(response):
+        metrics.inc('sim_at_command_errors_total', port, key, 'error')
+    timing = metrics.current_scan()
+    if timing is not None:
+        timing.add_command(key, elapsed)
+
+
+def detect_modem_model(port, baud_rate):
+    if port in modem_models:
+        return modem_models[port]
+    response = send_at_command(port, baud_rate, b'AT+CGMM\r')
+    if not response:
+        # Asked again on the next scan; until then timings pool as 'unknown'.
+        return 'unknown'
+    model = 'unknown'
+    for line in response.decode('utf-8', errors='ignore').split('\r\n'):
+        line = line.strip()
+        if line and line != 'OK' and not line.startswith(('AT', '+CME', 'ERROR')):
+            model = line
+            break
+    modem_models[port] = model
+    return model
 
 
 def detect_ports():
-    return [port.device for port in serial.tools.list_ports.comports()]
+    return session_pool.transport.list_ports()
+
+
+def forget_port(port):
+    """Drop everything held for a port that went away."""
+    scheduler.cancel(port)
+    session_pool.close(port)
+    modem_models.pop(port, None)
+    identity_cache.pop(port, None)
+    port_iccids.pop(port, None)
+    pdu_mode_ports.discard(port)
+    port_health.reset(port)
+    ussd_resolver.cancel(port)
 
 
 def extract_phone_number(response):
@@ -39,6 +128,57 @@ def extract_phone_number(response):
     return None
 
 
+def extract_msisdn(response_str):
+    parts = response_str.split('"')
+    if len(parts) >= 2 and parts[1].startswith('MSISDN:'):
+        return parts[1].split(':')[1].strip()
+    return None
+
+
+def parse_cusd(line):
+    """``(msisdn, text)`` of a ``+CUSD:`` line; text when it is not an MSISDN."""
+    msisdn = extract_msisdn(line)
+    return msisdn, (None if msisdn else extract_phone_number(line.encode('utf-8')))
+
+
+def save_msisdn(iccid, msisdn):
+    scan_store.save_msisdn(iccid, msisdn)
+
+
+ussd_resolver = UssdResolver(session_pool, parse_cusd, save_msisdn)
+
+
+def resolve_msisdn(port, baud_rate, iccid):
+    """MSISDN of the SIM in ``port`` from the cache, else ask the network.
+
+    The USSD request is sent without waiting for its ``+CUSD`` answer,
+    which ``ussd_resolver`` collects while the scan goes on.
+    """
+    msisdn = scan_store.cached_msisdn(iccid, DEFAULT_MSISDN_TTL)
+    if msisdn is not None:
+        return msisdn
+    if not ussd_resolver.expect(port, iccid, baud_rate):
+        return None
+    response = send_at_command(port, baud_rate, MSISDN_REQUEST)
+    if not response or has_error(response):
+        ussd_resolver.cancel(port)
+        return None
+    result = ussd_resolver.result(port, iccid)
+    return result[0] if result else None
+
+
+def apply_ussd_result(port, iccid, responses):
+    """Fill the MSISDN, or the USSD text, from a ``+CUSD`` reply received meanwhile."""
+    result = ussd_resolver.result(port, iccid)
+    if result is None:
+        return
+    msisdn, text = result
+    if msisdn:
+        responses["MSISDN"] = msisdn
+    elif text:
+        responses["Phone Number (USSD)"] = text
+
+
 def extract_iccid(response):
     try:
         parts = response.split(',')
@@ -58,41 +198,140 @@ def extract_iccid(response):
     return None
 
 
-def decode_sms(hex_string):
-    try:
-        bytes_data = bytes.fromhex(hex_string)
-        decoded_text = bytes_data.decode('utf-16-be')
-        decoded_text = decoded_text.rstrip('\x00')
-        decoded_text = decoded_text.replace('\n', '')
-        return decoded_text
-    except (UnicodeDecodeError, ValueError) as e:
-        print(f"Error decoding SMS: {e}")
+def read_iccid(port, baud_rate):
+    response = send_at_command(port, baud_rate, b'AT+CRSM=176,12258,0,0,10\r')
+    if response:
+        return extract_iccid(response.decode('utf-8', errors='ignore').strip())
+    return None
+
+
+def set_pdu_mode(port, baud_rate):
+    response = send_at_command(port, baud_rate, b'AT+CMGF=0\r')
+    if response and b'OK' in response and not has_error(response):
+        pdu_mode_ports.add(port)
+        return True
+    print(f"  Could not switch port {port} to PDU mode: {response}")
+    return False
+
+
+def list_sms(port, baud_rate, status="ALL", used_sms=None):
+    """List SMS in PDU mode and return them decoded and reassembled.
+
+    PDU mode is set once per port. A listing that fails is retried once
+    after setting it again, in case the modem was reset to text mode. The
+    timeout grows with ``used_sms``, the SIM's ``+CPMS`` count, as the
+    learned latency may come from listing an empty SIM.
+    """
+    command = f'AT+CMGL={LIST_STATUS[status]}\r'.encode('ascii')
+    timeout = latency_tracker.timeout_for(modem_models.get(port, 'unknown'), command)
+    timeout += (used_sms or 0) * CMGL_TIMEOUT_PER_MESSAGE
+    for _ in range(2):
+        if port not in pdu_mode_ports and not set_pdu_mode(port, baud_rate):
+            return None
+        response = send_at_command(port, baud_rate, command, timeout=timeout,
+                                   retry_timeout=max(timeout, latency_tracker.ceiling))
+        if response and not has_error(response):
+            return reassemble(parse_cmgl(response, port))
+        pdu_mode_ports.discard(port)
+    print(f"  No SMS listing received on port {port}: {response}")
+    return None
+
+
+def fetch_sms(port, baud_rate, iccid=None, used_sms=None, incremental=True):
+    """Return the messages on the SIM, reading only what the store lacks.
+
+    The first scan of a SIM lists everything; after that only unread
+    messages are pulled. A full listing is done again when the stored count
+    no longer matches the SIM's used count (e.g. messages read or deleted
+    elsewhere), or when an unread part of a concatenated message needs the
+    parts that were already read.
+    """
+    if iccid is None or not incremental:
+        return list_sms(port, baud_rate, "ALL", used_sms)
+
+    full_listing = not message_store.is_synced(iccid)
+    messages = list_sms(port, baud_rate, "ALL" if full_listing else "REC UNREAD",
+                        used_sms)
+    if messages is None:
         return None
+    message_store.add_messages(iccid, port, messages, full_listing)
+
+    if not full_listing and (
+            any(not m["complete"] for m in messages)
+            or (used_sms is not None
+                and message_store.count_on_sim(iccid) != used_sms)):
+        messages = list_sms(port, baud_rate, "ALL", used_sms)
+        if messages is None:
+            return None
+        message_store.add_messages(iccid, port, messages, full_listing=True)
+        full_listing = True
+
+    if full_listing:
+        message_store.mark_synced(iccid)
+    return message_store.get_messages(iccid)
 
 
 def load_iccid_pin_data():
-    iccid_pin_data = {}
-    try:
-        cursor.execute("SELECT iccid, pin FROM sim_cards")
-        rows = cursor.fetchall()
-        for row in rows:
-            iccid = row[0]
-            pin = row[1]
-            iccid_pin_data[iccid] = pin
-    except Exception as e:
-        print(f"Error loading ICCID and PIN data from database: {e}")
-    return iccid_pin_data
+    # PINs are looked up per ICCID on demand and cached, see PinDirectory.
+    return pin_directory
 
 
-def delete_all_sms(port, baud_rate):
-    command = b'AT+CMGD=1,4\r'
+def send_delete_batch(port, baud_rate, indexes):
+    """Delete storage slots with one concatenated ``AT+CMGD`` line."""
+    command = ('AT' + ';'.join(f'+CMGD={i}' for i in indexes) + '\r').encode('ascii')
     response = send_at_command(port, baud_rate, command)
-    if response and b'OK' in response:
-        print(f"All SMS deleted from SIM on port {port}")
-        return True
-    else:
+    return bool(response) and b'OK' in response and not has_error(response)
+
+
+def delete_read_sms(port, baud_rate):
+    """Delete the messages that are read and stored, returns how many.
+
+    The SIM is listed and persisted right before deleting, and only the
+    slots of that listing are deleted, so a message that arrives meanwhile
+    stays on the SIM. Incomplete multipart messages are kept until their
+    remaining parts arrive. If a batch fails part way (some modems reject
+    concatenated commands), the SIM is listed again and what is left of the
+    same messages is deleted one command at a time, slot by slot. A message
+    counts as deleted once none of its slots are left.
+    """
+    iccid = port_iccids.get(port)
+    if iccid is None:
+        print(f"Not deleting SMS on port {port}: unknown ICCID")
+        return 0
+    messages = list_sms(port, baud_rate, "ALL")
+    if messages is None:
         print(f"Failed to delete SMS from SIM on port {port}")
-        return False
+        return 0
+    message_store.add_messages(iccid, port, messages, full_listing=True)
+    message_store.mark_synced(iccid)
+    targets = [m for m in messages if m["complete"]]
+    slots = [i for m in targets for i in m["indexes"]]
+
+    owners = {i: m for m in targets for i in m["indexes"]}
+    gone = set(slots)
+    for start in range(0, len(slots), DELETE_BATCH_SIZE):
+        if send_delete_batch(port, baud_rate, slots[start:start + DELETE_BATCH_SIZE]):
+            continue
+        gone = set(slots[:start])
+        listed = list_sms(port, baud_rate, "ALL")
+        if listed is None:
+            print(f"Failed to delete SMS from SIM on port {port}")
+            break
+        # A slot counts as still held only by the same message, a new one
+        # may have arrived in a slot that the batch did free.
+        held = {i for m in listed for i in m["indexes"]
+                if i in owners and (owners[i]["sender"], owners[i]["timestamp"])
+                == (m["sender"], m["timestamp"])}
+        gone.update(i for i in slots[start:] if i not in held)
+        for i in slots[start:]:
+            if i in held and send_delete_batch(port, baud_rate, [i]):
+                gone.add(i)
+        break
+
+    deleted = [m for m in targets if gone.issuperset(m["indexes"])]
+    message_store.mark_deleted(iccid, [m["index"] for m in deleted])
+    print(f"Deleted {len(deleted)} SMS from SIM on port {port}")
+    return len(deleted)
 
 
 def count_sms_in_sim(port, baud_rate):
@@ -116,6 +355,7 @@ def check_and_unlock_sim(port, baud_rate, iccid_pin_data):
 
     if not status_response:
         print(f"Failed to get SIM status on port {port}")
+        port_health.fault(port, FAULT_NO_RESPONSE)
         return False
 
     try:
@@ -156,25 +396,33 @@ def check_and_unlock_sim(port, baud_rate, iccid_pin_data):
                             if disable_pin_response and b'OK' in disable_pin_response:
                                 print(f"PIN lock on SIM card at port {
                                       port} has been disabled.")
+                                metrics.inc('sim_unlock_attempts_total', port, 'success')
                                 return True
                             else:
                                 print(
                                     f"Failed to disable PIN lock on SIM card at port {port}")
+                                metrics.inc('sim_unlock_attempts_total', port,
+                                            'disable_failed')
                         else:
                             print(f"Failed to unlock SIM card on port {port}")
+                            metrics.inc('sim_unlock_attempts_total', port, 'wrong_pin')
                     else:
                         print(f"No matching ICCID found for {
                               decoded_iccid} on port {port}")
+                        metrics.inc('sim_unlock_attempts_total', port, 'no_pin')
                 else:
                     print(f"Failed to extract ICCID on port {port}")
+                    metrics.inc('sim_unlock_attempts_total', port, 'no_iccid')
             else:
                 print(f"Failed to get ICCID on port {port}")
+                metrics.inc('sim_unlock_attempts_total', port, 'no_iccid')
 
         elif "+CPIN: READY" in status_decoded:
             return True
 
         else:
             print(f"Unexpected SIM status on port {port}: {status_decoded}")
+            port_health.fault(port, FAULT_SIM_STATUS)
 
     except UnicodeDecodeError as e:
         print(f"Error decoding SIM status response on port {port}: {e}")
@@ -185,13 +433,111 @@ def check_and_unlock_sim(port, baud_rate, iccid_pin_data):
     return False
 
 
-def process_single_sim_card(port, baud_rate, iccid_pin_data, full_scan=True):
+def cached_identity(port):
+    identity = identity_cache.get(port)
+    if identity is None:
+        # After a restart the last stored scan seeds the cache.
+        port_data = scan_store.get_port(port)
+        if port_data and port_data["responses"].get("ICCID") is not None:
+            identity = {k: v for k, v in port_data["responses"].items()
+                        if k in IDENTITY_KEYS}
+            identity_cache[port] = identity
+    return identity
+
+
+def update_identity(port_data):
+    responses = port_data["responses"]
+    if responses.get("ICCID") is not None and responses.get("Get IMSI"):
+        identity_cache[port_data["port"]] = {
+            k: v for k, v in responses.items() if k in IDENTITY_KEYS}
+
+
+def rescan_sim_card(port, baud_rate, identity, incremental=True):
+    """Cheap rescan of a port whose SIM we already identified.
+
+    One ICCID probe decides: if it matches the cached identity, only the SMS
+    count and messages are read again. Returns None when the SIM changed or
+    is not ready, so the caller falls back to the full scan.
+    """
+    print(f"Rescanning SIM card on port {port}...")
+    iccid = read_iccid(port, baud_rate)
+    if iccid is None or iccid != identity.get("ICCID"):
+        print(f"  SIM on port {port} changed, doing a full scan")
+        return None
+
+    used_sms, total_sms = count_sms_in_sim(port, baud_rate)
+    if used_sms is None:
+        return None
+
+    port_iccids[port] = iccid
+    with metrics.phase("sms"):
+        sms = fetch_sms(port, baud_rate, iccid, used_sms, incremental)
+    if sms is None:
+        return None
+
+    responses = dict(identity)
+    if not responses.get("MSISDN"):
+        # Resolved after the full scan that filled the identity.
+        msisdn = scan_store.cached_msisdn(iccid, DEFAULT_MSISDN_TTL)
+        if msisdn is not None:
+            responses["MSISDN"] = identity["MSISDN"] = msisdn
+    responses["SMS Count"] = {"used": used_sms, "total": total_sms}
+    responses["Get SMS"] = sms
+    return {"port": port, "timestamp": datetime.now().isoformat(),
+            "responses": responses}
+
+
+def process_single_sim_card(port, baud_rate, iccid_pin_data, full_scan=True,
+                            incremental=True, use_identity_cache=True,
+                            delete_sms=False):
+    # Keep the whole scan on one pooled handle, other callers on this port wait.
+    with session_pool.lock(port, baud_rate), metrics.track_scan() as timing:
+        port_health.begin_scan(port)
+        kind = "full" if full_scan else "sms"
+        port_data = None
+        with timing.phase("model"):
+            detect_modem_model(port, baud_rate)
+        if full_scan and use_identity_cache:
+            identity = cached_identity(port)
+            if identity:
+                with timing.phase("rescan"):
+                    port_data = rescan_sim_card(port, baud_rate, identity, incremental)
+                if port_data:
+                    kind = "rescan"
+        if port_data is None:
+            port_data = scan_sim_card(port, baud_rate, iccid_pin_data, full_scan,
+                                      incremental)
+            if port_data and full_scan:
+                update_identity(port_data)
+        if port_data and delete_sms:
+            with timing.phase("delete"):
+                port_data["deleted"] = delete_read_sms(port, baud_rate)
+            refresh_sms(port, port_data)
+        breakdown = timing.breakdown()
+        if port_health.end_scan(port, port_data is not None):
+            metrics.inc('sim_port_circuit_opens_total', port)
+    metrics.observe('sim_scan_duration_seconds', breakdown["total"], kind)
+    if port_data:
+        port_data["timings"] = dict(breakdown, kind=kind)
+    return port_data
+
+
+def refresh_sms(port, port_data):
+    """Reflect deleted messages in a scan result."""
+    iccid = port_iccids.get(port)
+    if iccid is None:
+        return
+    responses = port_data["responses"]
+    responses["Get SMS"] = message_store.get_messages(iccid)
+    if "SMS Count" in responses:
+        responses["SMS Count"] = dict(responses["SMS Count"],
+                                      used=message_store.count_on_sim(iccid))
 
-    command_timeouts = {
-        "Set Phonebook Storage to MSISDN": 1.7
-    }
 
-    default_timeout = 0.08
+def scan_sim_card(port, baud_rate, iccid_pin_data, full_scan=True,
+                  incremental=True):
+
+    model = modem_models.get(port, 'unknown')
 
     port_data = {"port": port, "timestamp": datetime.now().isoformat(),
                  "responses": {}}
@@ -199,7 +545,9 @@ def process_single_sim_card(port, baud_rate, iccid_pin_data, full_scan=True):
     print(f"Checking SIM card on port {port}...")
 
     if full_scan:
-        if not check_and_unlock_sim(port, baud_rate, iccid_pin_data):
+        with metrics.phase("unlock"):
+            unlocked = check_and_unlock_sim(port, baud_rate, iccid_pin_data)
+        if not unlocked:
             print(f"Skipping port {port} due to SIM status issues.")
             return None
 
@@ -207,18 +555,13 @@ def process_single_sim_card(port, baud_rate, iccid_pin_data, full_scan=True):
         commands = {
             "Check SIM status": b'AT+CPIN?\r',
             "Get IMSI": b'AT+CIMI\r',
-            "Set SMS text mode": b'AT+CMGF=1\r',
-            "Get SMS": b'AT+CMGL="ALL"\r',
-            "Send USSD": b'AT+CUSD=1,"*99#"\r',
-            "Set Phonebook Storage to MSISDN": b'AT+CPBS="ON"\r',
             "Get Operator": b'AT+COPS?\r',
             "Get ICCID": b'AT+CRSM=176,12258,0,0,10\r',
         }
     else:
-        commands = {
-            "Get SMS": b'AT+CMGL="ALL"\r'
-        }
+        commands = {}
 
+    used_sms = None
     if full_scan:
         used_sms, total_sms = count_sms_in_sim(port, baud_rate)
         if used_sms is not None and total_sms is not None:
@@ -227,8 +570,8 @@ def process_single_sim_card(port, baud_rate, iccid_pin_data, full_scan=True):
 
     for desc, command in commands.items():
 
-        timeout = command_timeouts.get(desc, default_timeout)
-        print(f"  Sending command: {desc} (timeout: {timeout})")
+        timeout = latency_tracker.timeout_for(model, command)
+        print(f"  Sending command: {desc} (timeout: {timeout:.2f})")
 
         response = send_at_command(port, baud_rate, command, timeout=timeout)
 
@@ -240,44 +583,13 @@ def process_single_sim_card(port, baud_rate, iccid_pin_data, full_scan=True):
                 decoded_response = decoded_response.rstrip(
                     '\r\n')
 
-                if desc == "Get SMS":
-                    sms_texts = []
-                    sms_messages = decoded_response.split('+CMGL:')
-                    for sms in sms_messages[1:]:
-                        lines = sms.split('\r\n')
-                        if len(lines) >= 2:
-                            sms_info = lines[0].split(',')
-                            sender = sms_info[2].replace(
-                                '"', '') if len(sms_info) > 2 else ''
-                            timestamp = sms_info[4].replace(
-                                '"', '') if len(sms_info) > 4 else ''
-                            sms_content = lines[1].strip()
-                            decoded_sms = decode_sms(sms_content)
-                            if decoded_sms is None:
-                                decoded_sms = sms_content
-                            sms_texts.append({
-                                "sender": sender,
-                                "timestamp": timestamp,
-                                "message": decoded_sms
-                            })
-                        else:
-                            print(f"Invalid SMS format on port {port}: {sms}")
-                    port_data["responses"][desc] = sms_texts
-
-                else:
-                    port_data["responses"][desc] = decoded_response.split('\r\n')[
-                        0]
+                port_data["responses"][desc] = decoded_response.split('\r\n')[0]
 
                 if desc == "Get ICCID":
                     extracted_iccid = extract_iccid(decoded_response)
                     if extracted_iccid:
                         port_data["responses"]["ICCID"] = extracted_iccid
 
-                if desc == "Send USSD" and "CUSD:" in decoded_response:
-                    phone_number = extract_phone_number(response)
-                    if phone_number:
-                        port_data["responses"]["Phone Number (USSD)"] = phone_number
-
                 if desc == "Get Phone Number" and "+CNUM:" in decoded_response:
                     lines = decoded_response.split('\r\n')
                     for line in lines:
@@ -292,12 +604,6 @@ def process_single_sim_card(port, baud_rate, iccid_pin_data, full_scan=True):
                         ',')[2].replace('"', '')
                     port_data["responses"][desc] = operator_code
 
-                if desc == "Set Phonebook Storage to MSISDN" and "+CUSD:" in decoded_response:
-                    parts = decoded_response.split('"')
-                    if len(parts) >= 2 and parts[1].startswith('MSISDN:'):
-                        msisdn = parts[1].split(':')[1].strip()
-                        port_data["responses"]["MSISDN"] = msisdn
-
             except UnicodeDecodeError as e:
                 hex_response = response.hex()
                 port_data["responses"][desc] = hex_response
@@ -310,17 +616,33 @@ def process_single_sim_card(port, baud_rate, iccid_pin_data, full_scan=True):
             port_data["responses"][desc] = None
             print(f"  No response received on port {port}")
 
-    if "Set Phonebook Storage to MSISDN" in port_data["responses"]:
-        del port_data["responses"]["Set Phonebook Storage to MSISDN"]
     if "Get ICCID" in port_data["responses"]:
         del port_data["responses"]["Get ICCID"]
-    if "Send USSD" in port_data["responses"]:
-        del port_data["responses"]["Send USSD"]
+
+    iccid = port_data["responses"].get("ICCID")
+    if iccid is None:
+        iccid = read_iccid(port, baud_rate)
+    if iccid is not None:
+        port_iccids[port] = iccid
+    msisdn = None
+    if full_scan and iccid is not None:
+        with metrics.phase("msisdn"):
+            msisdn = resolve_msisdn(port, baud_rate, iccid)
+    with metrics.phase("sms"):
+        port_data["responses"]["Get SMS"] = fetch_sms(
+            port, baud_rate, iccid, used_sms, incremental)
+
+    if msisdn:
+        port_data["responses"]["MSISDN"] = msisdn
+    else:
+        # The +CUSD answer often lands while the SMS are read.
+        apply_ussd_result(port, iccid, port_data["responses"])
 
     return port_data
 
 
-def process_sim_cards(port=None, delete_sms=False):
+def process_sim_cards(port=None, delete_sms=False, incremental=True,
+                      use_identity_cache=True):
     baud_rate = 115200
     active_ports = detect_ports()
     iccid_pin_data = load_iccid_pin_data()
@@ -330,38 +652,93 @@ def process_sim_cards(port=None, delete_sms=False):
 
     if port:
         active_ports = [port]
+    else:
+        # Ports with an open circuit are left to their backoff schedule.
+        active_ports = [p for p in active_ports if port_health.allow(p)]
+
+    # Deleting is the last step of each port's own scan job.
+    futures = [scheduler.submit(p, process_single_sim_card, p, baud_rate,
+                                iccid_pin_data, full_scan, incremental,
+                                use_identity_cache, delete_sms,
+                                priority=PRIORITY_SCAN)
+               for p in active_ports]
+    for future in concurrent.futures.as_completed(futures):
+        port_data = future.result()
+        if port_data:
+            data.append(port_data)
+
+    # A CLI run exits after saving, so wait for MSISDN requests still out.
+    if not ussd_resolver.wait():
+        print("Some USSD replies did not arrive in time")
+    for port_data in data:
+        responses = port_data["responses"]
+        if not responses.get("MSISDN"):
+            apply_ussd_result(port_data["port"], responses.get("ICCID"), responses)
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = {executor.submit(process_single_sim_card, p, baud_rate,
-                                   iccid_pin_data, full_scan): p for p in active_ports}
-        for future in concurrent.futures.as_completed(futures):
-            port_data = future.result()
-            if port_data:
-                data.append(port_data)
-
-    if delete_sms:
-        for p in active_ports:
-            delete_all_sms(p, baud_rate)
-
-    output_file = 'sim_data.json'
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+    if full_scan:
+        scan_store.replace_ports(data)
+    else:
+        for port_data in data:
+            scan_store.save_port_data(port_data)
 
-    print(f"Data saved to {output_file}")
+    print(f"Data saved to {scan_store.db_file}")
 
 
 def parse_arguments():
+    import argparse
     parser = argparse.ArgumentParser(
         description='Process SIM cards on specified port')
     parser.add_argument('--port', type=str, help='Specify a port to process')
     parser.add_argument('--delete-sms', action='store_true',
-                        help='Delete all SMS messages from SIM storage')
+                        help='Delete the SMS read by the scan from SIM storage')
+    parser.add_argument('--all-sms', action='store_true',
+                        help='List every SMS on the SIM instead of only new ones')
+    parser.add_argument('--full-rescan', action='store_true',
+                        help='Re-read IMSI, MSISDN and operator even for known SIMs')
+    parser.add_argument('--session-ttl', type=float, default=DEFAULT_IDLE_TTL,
+                        help='Seconds an idle port handle stays open')
+    parser.add_argument('--max-concurrency', type=int,
+                        default=DEFAULT_MAX_CONCURRENCY,
+                        help='Maximum number of ports talked to at once')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Scan in this many worker processes, ports split by USB hub')
+    subparsers = parser.add_subparsers(dest='command')
+    export = subparsers.add_parser(
+        'export', help='Stream stored SIMs, scans or SMS history as CSV or NDJSON')
+    export.add_argument('kind', choices=('sims', 'scans', 'messages'))
+    export.add_argument('--format', choices=('csv', 'ndjson'), default='ndjson')
+    export.add_argument('--port', dest='ports', action='append',
+                        help='Only this port (repeatable)')
+    export.add_argument('--since', help='From this ISO time, inclusive')
+    export.add_argument('--until', help='Up to this ISO time, exclusive')
+    export.add_argument('--gzip', action='store_true', help='Gzip the output')
+    export.add_argument('-o', '--output', help='Output file (default stdout)')
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = parse_arguments()
-    if args.port:
-        process_sim_cards(port=args.port, delete_sms=args.delete_sms)
-    else:
-        process_sim_cards()
+    if args.command == 'export':
+        from export import write_export
+        write_export(scan_store, args.kind, args.output, fmt=args.format,
+                     ports=args.ports, since=args.since, until=args.until,
+                     compress=args.gzip)
+        raise SystemExit(0)
+    session_pool.idle_ttl = args.session_ttl
+    scheduler.max_concurrency = args.max_concurrency
+    if args.workers:
+        from shards import ShardedScheduler
+        scheduler = ShardedScheduler(workers=args.workers,
+                                     max_concurrency=args.max_concurrency,
+                                     idle_ttl=args.session_ttl)
+    try:
+        if args.port:
+            process_sim_cards(port=args.port, delete_sms=args.delete_sms,
+                              incremental=not args.all_sms)
+        else:
+            process_sim_cards(delete_sms=args.delete_sms,
+                              incremental=not args.all_sms,
+                              use_identity_cache=not args.full_rescan)
+    finally:
+        scheduler.shutdown()
+        session_pool.close_all()
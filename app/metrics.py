@@ -0,0 +1,193 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+
+# Upper bounds in seconds, sized for AT commands (ms) up to USSD replies (s).
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SCAN_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{name}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class ScanTiming:
+    """Where one port scan spent its time, by phase and by AT command."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.commands = {}
+
+    def add_command(self, command, seconds):
+        entry = self.commands.get(command)
+        if entry is None:
+            entry = self.commands[command] = {"count": 0, "seconds": 0.0}
+        entry["count"] += 1
+        entry["seconds"] += seconds
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - started
+
+    def breakdown(self):
+        return {
+            "total": round(time.perf_counter() - self.started, 4),
+            "phases": {name: round(s, 4) for name, s in self.phases.items()},
+            "commands": {command: {"count": e["count"], "seconds": round(e["seconds"], 4)}
+                         for command, e in self.commands.items()},
+        }
+
+
+class Metrics:
+    """Counters and histograms rendered in the Prometheus text format.
+
+    Recording is a dict lookup and a bisect under one lock, cheap enough to
+    stay on for every AT command. Metrics are declared once with
+    ``counter``/``histogram``; samples are keyed by their label values.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._local = threading.local()
+
+    def counter(self, name, help_text, labels=()):
+        self._metrics[name] = {"type": "counter", "help": help_text,
+                               "labels": tuple(labels), "samples": {}}
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self._metrics[name] = {"type": "histogram", "help": help_text,
+                               "labels": tuple(labels), "buckets": tuple(buckets),
+                               "samples": {}}
+
+    def inc(self, name, *label_values, amount=1):
+        samples = self._metrics[name]["samples"]
+        with self._lock:
+            samples[label_values] = samples.get(label_values, 0) + amount
+
+    def observe(self, name, value, *label_values):
+        metric = self._metrics[name]
+        index = bisect.bisect_left(metric["buckets"], value)
+        with self._lock:
+            sample = metric["samples"].get(label_values)
+            if sample is None:
+                # Per-bucket counts plus a +Inf slot, then sum and count.
+                sample = metric["samples"][label_values] = \
+                    [[0] * (len(metric["buckets"]) + 1), 0.0, 0]
+            sample[0][index] += 1
+            sample[1] += value
+            sample[2] += 1
+
+    @contextmanager
+    def track_scan(self):
+        """Collect a ``ScanTiming`` for the scan running on this thread."""
+        timing = ScanTiming()
+        previous = getattr(self._local, "scan", None)
+        self._local.scan = timing
+        try:
+            yield timing
+        finally:
+            self._local.scan = previous
+
+    def current_scan(self):
+        return getattr(self._local, "scan", None)
+
+    def phase(self, name):
+        """Time a phase of the current scan; a no-op outside ``track_scan``."""
+        timing = self.current_scan()
+        return timing.phase(name) if timing is not None else nullcontext()
+
+    def samples(self):
+        """A picklable copy of every sample, for ``merge`` in another process."""
+        with self._lock:
+            return {name: {k: ([list(v[0]), v[1], v[2]]
+                               if metric["type"] == "histogram" else v)
+                           for k, v in metric["samples"].items()}
+                    for name, metric in self._metrics.items()}
+
+    def merge(self, samples):
+        """Add ``samples()`` taken from another registry with the same metrics."""
+        with self._lock:
+            for name, values in samples.items():
+                metric = self._metrics.get(name)
+                if metric is None:
+                    continue
+                for label_values, value in values.items():
+                    if metric["type"] == "counter":
+                        metric["samples"][label_values] = \
+                            metric["samples"].get(label_values, 0) + value
+                        continue
+                    sample = metric["samples"].setdefault(
+                        label_values, [[0] * len(value[0]), 0.0, 0])
+                    sample[0] = [a + b for a, b in zip(sample[0], value[0])]
+                    sample[1] += value[1]
+                    sample[2] += value[2]
+
+    def render(self):
+        with self._lock:
+            snapshot = [(name, metric, {k: (list(v[0]), v[1], v[2])
+                                        if metric["type"] == "histogram" else v
+                                        for k, v in metric["samples"].items()})
+                        for name, metric in self._metrics.items()]
+        lines = []
+        for name, metric, samples in snapshot:
+            lines.append(f'# HELP {name} {metric["help"]}')
+            lines.append(f'# TYPE {name} {metric["type"]}')
+            for label_values in sorted(samples):
+                labels = list(zip(metric["labels"], label_values))
+                if metric["type"] == "counter":
+                    lines.append(f'{name}{format_labels(labels)} '
+                                 f'{format_value(samples[label_values])}')
+                    continue
+                counts, total, count = samples[label_values]
+                cumulative = 0
+                for bound, bucket_count in zip(metric["buckets"] + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    le = labels + [("le", format_value(float(bound)))]
+                    lines.append(f'{name}_bucket{format_labels(le)} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(labels)} {format_value(total)}')
+                lines.append(f'{name}_count{format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def scanner_metrics():
+    """The metrics recorded by the scanner in ``main``."""
+    metrics = Metrics()
+    metrics.histogram('sim_at_command_duration_seconds',
+                      'AT command round trip time.', ('port', 'command'))
+    metrics.counter('sim_at_command_timeouts_total',
+                    'AT commands without a final result code before the timeout.',
+                    ('port', 'command'))
+    metrics.counter('sim_at_command_errors_total',
+                    'AT commands answered with ERROR/+CME/+CMS or failed on the port.',
+                    ('port', 'command', 'reason'))
+    metrics.counter('sim_serial_bytes_read_total',
+                    'Bytes read in AT command replies.', ('port',))
+    metrics.counter('sim_unlock_attempts_total',
+                    'SIM PIN unlock attempts by result.', ('port', 'result'))
+    metrics.counter('sim_port_circuit_opens_total',
+                    'Times a failing port was taken out of full scans.', ('port',))
+    metrics.histogram('sim_scan_duration_seconds',
+                      'Time to scan one port.', ('kind',), buckets=SCAN_BUCKETS)
+    return metrics
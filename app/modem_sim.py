@@ -0,0 +1,430 @@
+import ast
+import csv
+import json
+import re
+import threading
+import time
+
+import serial
+
+from pdu import CODING_GSM7, CODING_UCS2, decode_gsm7, encode_gsm7, pack_septets
+
+
+DEFAULT_LATENCY = 0.02
+DEFAULT_USSD_LATENCY = 0.3
+SMS_CAPACITY = 30
+STATUS_CODES = {"REC UNREAD": 0, "REC READ": 1, "STO UNSENT": 2, "STO SENT": 3}
+
+
+def encode_iccid_record(iccid):
+    """Build the EF_ICCID bytes ``AT+CRSM=176,12258,...`` returns for ``iccid``.
+
+    The card stores the ICCID nibble-swapped; ``extract_iccid`` keeps digits
+    8-18 of that record, which is where the 10-digit ICCID we use lives.
+    """
+    digits = '89212010' + f'{int(iccid):010d}' + '0F'
+    return ''.join(digits[i:i + 2][::-1] for i in range(0, len(digits), 2))
+
+
+def encode_address(address):
+    digits = address[1:] if address.startswith('+') else address
+    if digits.isdigit():
+        toa = 0x91 if address.startswith('+') else 0x81
+        padded = digits + 'F' * (len(digits) % 2)
+        swapped = ''.join(padded[i + 1] + padded[i] for i in range(0, len(padded), 2))
+        return bytes([len(digits), toa]) + bytes.fromhex(swapped)
+    septets = encode_gsm7(address) or encode_gsm7('?' * len(address))
+    return bytes([(7 * len(septets) + 3) // 4, 0xD0]) + pack_septets(septets)
+
+
+def encode_timestamp(timestamp):
+    """``'2024/09/12 16:46:19+04'`` -> 7 SCTS octets."""
+    match = re.match(r'\d{2}(\d{2})/(\d{2})/(\d{2}) (\d{2}):(\d{2}):(\d{2})([+-])(\d{2})',
+                     timestamp or '')
+    if match is None:
+        return encode_timestamp(time.strftime('%Y/%m/%d %H:%M:%S+00'))
+    octets = bytes(int(field[1] + field[0], 16) for field in match.groups()[:6])
+    quarters = match.group(8)
+    zone = (int(quarters[1]) << 4) | int(quarters[0]) | (0x08 if match.group(7) == '-' else 0)
+    return octets + bytes([zone])
+
+
+def split_message(text):
+    """Split ``text`` into SMS parts: ``[(coding, payload, part_text), ...]``."""
+    septets = encode_gsm7(text)
+    if septets is not None:
+        if len(septets) <= 160:
+            return [(CODING_GSM7, septets, text)]
+        parts, start = [], 0
+        while start < len(septets):
+            end = min(start + 153, len(septets))
+            if septets[end - 1] == 0x1B and end < len(septets):
+                end -= 1  # keep an escape with the character it prefixes
+            parts.append(septets[start:end])
+            start = end
+        return [(CODING_GSM7, part, decode_gsm7(part)) for part in parts]
+    data = text.encode('utf-16-be')
+    if len(data) <= 140:
+        return [(CODING_UCS2, data, text)]
+    parts, start = [], 0
+    while start < len(data):
+        end = min(start + 134, len(data))
+        if 0xD8 <= data[end - 2] <= 0xDB and end < len(data):
+            end -= 2  # do not split a surrogate pair
+        parts.append(data[start:end])
+        start = end
+    return [(CODING_UCS2, part, part.decode('utf-16-be', errors='surrogatepass'))
+            for part in parts]
+
+
+def encode_deliver_pdu(sender, timestamp, coding, payload, concat=None):
+    """Hex SMS-DELIVER PDU (no SMSC) and its TPDU length for ``+CMGL``."""
+    first = 0x04
+    udh = b''
+    if concat is not None:
+        first |= 0x40
+        udh = bytes([5, 0x00, 3, *concat])
+    if coding == CODING_GSM7:
+        skip = (len(udh) * 8 + 6) // 7
+        user_data = bytearray(pack_septets([0] * skip + list(payload)))
+        user_data[:len(udh)] = udh
+        udl, dcs = skip + len(payload), 0x00
+    else:
+        user_data = udh + bytes(payload)
+        udl, dcs = len(user_data), 0x08
+    tpdu = (bytes([first]) + encode_address(sender) + bytes([0x00, dcs])
+            + encode_timestamp(timestamp) + bytes([udl]) + bytes(user_data))
+    return '00' + tpdu.hex().upper(), len(tpdu)
+
+
+class SimulatedModem:
+    """AT command model of one GSM modem with a SIM card.
+
+    Covers the commands the scanner sends: PIN status/unlock, IMSI, ICCID
+    via CRSM, operator, SMS count/list/read/delete in PDU or text mode
+    (long texts are stored as concatenated parts), USSD and CNMI. Every
+    reply is delayed by ``latency`` seconds; the ``+CUSD`` answer to a USSD
+    request arrives ``ussd_latency`` seconds after its ``OK``.
+    """
+
+    def __init__(self, iccid, imsi='', msisdn='', operator='IAM', pin=None,
+                 pin_locked=False, messages=None, model='SIMULATED',
+                 latency=DEFAULT_LATENCY, ussd_latency=DEFAULT_USSD_LATENCY):
+        self.iccid = iccid
+        self.imsi = imsi
+        self.msisdn = msisdn
+        self.operator = operator
+        self.pin = pin
+        self.pin_locked = pin_locked and pin is not None
+        self.model = model
+        self.latency = latency
+        self.ussd_latency = ussd_latency
+        self.text_mode = False
+        self.next_reference = 0
+        self.indications = False
+        self.messages = {}
+        self.handle = None
+        self.lock = threading.Lock()
+        for message in messages or []:
+            self.store_message(message.get("sender", ''), message.get("message", ''),
+                               message.get("timestamp", ''), status="REC READ")
+
+    def store_message(self, sender, text, timestamp='', status="REC UNREAD"):
+        """Store ``text``, one slot per SMS part, returns the slot indexes."""
+        parts = split_message(text)
+        with self.lock:
+            free = [i for i in range(1, SMS_CAPACITY + 1) if i not in self.messages]
+            if len(free) < len(parts):
+                return []
+            reference = self.next_reference
+            self.next_reference = (reference + 1) % 256
+            for seq, (index, (coding, payload, part_text)) in enumerate(
+                    zip(free, parts), 1):
+                concat = (reference, len(parts), seq) if len(parts) > 1 else None
+                pdu, length = encode_deliver_pdu(sender, timestamp, coding, payload,
+                                                 concat)
+                self.messages[index] = {"status": status, "sender": sender,
+                                        "timestamp": timestamp, "text": part_text,
+                                        "pdu": pdu, "length": length}
+        return free[:len(parts)]
+
+    def deliver_sms(self, sender, text, timestamp=None):
+        """Receive a new SMS, announcing each part with +CMTI if indications are on."""
+        timestamp = timestamp or time.strftime('%Y/%m/%d %H:%M:%S+00')
+        indexes = self.store_message(sender, text, timestamp)
+        if self.indications and self.handle is not None:
+            for index in indexes:
+                self.handle.push(f'\r\n+CMTI: "SM",{index}\r\n'.encode('ascii'), 0)
+        return indexes
+
+    def body(self, text):
+        return text.encode('utf-16-be').hex().upper()
+
+    def sms_header(self, index, message, with_index=True):
+        if not self.text_mode:
+            fields = [str(STATUS_CODES[message["status"]]), '', str(message["length"])]
+        else:
+            fields = [f'"{message["status"]}"', f'"{message["sender"]}"', '',
+                      f'"{message["timestamp"]}"']
+        if with_index:
+            fields.insert(0, str(index))
+        return ','.join(fields)
+
+    def sms_body(self, message):
+        return self.body(message["text"]) if self.text_mode else message["pdu"]
+
+    def handle_line(self, line):
+        """Run a command line, including ``AT+A;+B`` concatenated commands.
+
+        Only the last command's ``OK`` is sent and execution stops at the
+        first error, as V.250 specifies.
+        """
+        commands = [c for c in re.split(r';(?=(?:[^"]*"[^"]*")*[^"]*$)', line) if c]
+        replies = []
+        for i, command in enumerate(commands):
+            if i:
+                command = 'AT' + command
+            result = self.handle_command(command)
+            failed = any(b'ERROR' in data for _, data in result)
+            if i < len(commands) - 1 and not failed:
+                result = [(delay, data[:-len(b'\r\nOK\r\n')]
+                           if data.endswith(b'\r\nOK\r\n') else data)
+                          for delay, data in result]
+            replies += [(delay, data) for delay, data in result if data]
+            if failed:
+                break
+        return replies
+
+    def handle_command(self, command):
+        """Return ``[(delay, bytes), ...]`` replies for one command line."""
+        ok = [(self.latency, b'\r\nOK\r\n')]
+        error = [(self.latency, b'\r\nERROR\r\n')]
+
+        def reply(*lines):
+            text = ''.join(f'\r\n{line}\r\n' for line in lines) + '\r\nOK\r\n'
+            return [(self.latency, text.encode('utf-8'))]
+
+        def cme(code):
+            return [(self.latency, f'\r\n+CME ERROR: {code}\r\n'.encode('ascii'))]
+
+        upper = command.upper()
+        if upper == 'AT':
+            return ok
+        if upper == 'AT+CGMM':
+            return reply(self.model)
+        if upper == 'AT+CPIN?':
+            return reply('+CPIN: SIM PIN' if self.pin_locked else '+CPIN: READY')
+        if upper.startswith('AT+CPIN='):
+            if command.split('=', 1)[1].strip('"') == self.pin:
+                self.pin_locked = False
+                return ok
+            return cme(16)
+        if upper.startswith('AT+CLCK='):
+            return ok
+        if upper.startswith('AT+CRSM=176,12258'):
+            return reply(f'+CRSM: 144,0,"{encode_iccid_record(self.iccid)}"')
+        if self.pin_locked:
+            return cme(11)
+        if upper == 'AT+CIMI':
+            return reply(self.imsi)
+        if upper.startswith('AT+CMGF='):
+            self.text_mode = command.split('=', 1)[1].strip() == '1'
+            return ok
+        if upper.startswith('AT+CNMI='):
+            self.indications = command.split('=', 1)[1].split(',')[0].strip() != '0'
+            return ok
+        if upper.startswith('AT+CPMS'):
+            used = len(self.messages)
+            return reply(f'+CPMS: {used},{SMS_CAPACITY},{used},{SMS_CAPACITY},'
+                         f'{used},{SMS_CAPACITY}')
+        if upper.startswith('AT+CMGL'):
+            status = command.split('=', 1)[1].strip()
+            # Text mode takes "ALL", "REC UNREAD"...; PDU mode takes 4, 0...
+            if status.isdigit() == self.text_mode:
+                return [(self.latency, b'\r\n+CMS ERROR: 302\r\n')]
+            return self.list_messages(status.strip('"').upper())
+        if upper.startswith('AT+CMGR='):
+            index = int(command.split('=', 1)[1])
+            with self.lock:
+                message = self.messages.get(index)
+                if message is None:
+                    return [(self.latency, b'\r\n+CMS ERROR: 321\r\n')]
+                header = self.sms_header(index, message, with_index=False)
+                message["status"] = "REC READ"
+            return reply(f'+CMGR: {header}\r\n{self.sms_body(message)}')
+        if upper.startswith('AT+CMGD='):
+            args = command.split('=', 1)[1].split(',')
+            with self.lock:
+                if len(args) > 1 and args[1].strip() == '4':
+                    self.messages.clear()
+                else:
+                    self.messages.pop(int(args[0]), None)
+            return ok
+        if upper.startswith('AT+CUSD='):
+            return ok + [(self.ussd_latency,
+                          f'\r\n+CUSD: 2,"MSISDN:\r{self.msisdn}",15\r\n'.encode('utf-8'))]
+        if upper.startswith('AT+CPBS='):
+            return ok
+        if upper == 'AT+COPS?':
+            return reply(f'+COPS: 0,0,"{self.operator}"')
+        return error
+
+    def list_messages(self, status):
+        wanted = {"ALL": None, "4": None, "REC UNREAD": "REC UNREAD", "0": "REC UNREAD",
+                  "REC READ": "REC READ", "1": "REC READ"}.get(status, None)
+        lines = []
+        with self.lock:
+            for index in sorted(self.messages):
+                message = self.messages[index]
+                if wanted is not None and message["status"] != wanted:
+                    continue
+                lines.append(f'+CMGL: {self.sms_header(index, message)}\r\n'
+                             f'{self.sms_body(message)}')
+                message["status"] = "REC READ"
+        text = ''.join(f'\r\n{line}\r\n' for line in lines) + '\r\nOK\r\n'
+        return [(self.latency, text.encode('utf-8'))]
+
+
+class SimulatedSerial:
+    """``serial.Serial`` stand-in wired to a ``SimulatedModem``."""
+
+    def __init__(self, modem, timeout=None):
+        self.modem = modem
+        self.timeout = timeout
+        self.is_open = True
+        self._ready = b''
+        self._scheduled = []
+        self._cond = threading.Condition()
+        modem.handle = self
+
+    def push(self, data, delay):
+        with self._cond:
+            self._scheduled.append((time.monotonic() + delay, data))
+            self._scheduled.sort(key=lambda item: item[0])
+            self._cond.notify_all()
+
+    def _release(self):
+        now = time.monotonic()
+        while self._scheduled and self._scheduled[0][0] <= now:
+            self._ready += self._scheduled.pop(0)[1]
+
+    @property
+    def in_waiting(self):
+        with self._cond:
+            self._release()
+            return len(self._ready)
+
+    def write(self, data):
+        if not self.is_open:
+            raise serial.SerialException("port is closed")
+        for line in data.decode('utf-8', errors='ignore').split('\r'):
+            if line.strip():
+                for delay, reply in self.modem.handle_line(line.strip()):
+                    self.push(reply, delay)
+        return len(data)
+
+    def read(self, size=1):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                self._release()
+                if self._ready:
+                    data, self._ready = self._ready[:size], self._ready[size:]
+                    return data
+                now = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    return b''
+                wait = None if deadline is None else deadline - now
+                if self._scheduled:
+                    next_ready = self._scheduled[0][0] - now
+                    wait = next_ready if wait is None else min(wait, next_ready)
+                self._cond.wait(max(wait, 0) if wait is not None else None)
+
+    def readall(self):
+        data = b''
+        while True:
+            chunk = self.read(4096)
+            if not chunk:
+                return data
+            data += chunk
+
+    def reset_input_buffer(self):
+        with self._cond:
+            self._release()
+            self._ready = b''
+
+    def close(self):
+        self.is_open = False
+        if self.modem.handle is self:
+            self.modem.handle = None
+
+
+class SimulatedTransport:
+    """Transport over a dict of ``{port: SimulatedModem}``."""
+
+    def __init__(self, modems):
+        self.modems = modems
+
+    def open(self, port, baud_rate, timeout):
+        if port not in self.modems:
+            raise serial.SerialException(f"could not open port {port}")
+        return SimulatedSerial(self.modems[port], timeout)
+
+    def list_ports(self):
+        return list(self.modems)
+
+
+def load_capture(path):
+    """Read SIM profiles from a ``sim_data.json`` or ``output.csv`` capture."""
+    if path.endswith('.json'):
+        with open(path, encoding='utf-8') as f:
+            entries = [entry["responses"] for entry in json.load(f)]
+    else:
+        with open(path, newline='', encoding='utf-8') as f:
+            entries = [ast.literal_eval(row["responses"]) for row in csv.DictReader(f)]
+
+    profiles = []
+    for responses in entries:
+        msisdn = responses.get("MSISDN", '')
+        if not msisdn:
+            # output.csv keeps the raw +CUSD reply.
+            raw = responses.get("Set Phonebook Storage to MSISDN") or ''
+            match = re.search(r'MSISDN:\s*(\d+)', raw)
+            msisdn = match.group(1) if match else ''
+        operator = responses.get("Get Operator", '')
+        match = re.search(r'"(\w+)"', operator)
+        if match:
+            operator = match.group(1)
+        messages = responses.get("Get SMS") or responses.get("SMS") or []
+        profiles.append({
+            "iccid": int(responses.get("ICCID") or 0),
+            "imsi": responses.get("Get IMSI", ''),
+            "msisdn": msisdn,
+            "operator": operator if operator and not operator.startswith('+') else 'IAM',
+            "messages": [{"sender": m.get("sender", ''),
+                          "timestamp": m.get("timestamp", ''),
+                          "message": m.get("message") or m.get("text") or ''}
+                         for m in messages],
+        })
+    return profiles
+
+
+def build_rack(count, profiles, latency=DEFAULT_LATENCY,
+               ussd_latency=DEFAULT_USSD_LATENCY, locked_every=0):
+    """Make ``count`` modems on ports SIM1..SIMn, cycling through ``profiles``.
+
+    ICCIDs and IMSIs get a per-port suffix so every SIM is distinct. With
+    ``locked_every=n`` every n-th SIM starts PIN locked with PIN 1234.
+    """
+    modems = {}
+    for i in range(count):
+        profile = profiles[i % len(profiles)]
+        locked = bool(locked_every) and i % locked_every == 0
+        modems[f'SIM{i + 1}'] = SimulatedModem(
+            iccid=int(f'{profile["iccid"]:010d}'[:4] + f'{i:06d}'),
+            imsi=profile["imsi"][:-4] + f'{i:04d}' if profile["imsi"] else f'{i:015d}',
+            msisdn=profile["msisdn"], operator=profile["operator"],
+            pin='1234' if locked else None, pin_locked=locked,
+            messages=profile["messages"], latency=latency,
+            ussd_latency=ussd_latency)
+    return modems
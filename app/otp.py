@@ -0,0 +1,53 @@
+import json
+import os
+import re
+
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+default_patterns_file = os.path.join(base_dir, '../data/otp_patterns.json')
+
+ANY_SENDER = '*'
+# A 4-8 digit run that is not part of a longer number such as an MSISDN.
+DEFAULT_PATTERNS = {
+    'Google': r'G-(\d{4,8})',
+    ANY_SENDER: r'(?<!\d)(\d{4,8})(?!\d)',
+}
+
+
+class OtpExtractor:
+    """Pulls verification codes out of SMS bodies with per-sender patterns.
+
+    Patterns map a sender (case-insensitive, ``*`` for any other sender) to
+    a regex; the first group, or the whole match, is the code. They come
+    from ``data/otp_patterns.json`` when it exists, e.g.
+    ``{"Google": "G-(\\\\d{6})", "*": "code[: ]+(\\\\d+)"}``.
+    """
+
+    def __init__(self, patterns=None):
+        patterns = DEFAULT_PATTERNS if patterns is None else patterns
+        self.patterns = {sender.lower(): re.compile(pattern)
+                         for sender, pattern in patterns.items()}
+
+    @classmethod
+    def from_file(cls, path=None):
+        path = path or default_patterns_file
+        if not os.path.exists(path):
+            return cls()
+        try:
+            with open(path, encoding='utf-8') as f:
+                return cls(json.load(f))
+        except (OSError, ValueError, re.error) as e:
+            print(f"Error loading OTP patterns from {path}: {e}")
+            return cls()
+
+    def extract(self, sender, message):
+        if not message:
+            return None
+        pattern = self.patterns.get((sender or '').lower(),
+                                    self.patterns.get(ANY_SENDER))
+        if pattern is None:
+            return None
+        match = pattern.search(message)
+        if match is None:
+            return None
+        return match.group(1) if match.groups() else match.group(0)
@@ -0,0 +1,263 @@
+"""SMS PDU decoding (3GPP TS 23.040 / 23.038).
+
+Turns ``AT+CMGL=4`` / ``AT+CMGR`` replies in PDU mode (``AT+CMGF=0``) into
+message dicts: GSM 7-bit (with the extension table), 8-bit and UCS-2
+bodies, alphanumeric and numeric senders, and concatenated messages
+reassembled from their user data headers.
+"""
+
+GSM7_BASIC = (
+    '@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞ\x1bÆæßÉ !"#¤%&\'()*+,-./0123456789:;<=>?'
+    '¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà'
+)
+GSM7_ESCAPE = 0x1B
+GSM7_EXTENSION = {
+    0x0A: '\x0c', 0x14: '^', 0x28: '{', 0x29: '}', 0x2F: '\\',
+    0x3C: '[', 0x3D: '~', 0x3E: ']', 0x40: '|', 0x65: '€',
+}
+
+CODING_GSM7 = 'gsm7'
+CODING_8BIT = '8bit'
+CODING_UCS2 = 'ucs2'
+
+# +CMGL/+CMGR <stat> values in PDU mode.
+STATUS_NAMES = {0: "REC UNREAD", 1: "REC READ", 2: "STO UNSENT", 3: "STO SENT"}
+LIST_STATUS = {"REC UNREAD": 0, "REC READ": 1, "STO UNSENT": 2, "STO SENT": 3,
+               "ALL": 4}
+
+IEI_CONCAT_8BIT = 0x00
+IEI_CONCAT_16BIT = 0x08
+
+MTI_DELIVER = 0x00
+MTI_SUBMIT = 0x01
+
+
+def unpack_septets(data, count):
+    """The first ``count`` 7-bit values packed LSB first in ``data``."""
+    value = int.from_bytes(data, 'little')
+    return [(value >> (7 * i)) & 0x7F for i in range(count)]
+
+
+def pack_septets(septets):
+    value = 0
+    for i, septet in enumerate(septets):
+        value |= septet << (7 * i)
+    return value.to_bytes((7 * len(septets) + 7) // 8, 'little')
+
+
+def decode_gsm7(septets):
+    chars = []
+    escape = False
+    for septet in septets:
+        if escape:
+            chars.append(GSM7_EXTENSION.get(septet, GSM7_BASIC[septet]))
+            escape = False
+        elif septet == GSM7_ESCAPE:
+            escape = True
+        else:
+            chars.append(GSM7_BASIC[septet])
+    return ''.join(chars)
+
+
+_GSM7_REVERSE = {char: i for i, char in enumerate(GSM7_BASIC) if i != GSM7_ESCAPE}
+_GSM7_EXTENSION_REVERSE = {char: i for i, char in GSM7_EXTENSION.items()}
+
+
+def encode_gsm7(text):
+    """Septets for ``text``, or None if it needs UCS-2."""
+    septets = []
+    for char in text:
+        if char in _GSM7_REVERSE:
+            septets.append(_GSM7_REVERSE[char])
+        elif char in _GSM7_EXTENSION_REVERSE:
+            septets += [GSM7_ESCAPE, _GSM7_EXTENSION_REVERSE[char]]
+        else:
+            return None
+    return septets
+
+
+def data_coding(dcs):
+    """Alphabet named by a TP-DCS octet."""
+    group = dcs >> 4
+    if group <= 0x07:
+        if dcs & 0x20:
+            # Compressed text is not supported by any modem we use.
+            return CODING_8BIT
+        return (CODING_GSM7, CODING_8BIT, CODING_UCS2, CODING_GSM7)[(dcs >> 2) & 0x03]
+    if group in (0x0C, 0x0D):
+        return CODING_GSM7
+    if group == 0x0E:
+        return CODING_UCS2
+    if group == 0x0F:
+        return CODING_8BIT if dcs & 0x04 else CODING_GSM7
+    return CODING_8BIT
+
+
+def swap_nibbles(data):
+    return ''.join(f'{b & 0x0F:X}{b >> 4:X}' for b in data)
+
+
+def decode_address(data, digits, toa):
+    if toa & 0x70 == 0x50:
+        # Alphanumeric sender such as "Google", GSM 7-bit packed.
+        return decode_gsm7(unpack_septets(data, digits * 4 // 7))
+    number = swap_nibbles(data)[:digits].rstrip('F')
+    return '+' + number if toa & 0x70 == 0x10 else number
+
+
+def decode_timestamp(data):
+    """SCTS -> ``'2024/09/12 16:46:19+04'``, the format text mode prints."""
+    fields = [int(swap_nibbles(data[i:i + 1])) for i in range(6)]
+    zone = data[6]
+    quarters = (zone & 0x07) * 10 + (zone >> 4)
+    sign = '-' if zone & 0x08 else '+'
+    return ('20{:02d}/{:02d}/{:02d} {:02d}:{:02d}:{:02d}'.format(*fields)
+            + f'{sign}{quarters:02d}')
+
+
+def parse_udh(header):
+    """Return ``(reference, total, sequence)`` for a concatenated part, else None."""
+    pos = 0
+    while pos + 1 < len(header):
+        iei, length = header[pos], header[pos + 1]
+        value = header[pos + 2:pos + 2 + length]
+        pos += 2 + length
+        if iei == IEI_CONCAT_8BIT and length == 3:
+            return value[0], value[1], value[2]
+        if iei == IEI_CONCAT_16BIT and length == 4:
+            return (value[0] << 8) | value[1], value[2], value[3]
+    return None
+
+
+def decode_user_data(data, udl, coding, has_udh):
+    """Body text and concatenation info of a TP-UD field."""
+    concat = None
+    header_octets = 0
+    if has_udh:
+        header_octets = data[0] + 1
+        concat = parse_udh(data[1:header_octets])
+    if coding == CODING_GSM7:
+        skip = (header_octets * 8 + 6) // 7
+        return decode_gsm7(unpack_septets(data, udl)[skip:]), concat
+    body = data[header_octets:udl]
+    if coding == CODING_UCS2:
+        return body.decode('utf-16-be', errors='surrogatepass'), concat
+    return body.decode('latin-1'), concat
+
+
+def decode_pdu(pdu):
+    """Decode one SMS-DELIVER or SMS-SUBMIT PDU (hex, with SMSC prefix).
+
+    Returns ``{"sender", "timestamp", "message", "concat"}``; ``sender`` is
+    the recipient for stored outgoing messages. Raises ``ValueError`` on a
+    malformed PDU.
+    """
+    try:
+        data = bytes.fromhex(pdu.strip())
+        pos = data[0] + 1
+        first = data[pos]
+        mti = first & 0x03
+        pos += 1
+        if mti == MTI_SUBMIT:
+            pos += 1  # TP-MR
+        elif mti != MTI_DELIVER:
+            raise ValueError(f"unsupported message type {mti}")
+        digits, toa = data[pos], data[pos + 1]
+        address_octets = (digits + 1) // 2
+        sender = decode_address(data[pos + 2:pos + 2 + address_octets], digits, toa)
+        pos += 2 + address_octets
+        dcs = data[pos + 1]
+        pos += 2
+        timestamp = ''
+        if mti == MTI_DELIVER:
+            timestamp = decode_timestamp(data[pos:pos + 7])
+            pos += 7
+        else:
+            validity = (first >> 3) & 0x03
+            pos += {0: 0, 2: 1}.get(validity, 7)
+        udl = data[pos]
+        message, concat = decode_user_data(data[pos + 1:], udl, data_coding(dcs),
+                                           bool(first & 0x40))
+    except IndexError as e:
+        raise ValueError(f"truncated PDU: {e}") from e
+    return {"sender": sender, "timestamp": timestamp, "message": message,
+            "concat": concat}
+
+
+def parse_cmgl(response, port=None):
+    """Decode a whole ``AT+CMGL`` PDU-mode reply in one pass.
+
+    Returns message parts in listing order, each with its storage
+    ``index`` and ``status``. Unreadable entries are logged and skipped.
+    """
+    lines = response.decode('ascii', errors='ignore').split('\r\n')
+    parts = []
+    for i, line in enumerate(lines):
+        if not line.startswith('+CMGL:') or i + 1 >= len(lines):
+            continue
+        try:
+            fields = line.split(':', 1)[1].split(',')
+            part = decode_pdu(lines[i + 1])
+            part["index"] = int(fields[0])
+            part["status"] = STATUS_NAMES.get(int(fields[1]), fields[1].strip())
+        except ValueError as e:
+            print(f"Invalid SMS PDU on port {port}: {line} {lines[i + 1]!r}: {e}")
+            continue
+        parts.append(part)
+    return parts
+
+
+def parse_cmgr(response, index):
+    """Decode an ``AT+CMGR`` PDU-mode reply into one message part."""
+    lines = response.decode('ascii', errors='ignore').split('\r\n')
+    for i, line in enumerate(lines):
+        if line.startswith('+CMGR:') and i + 1 < len(lines):
+            part = decode_pdu(lines[i + 1])
+            part["index"] = index
+            fields = line.split(':', 1)[1].split(',')
+            part["status"] = STATUS_NAMES.get(int(fields[0]), fields[0].strip())
+            return part
+    raise ValueError("no +CMGR line in reply")
+
+
+def concat_key(part):
+    reference, total, _ = part["concat"]
+    return part["sender"], reference, total
+
+
+def join_parts(parts):
+    """One message from the parts of a concatenated SMS, in sequence order."""
+    parts = sorted(parts, key=lambda p: p["concat"][2])
+    total = parts[0]["concat"][1]
+    # Rejoin before decoding so a surrogate pair split across parts survives.
+    text = ''.join(p["message"] for p in parts)
+    text = text.encode('utf-16-be', errors='surrogatepass').decode(
+        'utf-16-be', errors='replace')
+    return {"index": parts[0]["index"], "sender": parts[0]["sender"],
+            "timestamp": parts[0]["timestamp"], "message": text,
+            "indexes": [p["index"] for p in parts],
+            "complete": len(parts) == total}
+
+
+def reassemble(parts):
+    """Merge concatenated parts into whole messages, keeping listing order.
+
+    Each message gets ``indexes`` (every storage slot it occupies) and
+    ``complete`` (False while parts are still missing).
+    """
+    groups = {}
+    messages = []
+    for part in parts:
+        if part["concat"] is None:
+            messages.append({"index": part["index"], "sender": part["sender"],
+                             "timestamp": part["timestamp"],
+                             "message": part["message"],
+                             "indexes": [part["index"]], "complete": True})
+            continue
+        key = concat_key(part)
+        if key not in groups:
+            groups[key] = {}
+            messages.append(key)
+        groups[key].setdefault(part["concat"][2], part)
+    return [join_parts(list(groups[m].values())) if isinstance(m, tuple) else m
+            for m in messages]
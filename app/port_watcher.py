@@ -0,0 +1,86 @@
+import threading
+
+
+DEFAULT_WATCH_INTERVAL = 2.0
+
+
+class PortWatcher:
+    """Keeps the set of live modem ports and reports hot-plug changes.
+
+    A background thread re-lists the ports every ``interval`` seconds and
+    calls ``on_added(port)`` / ``on_removed(port)`` for the differences. The
+    first listing only seeds the inventory, so startup does not look like
+    every port was just plugged in. A port that disappears and comes back
+    (a re-enumerated modem) is reported as added again.
+    """
+
+    def __init__(self, list_ports, on_added=None, on_removed=None,
+                 interval=DEFAULT_WATCH_INTERVAL):
+        self.list_ports = list_ports
+        self.on_added = on_added
+        self.on_removed = on_removed
+        self.interval = interval
+        self._ports = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def is_running(self):
+        return self._thread is not None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="port-watcher", daemon=True)
+            self._thread.start()
+        if self._ports is None:
+            self.refresh()
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        self._stop.set()
+        if thread is not None:
+            thread.join()
+
+    def ports(self):
+        """Current inventory, listed once if the watcher has not run yet."""
+        if self._ports is None:
+            self.refresh()
+        with self._lock:
+            return sorted(self._ports)
+
+    def refresh(self):
+        """List the ports once and report changes, returns (added, removed)."""
+        try:
+            current = set(self.list_ports())
+        except Exception as e:
+            print(f"Error listing ports: {e}")
+            return set(), set()
+        with self._lock:
+            previous, self._ports = self._ports, current
+        if previous is None:
+            return set(), set()
+        added, removed = current - previous, previous - current
+        for port in sorted(removed):
+            print(f"Port {port} removed")
+            self._notify(self.on_removed, port)
+        for port in sorted(added):
+            print(f"Port {port} added")
+            self._notify(self.on_added, port)
+        return added, removed
+
+    def _notify(self, callback, port):
+        if callback is None:
+            return
+        try:
+            callback(port)
+        except Exception as e:
+            print(f"Error handling port change on {port}: {e}")
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.refresh()
@@ -0,0 +1,158 @@
+import asyncio
+import concurrent.futures
+import heapq
+import itertools
+import threading
+
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_SCAN = 1
+PRIORITY_HOUSEKEEPING = 2
+
+DEFAULT_MAX_CONCURRENCY = 32
+
+
+class PrioritySlots:
+    """Asyncio semaphore that hands free slots to the best priority first."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self._waiters = []
+        self._seq = itertools.count()
+
+    async def acquire(self, priority):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # The slot may have been handed over just before the cancel.
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                # The slot passes straight to the waiter, ``active`` stays.
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+class PortScheduler:
+    """Runs blocking port jobs from one asyncio loop with per-port queues.
+
+    Every port gets a priority queue drained by a coroutine, so jobs on one
+    port never overlap and a queued interactive job overtakes queued scans
+    and housekeeping. At most ``max_concurrency`` jobs run at once across all
+    ports, on a thread pool of the same size, so hundreds of ports do not
+    mean hundreds of threads. ``submit`` is thread-safe and returns a
+    ``concurrent.futures.Future``; cancelling it drops a job that has not
+    started yet.
+    """
+
+    def __init__(self, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self._executor = None
+        self._loop = None
+        self._thread = None
+        self._slots = None
+        self._queues = {}
+        self._pending = {}
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_concurrency, thread_name_prefix="port-io")
+            self._loop = asyncio.new_event_loop()
+            self._slots = PrioritySlots(self.max_concurrency)
+            self._thread = threading.Thread(
+                target=self._loop.run_forever, name="port-scheduler", daemon=True)
+            self._thread.start()
+
+    def submit(self, port, fn, *args, priority=PRIORITY_SCAN):
+        self.start()
+        future = concurrent.futures.Future()
+        job = (priority, next(self._seq), future, fn, args)
+        with self._lock:
+            self._pending.setdefault(port, set()).add(future)
+        future.add_done_callback(lambda f: self._forget(port, f))
+        self._loop.call_soon_threadsafe(self._enqueue, port, job)
+        return future
+
+    def _forget(self, port, future):
+        with self._lock:
+            pending = self._pending.get(port)
+            if pending is not None:
+                pending.discard(future)
+                if not pending:
+                    del self._pending[port]
+
+    def _enqueue(self, port, job):
+        queue = self._queues.get(port)
+        if queue is None:
+            queue = self._queues[port] = asyncio.PriorityQueue()
+            self._loop.create_task(self._drain(queue))
+        queue.put_nowait(job)
+
+    async def _drain(self, queue):
+        while True:
+            priority, _, future, fn, args = await queue.get()
+            if future.done():
+                continue
+            await self._slots.acquire(priority)
+            try:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    result = await self._loop.run_in_executor(
+                        self._executor, fn, *args)
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            finally:
+                self._slots.release()
+
+    def pending(self, port=None):
+        """Number of queued or running jobs, for one port or overall."""
+        with self._lock:
+            if port is not None:
+                return len(self._pending.get(port, ()))
+            return sum(len(p) for p in self._pending.values())
+
+    def cancel(self, port=None):
+        """Cancel queued jobs for ``port`` (or all ports). Running jobs finish."""
+        with self._lock:
+            if port is not None:
+                futures = list(self._pending.get(port, ()))
+            else:
+                futures = [f for p in self._pending.values() for f in p]
+        return sum(1 for future in futures if future.cancel())
+
+    def shutdown(self):
+        self.cancel()
+        with self._lock:
+            if self._thread is None:
+                return
+            loop, thread, executor = self._loop, self._thread, self._executor
+            self._thread = None
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        loop.close()
+        executor.shutdown(wait=False, cancel_futures=True)
+        self._queues.clear()
@@ -0,0 +1,248 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import serial
+
+from at_reader import is_complete, read_response
+from transport import SerialTransport
+
+DEFAULT_IDLE_TTL = 30.0
+
+
+class PortSession:
+    """One open serial handle for a port, guarded by its own lock."""
+
+    def __init__(self, port, baud_rate, transport):
+        self.port = port
+        self.transport = transport
+        self.baud_rate = baud_rate
+        self.lock = threading.RLock()
+        self.ser = None
+        self.last_used = time.monotonic()
+        self.pinned = False
+        self.pending = b''
+
+    def is_open(self):
+        return self.ser is not None and self.ser.is_open
+
+    def open(self, timeout):
+        if not self.is_open():
+            self.ser = self.transport.open(self.port, self.baud_rate, timeout)
+        return self.ser
+
+    def close(self):
+        if self.ser is not None:
+            try:
+                self.ser.close()
+            except serial.SerialException as e:
+                print(f"Error closing port {self.port}: {e}")
+            self.ser = None
+
+
+class SessionPool:
+    """Keeps one serial handle per port open between AT commands.
+
+    Callers get the handle under a per-port lock, so commands on the same
+    port never interleave while different ports run in parallel. Handles
+    that stay unused for longer than ``idle_ttl`` seconds are closed by a
+    background reaper thread unless the port is pinned.
+
+    Unsolicited result codes (``+CMTI:`` and friends) are handed to the
+    callbacks registered with ``add_unsolicited_handler``, whether they show
+    up between commands or inside a command's reply; in the latter case
+    they are taken out of the reply returned to the caller.
+    """
+
+    def __init__(self, idle_ttl=DEFAULT_IDLE_TTL, transport=None):
+        self.idle_ttl = idle_ttl
+        self.transport = transport or SerialTransport()
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._reaper = None
+        self._stop = threading.Event()
+        self._handlers = []
+
+    def _get_session(self, port, baud_rate):
+        with self._lock:
+            session = self._sessions.get(port)
+            if session is None:
+                session = PortSession(port, baud_rate, self.transport)
+                self._sessions[port] = session
+            self._start_reaper()
+        if session.baud_rate != baud_rate:
+            with session.lock:
+                session.close()
+                session.baud_rate = baud_rate
+        return session
+
+    def lock(self, port, baud_rate):
+        """Return the port lock so a caller can keep a command sequence together."""
+        return self._get_session(port, baud_rate).lock
+
+    @contextmanager
+    def session(self, port, baud_rate, timeout=None):
+        """Hold the port lock and yield its open serial handle.
+
+        The lock is re-entrant, so a caller holding the session for a whole
+        command sequence can still go through ``execute``.
+        """
+        session = self._get_session(port, baud_rate)
+        with session.lock:
+            ser = session.open(timeout)
+            try:
+                yield ser
+            finally:
+                session.last_used = time.monotonic()
+
+    def execute(self, port, baud_rate, command, timeout, expect=None,
+                retry_timeout=None):
+        """Send one command on the pooled handle and return the raw reply.
+
+        Reading stops at the final result code (see ``read_response``). A
+        ``SerialException`` drops the handle and the command is retried once
+        on a fresh connection before the error is propagated.
+
+        A reply still incomplete after ``timeout`` is read on for up to
+        ``retry_timeout`` seconds in total, without sending the command again.
+        """
+        session = self._get_session(port, baud_rate)
+        with session.lock:
+            for attempt in range(2):
+                try:
+                    ser = session.open(timeout)
+                    if ser.in_waiting:
+                        self._dispatch(session, ser.read(ser.in_waiting))
+                    ser.reset_input_buffer()
+                    ser.write(command)
+                    response = read_response(ser, timeout, expect)
+                    if retry_timeout is not None and retry_timeout > timeout \
+                            and not is_complete(response, expect):
+                        response = read_response(ser, retry_timeout - timeout, expect,
+                                                 response)
+                    if self._handlers:
+                        # A late URC (e.g. the +CUSD of an earlier request)
+                        # must not be parsed as part of this reply.
+                        response = b'\r\n'.join(self._dispatch_lines(
+                            session, response.split(b'\r\n'), keep=expect))
+                    return response
+                except serial.SerialException:
+                    session.close()
+                    if attempt:
+                        raise
+                    print(f"Reconnecting to port {port}...")
+                finally:
+                    session.last_used = time.monotonic()
+
+    def add_unsolicited_handler(self, prefix, callback):
+        """Call ``callback(port, line)`` for every line starting with ``prefix``.
+
+        Callbacks run with the port lock held and must not block.
+        """
+        # Replaced rather than changed in place: dispatch iterates it unlocked.
+        self._handlers = self._handlers + [(prefix, callback)]
+
+    def remove_unsolicited_handler(self, prefix, callback):
+        """Stop calling a callback added with ``add_unsolicited_handler``."""
+        self._handlers = [h for h in self._handlers if h != (prefix, callback)]
+
+    def _dispatch(self, session, data):
+        lines = (session.pending + data).split(b'\r\n')
+        session.pending = lines.pop()
+        self._dispatch_lines(session, lines)
+
+    def _dispatch_lines(self, session, lines, keep=None):
+        """Hand unsolicited lines to their callbacks and return the others.
+
+        Lines starting with ``keep`` (a reply's ``expect``) are returned too.
+        """
+        if isinstance(keep, str):
+            keep = keep.encode('ascii')
+        rest = []
+        for raw in lines:
+            line = raw.strip()
+            handled = False
+            for prefix, callback in self._handlers:
+                if line.startswith(prefix):
+                    handled = True
+                    try:
+                        callback(session.port, line)
+                    except Exception as e:
+                        print(f"Error handling {line!r} on port {session.port}: {e}")
+            if not handled or (keep and line.startswith(keep)):
+                rest.append(raw)
+        return rest
+
+    def pin(self, port, baud_rate, pinned=True):
+        """Keep a port open past the idle TTL, e.g. while listening for SMS."""
+        self._get_session(port, baud_rate).pinned = pinned
+
+    def pinned_ports(self):
+        with self._lock:
+            return [s.port for s in self._sessions.values() if s.pinned]
+
+    def is_open(self, port):
+        with self._lock:
+            session = self._sessions.get(port)
+        return session is not None and session.is_open()
+
+    def poll(self, port):
+        """Read unsolicited data waiting on an idle port without blocking."""
+        with self._lock:
+            session = self._sessions.get(port)
+        if session is None or not session.lock.acquire(blocking=False):
+            return
+        try:
+            if session.is_open() and session.ser.in_waiting:
+                self._dispatch(session, session.ser.read(session.ser.in_waiting))
+                session.last_used = time.monotonic()
+        except serial.SerialException as e:
+            print(f"Error polling port {port}: {e}")
+            session.close()
+        finally:
+            session.lock.release()
+
+    def close(self, port):
+        with self._lock:
+            session = self._sessions.pop(port, None)
+        if session is not None:
+            with session.lock:
+                session.close()
+
+    def close_idle(self):
+        now = time.monotonic()
+        with self._lock:
+            sessions = list(self._sessions.values())
+        for session in sessions:
+            if session.pinned or now - session.last_used < self.idle_ttl:
+                continue
+            # Skip ports that are busy right now, the next sweep gets them.
+            if session.lock.acquire(blocking=False):
+                try:
+                    if session.is_open():
+                        session.close()
+                finally:
+                    session.lock.release()
+
+    def close_all(self):
+        self._stop.set()
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            with session.lock:
+                session.close()
+
+    def _start_reaper(self):
+        if self._reaper is not None or not self.idle_ttl:
+            return
+        self._stop.clear()
+        self._reaper = threading.Thread(
+            target=self._reap, name="session-reaper", daemon=True)
+        self._reaper.start()
+
+    def _reap(self):
+        interval = max(1.0, self.idle_ttl / 2)
+        while not self._stop.wait(interval):
+            self.close_idle()
+        self._reaper = None
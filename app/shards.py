@@ -0,0 +1,367 @@
+import concurrent.futures
+import importlib
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import os
+import sys
+import threading
+import time
+import zlib
+
+import main
+from metrics import scanner_metrics
+from scheduler import (DEFAULT_MAX_CONCURRENCY, PRIORITY_INTERACTIVE, PRIORITY_SCAN,
+                       PortScheduler)
+from sessions import DEFAULT_IDLE_TTL
+from store import MessageStore, PinDirectory, ScanStore
+from ussd import DEFAULT_USSD_TIMEOUT
+
+
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+# How often a job is moved to another worker after its worker died.
+MAX_ATTEMPTS = 2
+MONITOR_INTERVAL = 0.5
+# A stopping worker first waits for its USSD replies.
+SHUTDOWN_TIMEOUT = DEFAULT_USSD_TIMEOUT + 5.0
+
+
+def hub_key(location):
+    """USB hub of a pyserial ``location`` such as ``'1-1.4.2:1.0'`` -> ``'1-1.4'``."""
+    path = location.split(':', 1)[0]
+    return path.rsplit('.', 1)[0] if '.' in path else path
+
+
+def job_function(fn):
+    """Name a job function so a worker can import it, even from ``__main__``."""
+    module = fn.__module__
+    return ('main' if module == '__main__' else module), fn.__qualname__
+
+
+def worker_metrics():
+    """This worker's metric samples, see ``ShardedScheduler.metrics``."""
+    return main.metrics.samples()
+
+
+def worker_main(worker_id, tasks, results, config):
+    """Scan worker process: runs jobs for its ports on its own scheduler.
+
+    Each worker has its own ``main`` state (session pool, identity and PDU
+    caches) and shares the SQLite database with the coordinator. Results go
+    back over the worker's own pipe, so a worker killed mid-write cannot
+    block the others.
+    """
+    if config.get("quiet"):
+        sys.stdout = open(os.devnull, 'w')
+    transport = config.get("transport")
+    if transport is not None:
+        factory, args = transport
+        main.session_pool.transport = factory(*args)
+    if config.get("db_file"):
+        main.message_store = MessageStore(config["db_file"])
+        main.scan_store = ScanStore(main.message_store)
+        main.pin_directory = PinDirectory(config["db_file"])
+    # Spawn re-imports the parent's __main__ (app.py), which may have put a
+    # ShardedScheduler in main.scheduler; a worker runs its jobs itself.
+    main.scheduler = PortScheduler(config.get("max_concurrency", DEFAULT_MAX_CONCURRENCY))
+    main.session_pool.idle_ttl = config["idle_ttl"]
+    send_lock = threading.Lock()
+
+    def send_result(call_id, future):
+        if future.cancelled():
+            result = (call_id, "cancelled", None)
+        elif future.exception() is not None:
+            result = (call_id, "error", repr(future.exception()))
+        else:
+            result = (call_id, "ok", future.result())
+        with send_lock:
+            results.send(result)
+
+    def send_health(port, ok, fault):
+        # Sent ahead of the job's result, on the same pipe.
+        with send_lock:
+            results.send((None, "health", (port, ok, fault)))
+    main.port_health.on_outcome = send_health
+
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            call_id, port, (module, name), args, priority = task
+            fn = getattr(importlib.import_module(module), name)
+            if port is None:
+                # Not a port job (worker_metrics): answered right away.
+                future = concurrent.futures.Future()
+                try:
+                    future.set_result(fn(*args))
+                except Exception as e:
+                    future.set_exception(e)
+                send_result(call_id, future)
+                continue
+            future = main.scheduler.submit(port, fn, *args, priority=priority)
+            future.add_done_callback(lambda f, call_id=call_id: send_result(call_id, f))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        main.scheduler.shutdown()
+        # The worker's MSISDN requests are answered to its own sessions.
+        main.ussd_resolver.wait()
+        main.session_pool.close_all()
+
+
+class ShardedScheduler:
+    """``PortScheduler`` stand-in that spreads ports over worker processes.
+
+    Ports are partitioned by USB hub when the transport reports port
+    locations, otherwise by a hash of the port name, and stay with their
+    worker so its sessions and caches are reused. Jobs are sent to the
+    owning worker and its results stream back over the worker's pipe into
+    the returned futures. When a worker dies, its ports move to the surviving
+    workers, its unfinished jobs are resent (up to ``MAX_ATTEMPTS`` times)
+    and a fresh worker takes its place for new ports. Scan outcomes come
+    back the same way into ``main.port_health``, so circuit breaking works
+    as with one process.
+
+    Job functions must be module-level functions (``main.*``) and their
+    arguments picklable. Settings of the workers' own ``main`` state, such
+    as ``idle_ttl``, are passed in: a worker does not see what the parent's
+    ``__main__`` set.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 transport=None, db_file=None, locations=None, quiet=False,
+                 idle_ttl=DEFAULT_IDLE_TTL):
+        self.workers = workers
+        self.max_concurrency = max_concurrency
+        self.config = {"transport": transport, "db_file": db_file,
+                       "max_concurrency": max_concurrency, "idle_ttl": idle_ttl,
+                       "quiet": quiet}
+        self.locations = locations or getattr(main.session_pool.transport,
+                                              'port_locations', None)
+        self._context = multiprocessing.get_context('spawn')
+        self._results = []
+        self._processes = []
+        self._tasks = []
+        self._assignment = {}
+        self._groups = {}
+        self._calls = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._monitor = None
+        self._stop = threading.Event()
+
+    def start(self):
+        with self._lock:
+            if self._monitor is not None:
+                return
+            self._stop.clear()
+            # Create and migrate the tables here once, so workers opening
+            # the database at the same time don't race on ALTER TABLE.
+            message_store = MessageStore(self.config["db_file"])
+            for store in (message_store, ScanStore(message_store),
+                          PinDirectory(self.config["db_file"])):
+                store.connection()
+            self._results = [None] * self.workers
+            self._processes = [None] * self.workers
+            self._tasks = [None] * self.workers
+            for worker_id in range(self.workers):
+                self._spawn(worker_id)
+            self._monitor = threading.Thread(target=self._run, name="shard-monitor",
+                                             daemon=True)
+            self._monitor.start()
+
+    def _spawn(self, worker_id):
+        tasks = self._context.Queue()
+        reader, writer = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=worker_main, args=(worker_id, tasks, writer, self.config),
+            name=f"scan-worker-{worker_id}", daemon=True)
+        process.start()
+        writer.close()
+        if self._results[worker_id] is not None:
+            self._results[worker_id].close()
+        self._processes[worker_id] = process
+        self._tasks[worker_id] = tasks
+        self._results[worker_id] = reader
+
+    def _group(self, port):
+        """Ports on one USB hub share a worker; other ports stand alone."""
+        if self.locations is None:
+            return port
+        try:
+            location = self.locations().get(port)
+        except Exception as e:
+            print(f"Error reading port locations: {e}")
+            return port
+        return hub_key(location) if location else port
+
+    def _owner(self, port, exclude=()):
+        """Worker for ``port``, assigning new ports by hub or hash. Lock held."""
+        worker_id = self._assignment.get(port)
+        if worker_id is not None and worker_id not in exclude:
+            return worker_id
+        group = self._group(port)
+        worker_id = self._groups.get(group)
+        if worker_id is None or worker_id in exclude:
+            candidates = [w for w in range(self.workers) if w not in exclude]
+            worker_id = candidates[zlib.crc32(group.encode('utf-8')) % len(candidates)]
+            self._groups[group] = worker_id
+        self._assignment[port] = worker_id
+        return worker_id
+
+    def assignment(self):
+        with self._lock:
+            return dict(self._assignment)
+
+    def submit(self, port, fn, *args, priority=PRIORITY_SCAN):
+        self.start()
+        future = concurrent.futures.Future()
+        function = job_function(fn)
+        with self._lock:
+            call_id = next(self._ids)
+            worker_id = self._owner(port)
+            self._calls[call_id] = {"future": future, "port": port, "fn": function,
+                                    "args": args, "priority": priority,
+                                    "worker": worker_id, "attempts": 1}
+            self._tasks[worker_id].put((call_id, port, function, args, priority))
+        return future
+
+    def _resolve(self, call_id, status, value):
+        with self._lock:
+            call = self._calls.pop(call_id, None)
+        if call is None:
+            return
+        future = call["future"]
+        try:
+            if status == "ok":
+                future.set_result(value)
+            elif status == "cancelled":
+                future.cancel()
+            else:
+                future.set_exception(RuntimeError(
+                    f"Job on port {call['port']} failed in a scan worker: {value}"))
+        except concurrent.futures.InvalidStateError:
+            pass  # cancelled by the caller meanwhile
+
+    def _check_workers(self):
+        for worker_id, process in enumerate(self._processes):
+            if process.is_alive() or self._stop.is_set():
+                continue
+            print(f"Scan worker {worker_id} died (exit code {process.exitcode}), "
+                  f"reassigning its ports")
+            failed = []
+            with self._lock:
+                self._assignment = {p: w for p, w in self._assignment.items()
+                                    if w != worker_id}
+                self._groups = {g: w for g, w in self._groups.items() if w != worker_id}
+                for call_id, call in list(self._calls.items()):
+                    if call["worker"] != worker_id:
+                        continue
+                    if call["attempts"] >= MAX_ATTEMPTS or self.workers == 1:
+                        failed.append(call_id)
+                        continue
+                    call["attempts"] += 1
+                    call["worker"] = self._owner(call["port"], exclude=(worker_id,))
+                    self._tasks[call["worker"]].put(
+                        (call_id, call["port"], call["fn"], call["args"],
+                         call["priority"]))
+                self._spawn(worker_id)
+            for call_id in failed:
+                self._resolve(call_id, "error", "worker died")
+
+    def _run(self):
+        last_check = time.monotonic()
+        while not self._stop.is_set():
+            with self._lock:
+                readers = list(self._results)
+            for reader in multiprocessing.connection.wait(readers,
+                                                          timeout=MONITOR_INTERVAL):
+                try:
+                    call_id, status, value = reader.recv()
+                except (EOFError, OSError):
+                    last_check = 0.0  # its worker died: replace it right away
+                    continue
+                if status == "health":
+                    # Full scans and probes run off the coordinator's health.
+                    main.port_health.record(*value)
+                else:
+                    self._resolve(call_id, status, value)
+            # On a timer: a steady stream of results from busy workers must
+            # not hold up noticing a dead one.
+            if time.monotonic() - last_check >= MONITOR_INTERVAL:
+                self._check_workers()
+                last_check = time.monotonic()
+
+    def metrics(self, timeout=5.0):
+        """``main.metrics`` merged with every worker's, as one ``Metrics``.
+
+        The scanner's metrics are recorded where the commands run, in the
+        workers. A worker that died takes its counts with it.
+        """
+        merged = scanner_metrics()
+        merged.merge(main.metrics.samples())
+        futures = []
+        with self._lock:
+            if self._monitor is not None:
+                for worker_id, tasks in enumerate(self._tasks):
+                    call_id = next(self._ids)
+                    future = concurrent.futures.Future()
+                    # Never resent: its worker's samples died with it.
+                    self._calls[call_id] = {
+                        "future": future, "port": None,
+                        "fn": job_function(worker_metrics), "args": (),
+                        "priority": PRIORITY_INTERACTIVE, "worker": worker_id,
+                        "attempts": MAX_ATTEMPTS}
+                    tasks.put((call_id, None, job_function(worker_metrics), (),
+                               PRIORITY_INTERACTIVE))
+                    futures.append(future)
+        for future in futures:
+            try:
+                merged.merge(future.result(timeout=timeout))
+            except (concurrent.futures.TimeoutError, concurrent.futures.CancelledError,
+                    RuntimeError) as e:
+                print(f"Missing a scan worker's metrics: {e!r}")
+        return merged
+
+    def pending(self, port=None):
+        with self._lock:
+            if port is not None:
+                return sum(1 for c in self._calls.values() if c["port"] == port)
+            return len(self._calls)
+
+    def cancel(self, port=None):
+        """Cancel jobs not yet answered; workers finish what they started.
+
+        Cancelling one port (``main.forget_port``) also makes its worker
+        drop the port's session and caches.
+        """
+        with self._lock:
+            calls = [(call_id, c) for call_id, c in self._calls.items()
+                     if port is None or c["port"] == port]
+        cancelled = 0
+        for call_id, call in calls:
+            if call["future"].cancel():
+                cancelled += 1
+                with self._lock:
+                    self._calls.pop(call_id, None)
+        if port is not None and self._monitor is not None and port in self._assignment:
+            self.submit(port, main.forget_port, port, priority=PRIORITY_INTERACTIVE)
+        return cancelled
+
+    def shutdown(self):
+        self.cancel()
+        with self._lock:
+            if self._monitor is None:
+                return
+            monitor, self._monitor = self._monitor, None
+            self._stop.set()
+        for tasks in self._tasks:
+            tasks.put(None)
+        for process in self._processes:
+            process.join(timeout=SHUTDOWN_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+        monitor.join()
+        for reader in self._results:
+            reader.close()
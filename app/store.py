@@ -0,0 +1,1067 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from otp import OtpExtractor
+
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+default_db_file = os.path.join(base_dir, '../data/sim_cards.db')
+
+# An ICCID without a PIN is looked up again after this long, in case
+# another process imported it meanwhile.
+PIN_MISS_TTL = 60.0
+# How often a code waiter looks for messages stored by another process.
+CODE_POLL_INTERVAL = 0.25
+# Rows read per query when streaming an export.
+EXPORT_BATCH_SIZE = 1000
+# Scan history: a full snapshot after this many changes to a port.
+KEYFRAME_INTERVAL = 32
+
+
+class SqliteStore:
+    """Base for stores in ``data/sim_cards.db``.
+
+    Each thread gets its own connection, opened in WAL mode so API reads
+    never wait for a scan that is writing. Subclasses create their tables
+    in ``initialize``, which runs once on first use.
+    """
+
+    def __init__(self, db_file=None):
+        self.db_file = db_file or default_db_file
+        self._local = threading.local()
+        self._initialized = False
+        self._init_lock = threading.Lock()
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.db_file), exist_ok=True)
+            conn = sqlite3.connect(self.db_file, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        if not self._initialized:
+            with self._init_lock:
+                if not self._initialized:
+                    self.initialize(conn)
+                    self._initialized = True
+        return conn
+
+    def initialize(self, conn):
+        pass
+
+    def next_version(self, conn):
+        """Allocate the version stamped on rows changed in this transaction."""
+        conn.execute('UPDATE data_version SET version = version + 1')
+        return conn.execute('SELECT version FROM data_version').fetchone()[0]
+
+    @contextmanager
+    def versioned(self, conn):
+        """Yield the version for rows changed in the current transaction.
+
+        The shared counter only keeps the increment if a row changed, so
+        ``current_version`` moves on every change, row deletes included,
+        and on nothing else.
+        """
+        version = self.next_version(conn)
+        before = conn.total_changes
+        yield version
+        if conn.total_changes == before:
+            conn.execute('UPDATE data_version SET version = version - 1')
+
+    def current_version(self):
+        """Value of the shared change counter, an ETag for everything stored."""
+        return self.connection().execute(
+            'SELECT version FROM data_version').fetchone()[0]
+
+    def max_version(self, table):
+        """Version of the last change to ``table``, an index lookup."""
+        return self.connection().execute(
+            f'SELECT COALESCE(MAX(version), 0) FROM {table}').fetchone()[0]
+
+
+def create_version_table(conn):
+    """Shared change counter: rows carry the version of their last change so
+    pollers can ask for what changed since a version they already have."""
+    conn.executescript('''
+        CREATE TABLE IF NOT EXISTS data_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO data_version (id, version) VALUES (1, 0);
+    ''')
+
+
+def add_version_column(conn, table):
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+    if 'version' not in columns:
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_version ON {table} (version)')
+
+
+def page_query(query, params, cursor_column, cursor, limit):
+    """Append keyset pagination: rows after ``cursor``, one extra to see if more."""
+    if cursor is not None:
+        query += f' AND {cursor_column} > ?'
+        params.append(cursor)
+    query += f' ORDER BY {cursor_column} LIMIT ?'
+    params.append(limit + 1)
+    return query, params
+
+
+def export_filter(query, params, port_column, ports, time_column, since, until):
+    """Restrict an export to some ports and a ``[since, until)`` time range."""
+    if ports:
+        query += f" AND {port_column} IN ({','.join('?' * len(ports))})"
+        params += list(ports)
+    if since is not None:
+        query += f' AND {time_column} >= ?'
+        params.append(since)
+    if until is not None:
+        query += f' AND {time_column} < ?'
+        params.append(until)
+    return query, params
+
+
+def iter_pages(store, query, params, cursor_column, batch_size=EXPORT_BATCH_SIZE):
+    """Every row of ``query``, read in keyset-paged batches.
+
+    Each batch is a short read of its own, so a long export neither holds a
+    snapshot open nor buffers the table. ``cursor_column`` must be the
+    first column selected.
+    """
+    cursor = None
+    while True:
+        page, page_params = page_query(query, list(params), cursor_column, cursor,
+                                       batch_size)
+        rows = store.connection().execute(page, page_params).fetchall()
+        yield from rows[:batch_size]
+        if len(rows) <= batch_size:
+            return
+        cursor = rows[batch_size - 1][0]
+
+
+def part_columns(message):
+    """``(parts, part_indexes)`` column values for a message dict."""
+    indexes = message.get("indexes") or [message["index"]]
+    if len(indexes) == 1:
+        return 1, None
+    return len(indexes), ','.join(str(i) for i in indexes)
+
+
+class MessageStore(SqliteStore):
+    """Persistent, deduplicated SMS bodies keyed by ICCID and storage index.
+
+    A message is identified by (ICCID, index, timestamp, sender), so listing
+    the same SIM again never stores a message twice. ``sms_sync`` remembers
+    which SIMs had a full listing, after which only unread messages need to
+    be pulled. Verification codes are extracted once when a message is
+    stored and indexed, so ``wait_for_code`` can block until one arrives.
+    """
+
+    def __init__(self, db_file=None, otp_extractor=None):
+        super().__init__(db_file)
+        self._otp_extractor = otp_extractor
+        self._stored = threading.Condition()
+        # Bumped under _stored by every add_messages that stored something.
+        self._generation = 0
+
+    @property
+    def otp_extractor(self):
+        # Patterns are read on first use, not when main is imported.
+        if self._otp_extractor is None:
+            self._otp_extractor = OtpExtractor.from_file()
+        return self._otp_extractor
+
+    def initialize(self, conn):
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS sms_messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                iccid INTEGER NOT NULL,
+                sim_index INTEGER NOT NULL,
+                sender TEXT NOT NULL DEFAULT '',
+                timestamp TEXT NOT NULL DEFAULT '',
+                message TEXT,
+                port TEXT,
+                received_at TEXT,
+                on_sim INTEGER NOT NULL DEFAULT 1,
+                parts INTEGER NOT NULL DEFAULT 1,
+                part_indexes TEXT,
+                UNIQUE (iccid, sim_index, timestamp, sender)
+            );
+            CREATE INDEX IF NOT EXISTS idx_sms_messages_on_sim
+                ON sms_messages (iccid, on_sim);
+            CREATE INDEX IF NOT EXISTS idx_sms_messages_port
+                ON sms_messages (port);
+            CREATE TABLE IF NOT EXISTS sms_sync (
+                iccid INTEGER PRIMARY KEY,
+                synced_at TEXT
+            );
+        ''')
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(sms_messages)')]
+        if 'parts' not in columns:
+            conn.execute('ALTER TABLE sms_messages ADD COLUMN parts INTEGER NOT NULL DEFAULT 1')
+            conn.execute('ALTER TABLE sms_messages ADD COLUMN part_indexes TEXT')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_sms_messages_sender '
+                     'ON sms_messages (sender)')
+        create_version_table(conn)
+        add_version_column(conn, 'sms_messages')
+        if 'otp' not in columns:
+            conn.execute('ALTER TABLE sms_messages ADD COLUMN otp TEXT')
+            rows = conn.execute('SELECT id, sender, message FROM sms_messages').fetchall()
+            conn.executemany('UPDATE sms_messages SET otp = ? WHERE id = ?',
+                             [(self.otp_extractor.extract(sender, message), id_)
+                              for id_, sender, message in rows])
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_sms_messages_otp
+                        ON sms_messages (iccid, sender, id) WHERE otp IS NOT NULL''')
+        conn.commit()
+
+    def is_synced(self, iccid):
+        cursor = self.connection().execute(
+            'SELECT 1 FROM sms_sync WHERE iccid = ?', (iccid,))
+        return cursor.fetchone() is not None
+
+    def mark_synced(self, iccid):
+        conn = self.connection()
+        conn.execute('INSERT OR REPLACE INTO sms_sync (iccid, synced_at) VALUES (?, ?)',
+                     (iccid, datetime.now().isoformat()))
+        conn.commit()
+
+    def add_messages(self, iccid, port, messages, full_listing=False):
+        """Store messages read from the SIM, returns how many rows changed.
+
+        With ``full_listing`` the messages are everything on the SIM, so any
+        stored message missing from them is flagged as no longer on the SIM.
+        A concatenated message is one row; ``indexes`` lists the storage
+        slots of its parts. Rows that did not change keep their version.
+        """
+        received_at = datetime.now().isoformat()
+        conn = self.connection()
+        with conn, self.versioned(conn) as version:
+            before = conn.total_changes
+            conn.executemany('''
+                INSERT INTO sms_messages
+                    (iccid, sim_index, sender, timestamp, message, port, received_at,
+                     parts, part_indexes, version, otp)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (iccid, sim_index, timestamp, sender)
+                DO UPDATE SET on_sim = 1, port = excluded.port,
+                    message = excluded.message, parts = excluded.parts,
+                    part_indexes = excluded.part_indexes, version = excluded.version,
+                    otp = excluded.otp
+                WHERE on_sim = 0 OR port IS NOT excluded.port
+                    OR message IS NOT excluded.message
+                    OR part_indexes IS NOT excluded.part_indexes
+            ''', [(iccid, m["index"], m["sender"], m["timestamp"], m["message"],
+                   port, received_at, *part_columns(m), version,
+                   self.otp_extractor.extract(m["sender"], m["message"]))
+                  for m in messages])
+            if full_listing:
+                query = 'UPDATE sms_messages SET on_sim = 0, version = ? ' \
+                        'WHERE iccid = ? AND on_sim = 1'
+                params = [version, iccid]
+                if messages:
+                    query += (' AND (sim_index, timestamp, sender) NOT IN (VALUES '
+                              + ','.join(['(?, ?, ?)'] * len(messages)) + ')')
+                    for m in messages:
+                        params += [m["index"], m["timestamp"], m["sender"]]
+                conn.execute(query, params)
+            changed = conn.total_changes - before
+        if changed:
+            with self._stored:
+                self._generation += 1
+                self._stored.notify_all()
+        return changed
+
+    def count_on_sim(self, iccid):
+        """Storage slots in use on the SIM, comparable to the +CPMS count."""
+        cursor = self.connection().execute(
+            'SELECT COALESCE(SUM(parts), 0) FROM sms_messages '
+            'WHERE iccid = ? AND on_sim = 1', (iccid,))
+        return cursor.fetchone()[0]
+
+    def get_messages(self, iccid, on_sim=True):
+        return self.get_messages_by_iccid([iccid], on_sim).get(iccid, [])
+
+    def get_messages_by_iccid(self, iccids, on_sim=True):
+        """Return ``{iccid: [message, ...]}`` for many SIMs in one query."""
+        iccids = list(iccids)
+        if not iccids:
+            return {}
+        query = f'''SELECT iccid, sim_index, sender, timestamp, message
+                    FROM sms_messages
+                    WHERE iccid IN ({','.join('?' * len(iccids))})'''
+        if on_sim:
+            query += ' AND on_sim = 1'
+        cursor = self.connection().execute(
+            query + ' ORDER BY iccid, sim_index, id', iccids)
+        messages = {}
+        for iccid, index, sender, timestamp, message in cursor.fetchall():
+            messages.setdefault(iccid, []).append(
+                {"index": index, "sender": sender, "timestamp": timestamp,
+                 "message": message})
+        return messages
+
+    def mark_deleted(self, iccid, indexes=None):
+        """Flag messages as gone from the SIM, all of them if ``indexes`` is None."""
+        conn = self.connection()
+        with conn, self.versioned(conn) as version:
+            if indexes is None:
+                conn.execute('UPDATE sms_messages SET on_sim = 0, version = ? '
+                             'WHERE iccid = ? AND on_sim = 1', (version, iccid))
+            else:
+                conn.executemany(
+                    'UPDATE sms_messages SET on_sim = 0, version = ? '
+                    'WHERE iccid = ? AND sim_index = ? AND on_sim = 1',
+                    [(version, iccid, index) for index in indexes])
+
+    def find_code(self, iccid=None, msisdn=None, sender=None, after=None):
+        """Newest message with a code for a SIM (by ICCID or MSISDN), optionally
+        from ``sender`` and stored at or after ``after`` (ISO time)."""
+        query = '''SELECT id, iccid, port, sender, timestamp, message, otp, received_at
+                   FROM sms_messages WHERE otp IS NOT NULL'''
+        params = []
+        if iccid is not None:
+            query += ' AND iccid = ?'
+            params.append(normalize_iccid(iccid))
+        if msisdn is not None:
+            query += ' AND iccid IN (SELECT iccid FROM sims WHERE msisdn = ?)'
+            params.append(msisdn)
+        if sender is not None:
+            query += ' AND sender = ?'
+            params.append(sender)
+        if after is not None:
+            query += ' AND received_at >= ?'
+            params.append(after)
+        row = self.connection().execute(query + ' ORDER BY id DESC LIMIT 1',
+                                        params).fetchone()
+        if row is None:
+            return None
+        columns = ("id", "iccid", "port", "sender", "timestamp", "message", "code",
+                   "received_at")
+        return dict(zip(columns, row))
+
+    def wait_for_code(self, iccid=None, msisdn=None, sender=None, after=None,
+                      timeout=30.0):
+        """Block until ``find_code`` matches or ``timeout`` seconds pass.
+
+        Every ``add_messages`` that stores something wakes the waiters, so a
+        code is returned as soon as the scan or listener persists it. Writes
+        from other processes (scan workers, the CLI) cannot wake them and are
+        picked up every ``CODE_POLL_INTERVAL`` seconds. The query runs
+        outside the lock, and only again once something was stored or that
+        interval has passed.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._stored:
+                generation = self._generation
+            found = self.find_code(iccid, msisdn, sender, after)
+            queried = time.monotonic()
+            if found is not None or queried >= deadline:
+                return found
+            wake_at = min(deadline, queried + CODE_POLL_INTERVAL)
+            with self._stored:
+                while self._generation == generation:
+                    remaining = wake_at - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._stored.wait(remaining)
+
+    def query_messages(self, port=None, iccid=None, msisdn=None, sender=None,
+                       since=None, changed_since=None, cursor=None, limit=100):
+        """Filtered page of messages, ordered by id.
+
+        Only messages still on the SIM are returned, except with
+        ``changed_since`` (a version from an earlier response): then every
+        row changed after it comes back, removals included, so a client can
+        apply the delta. ``since`` filters on ``received_at``. Returns
+        ``(rows, next_cursor)``.
+        """
+        query = '''SELECT m.id, m.iccid, m.port, m.sim_index, m.sender, m.timestamp,
+                          m.message, m.received_at, m.on_sim, m.version, m.otp
+                   FROM sms_messages m WHERE 1 = 1'''
+        params = []
+        if changed_since is not None:
+            query += ' AND m.version > ?'
+            params.append(changed_since)
+        else:
+            query += ' AND m.on_sim = 1'
+        for column, value in (('m.port', port), ('m.iccid', normalize_iccid(iccid)),
+                              ('m.sender', sender)):
+            if value is not None:
+                query += f' AND {column} = ?'
+                params.append(value)
+        if msisdn is not None:
+            query += ' AND m.iccid IN (SELECT iccid FROM sims WHERE msisdn = ?)'
+            params.append(msisdn)
+        if since is not None:
+            query += ' AND m.received_at >= ?'
+            params.append(since)
+        query, params = page_query(query, params, 'm.id', cursor, limit)
+        rows = self.connection().execute(query, params).fetchall()
+        columns = ("id", "iccid", "port", "index", "sender", "timestamp", "message",
+                   "received_at", "on_sim", "version", "code")
+        items = [dict(zip(columns, row), on_sim=bool(row[8])) for row in rows[:limit]]
+        return items, (items[-1]["id"] if len(rows) > limit else None)
+
+    def export_messages(self, ports=None, since=None, until=None):
+        """Yield every stored message, deleted ones included, by ``received_at``
+        range and port."""
+        query, params = export_filter(
+            '''SELECT id, iccid, port, sim_index, sender, timestamp, message,
+                      received_at, on_sim, parts, otp
+               FROM sms_messages WHERE 1 = 1''', [],
+            'port', ports, 'received_at', since, until)
+        columns = ("id", "iccid", "port", "index", "sender", "timestamp", "message",
+                   "received_at", "on_sim", "parts", "code")
+        for row in iter_pages(self, query, params, 'id'):
+            yield dict(zip(columns, row), on_sim=bool(row[8]))
+
+
+def message_key(message):
+    return f'{message["index"]}|{message["timestamp"]}|{message["sender"]}'
+
+
+def state_delta(old, new):
+    """What changed between two port states, or None if nothing did."""
+    delta = {}
+    if old["stale"] != new["stale"]:
+        delta["stale"] = new["stale"]
+    responses = {k: v for k, v in new["responses"].items()
+                 if old["responses"].get(k) != v}
+    removed = [k for k in old["responses"] if k not in new["responses"]]
+    if responses:
+        delta["responses"] = responses
+    if removed:
+        delta["responses_removed"] = removed
+    messages = {k: m for k, m in new["messages"].items() if k not in old["messages"]}
+    messages_removed = [k for k in old["messages"] if k not in new["messages"]]
+    if messages:
+        delta["messages"] = messages
+    if messages_removed:
+        delta["messages_removed"] = messages_removed
+    return delta or None
+
+
+def apply_delta(state, delta):
+    state["stale"] = delta.get("stale", state["stale"])
+    state["responses"].update(delta.get("responses", {}))
+    for key in delta.get("responses_removed", ()):
+        state["responses"].pop(key, None)
+    state["messages"].update(delta.get("messages", {}))
+    for key in delta.get("messages_removed", ()):
+        state["messages"].pop(key, None)
+    return state
+
+
+class HistoryStore(SqliteStore):
+    """Per-port scan history stored as changes between consecutive scans.
+
+    A scan that changes nothing writes nothing, so the table grows with the
+    number of changes (SIM swaps, operator, SMS count, messages arriving or
+    leaving) rather than with how often the rack is scanned. Every
+    ``keyframe_interval`` changes a port gets a full snapshot, so rebuilding
+    its state at any moment reads one keyframe and at most that many deltas
+    through the ``(port, keyframe, recorded_at)`` index.
+    """
+
+    def __init__(self, db_file=None, keyframe_interval=KEYFRAME_INTERVAL):
+        super().__init__(db_file)
+        self.keyframe_interval = keyframe_interval
+        self._lock = threading.Lock()
+        # port -> (latest state, deltas written since its keyframe, its row id)
+        self._latest = {}
+
+    def initialize(self, conn):
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS scan_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                port TEXT NOT NULL,
+                recorded_at TEXT NOT NULL,
+                keyframe INTEGER NOT NULL DEFAULT 0,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_scan_history_port
+                ON scan_history (port, recorded_at);
+            CREATE INDEX IF NOT EXISTS idx_scan_history_keyframe
+                ON scan_history (port, keyframe, recorded_at);
+            CREATE INDEX IF NOT EXISTS idx_scan_history_last
+                ON scan_history (port, id);
+        ''')
+        conn.commit()
+
+    def record(self, port, responses, messages=None, stale=False, recorded_at=None):
+        """Record a port's state after a scan; returns False if nothing changed.
+
+        ``messages`` is the full list on the SIM, or None to keep the last one;
+        ``responses`` None keeps the last responses too.
+        """
+        recorded_at = recorded_at or datetime.now().isoformat()
+        with self._lock:
+            conn = self.connection()
+            with conn:
+                # The CLI and the API server both record: under the write
+                # lock, reload the port's state if another process moved it.
+                conn.execute('BEGIN IMMEDIATE')
+                last_id = conn.execute('SELECT MAX(id) FROM scan_history WHERE port = ?',
+                                       (port,)).fetchone()[0]
+                cached = self._latest.get(port)
+                if cached is None or cached[2] != last_id:
+                    cached = self._load_latest(port, last_id)
+                latest, count, _ = cached
+                if responses is None and latest is None:
+                    return False
+                state = {"stale": stale,
+                         "responses": dict(latest["responses"] if responses is None
+                                           else responses),
+                         "messages": ({message_key(m): m for m in messages}
+                                      if messages is not None
+                                      else dict(latest["messages"]) if latest else {})}
+                data = state_delta(latest, state) if latest is not None else state
+                if data is None:
+                    return False
+                keyframe = latest is None or count + 1 >= self.keyframe_interval
+                if keyframe:
+                    data = state
+                row_id = conn.execute(
+                    'INSERT INTO scan_history (port, recorded_at, keyframe, data) '
+                    'VALUES (?, ?, ?, ?)',
+                    (port, recorded_at, int(keyframe), json.dumps(data))).lastrowid
+            self._latest[port] = (state, 0 if keyframe else count + 1, row_id)
+            return True
+
+    def record_stale(self, port, stale=True, recorded_at=None):
+        return self.record(port, None, None, stale, recorded_at)
+
+    def _load_latest(self, port, last_id):
+        state, count = self._rebuild(port, None)
+        self._latest[port] = (state, count, last_id)
+        return self._latest[port]
+
+    def _rebuild(self, port, when):
+        """``(state, deltas after its keyframe)`` of a port at ``when`` (None: now)."""
+        conn = self.connection()
+        time_filter = '' if when is None else ' AND recorded_at <= ?'
+        params = [port] if when is None else [port, when]
+        keyframe = conn.execute(
+            f'''SELECT id, recorded_at, data FROM scan_history
+                WHERE port = ? AND keyframe = 1{time_filter}
+                ORDER BY recorded_at DESC, id DESC LIMIT 1''', params).fetchone()
+        if keyframe is None:
+            return None, 0
+        state = json.loads(keyframe[2])
+        state["recorded_at"] = keyframe[1]
+        deltas = conn.execute(
+            f'''SELECT recorded_at, data FROM scan_history
+                WHERE port = ? AND keyframe = 0 AND id > ?{time_filter}
+                ORDER BY id''', [port, keyframe[0]] + params[1:]).fetchall()
+        for recorded_at, data in deltas:
+            apply_delta(state, json.loads(data))
+            state["recorded_at"] = recorded_at
+        return state, len(deltas)
+
+    def state_at(self, port, when=None):
+        """A port's scan state at ``when`` (ISO time, default now), or None."""
+        state, _ = self._rebuild(port, when)
+        if state is None:
+            return None
+        return {"port": port, "recorded_at": state["recorded_at"],
+                "stale": state["stale"], "responses": state["responses"],
+                "messages": sorted(state["messages"].values(),
+                                   key=lambda m: m["index"])}
+
+    def changes(self, port, since=None, until=None, limit=100):
+        """Keyframes and deltas recorded for a port, oldest first."""
+        query, params = export_filter(
+            'SELECT recorded_at, keyframe, data FROM scan_history WHERE port = ?',
+            [port], 'port', None, 'recorded_at', since, until)
+        rows = self.connection().execute(query + ' ORDER BY id LIMIT ?',
+                                         params + [limit]).fetchall()
+        return [{"recorded_at": recorded_at, "keyframe": bool(keyframe),
+                 "data": json.loads(data)} for recorded_at, keyframe, data in rows]
+
+    def export_states(self, ports=None, since=None, until=None):
+        """Yield every state recorded for the ports in ``[since, until)``.
+
+        Each port is replayed from its last keyframe before ``since`` in
+        keyset-paged batches, so only its current state is held in memory.
+        """
+        query, params = export_filter(
+            'SELECT DISTINCT port FROM scan_history WHERE 1 = 1', [],
+            'port', ports, 'recorded_at', since, until)
+        for (port,) in self.connection().execute(query + ' ORDER BY port',
+                                                 params).fetchall():
+            yield from self._replay(port, since, until)
+
+    def _replay(self, port, since, until):
+        first = 0
+        if since is not None:
+            first = self.connection().execute(
+                'SELECT MAX(id) FROM scan_history '
+                'WHERE port = ? AND keyframe = 1 AND recorded_at < ?',
+                (port, since)).fetchone()[0] or 0
+        query, params = export_filter(
+            'SELECT id, recorded_at, keyframe, data FROM scan_history '
+            'WHERE port = ? AND id >= ?', [port, first],
+            'port', None, 'recorded_at', None, until)
+        state = None
+        for _, recorded_at, keyframe, data in iter_pages(self, query, params, 'id'):
+            if keyframe:
+                state = json.loads(data)
+            elif state is None:
+                continue
+            else:
+                apply_delta(state, json.loads(data))
+            if since is None or recorded_at >= since:
+                yield {"port": port, "iccid": state["responses"].get("ICCID"),
+                       "recorded_at": recorded_at, "stale": state["stale"],
+                       "responses": dict(state["responses"]),
+                       "messages": sorted(state["messages"].values(),
+                                          key=lambda m: m["index"])}
+
+
+class ScanStore(SqliteStore):
+    """Latest scan result per port plus the identity of every SIM seen.
+
+    ``ports`` holds one row per port with the non-SMS responses as JSON,
+    ``sims`` holds IMSI/MSISDN/operator per ICCID. SMS are not duplicated
+    here: ``get_ports`` joins them in from the ``MessageStore``. Saving a
+    port only touches that port's rows.
+    """
+
+    def __init__(self, message_store, db_file=None, history=None):
+        super().__init__(db_file or message_store.db_file)
+        self.message_store = message_store
+        self.history = history or HistoryStore(self.db_file)
+
+    def initialize(self, conn):
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS ports (
+                port TEXT PRIMARY KEY,
+                iccid INTEGER,
+                timestamp TEXT,
+                responses TEXT NOT NULL DEFAULT '{}',
+                stale INTEGER NOT NULL DEFAULT 0,
+                timings TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_ports_iccid ON ports (iccid);
+            CREATE TABLE IF NOT EXISTS sims (
+                iccid INTEGER PRIMARY KEY,
+                imsi TEXT,
+                msisdn TEXT,
+                operator TEXT,
+                port TEXT,
+                updated_at TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_sims_imsi ON sims (imsi);
+            CREATE INDEX IF NOT EXISTS idx_sims_msisdn ON sims (msisdn);
+            CREATE INDEX IF NOT EXISTS idx_sims_port ON sims (port);
+            CREATE TABLE IF NOT EXISTS msisdn_cache (
+                iccid INTEGER PRIMARY KEY,
+                msisdn TEXT NOT NULL,
+                resolved_at REAL NOT NULL
+            );
+        ''')
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(ports)')]
+        if 'stale' not in columns:
+            conn.execute('ALTER TABLE ports ADD COLUMN stale INTEGER NOT NULL DEFAULT 0')
+        if 'timings' not in columns:
+            conn.execute('ALTER TABLE ports ADD COLUMN timings TEXT')
+        create_version_table(conn)
+        add_version_column(conn, 'ports')
+        add_version_column(conn, 'sims')
+        conn.commit()
+
+    def save_port_data(self, port_data, conn=None):
+        """Upsert one ``process_single_sim_card`` result.
+
+        Responses are merged into the stored ones, so an SMS-only refresh
+        keeps the identity fields of the last full scan.
+        """
+        conn = conn or self.connection()
+        port = port_data["port"]
+        responses = dict(port_data["responses"])
+        row = conn.execute('SELECT iccid, responses FROM ports WHERE port = ?',
+                           (port,)).fetchone()
+        iccid = responses.get("ICCID")
+        if row is not None:
+            previous = json.loads(row[1])
+            if iccid is None or iccid == row[0]:
+                responses = dict(previous, **responses)
+                iccid = row[0] if iccid is None else iccid
+        if iccid is not None:
+            # Messages are served from sms_messages.
+            responses.pop("Get SMS", None)
+            responses["ICCID"] = iccid
+        timings = port_data.get("timings")
+        with conn, self.versioned(conn) as version:
+            # Scan time and timings change on every scan, they alone do not
+            # count as a change for pollers.
+            conn.execute('''
+                INSERT INTO ports (port, iccid, timestamp, responses, stale, timings,
+                                   version)
+                VALUES (?, ?, ?, ?, 0, ?, ?)
+                ON CONFLICT (port) DO UPDATE SET iccid = excluded.iccid,
+                    timestamp = excluded.timestamp, responses = excluded.responses,
+                    stale = 0, timings = excluded.timings,
+                    version = CASE WHEN stale = 1 OR iccid IS NOT excluded.iccid
+                                        OR responses IS NOT excluded.responses
+                                   THEN excluded.version ELSE version END
+            ''', (port, iccid, port_data["timestamp"], json.dumps(responses),
+                  json.dumps(timings) if timings is not None else None, version))
+            if iccid is not None:
+                conn.execute('''
+                    INSERT INTO sims (iccid, imsi, msisdn, operator, port, updated_at,
+                                      version)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (iccid) DO UPDATE SET
+                        imsi = COALESCE(excluded.imsi, imsi),
+                        msisdn = COALESCE(excluded.msisdn, msisdn),
+                        operator = COALESCE(excluded.operator, operator),
+                        port = excluded.port, updated_at = excluded.updated_at,
+                        version = excluded.version
+                    WHERE port IS NOT excluded.port
+                        OR imsi IS NOT COALESCE(excluded.imsi, imsi)
+                        OR msisdn IS NOT COALESCE(excluded.msisdn, msisdn)
+                        OR operator IS NOT COALESCE(excluded.operator, operator)
+                ''', (iccid, responses.get("Get IMSI"), responses.get("MSISDN"),
+                      responses.get("Get Operator"), port, port_data["timestamp"],
+                      version))
+        self.history.record(port, {k: v for k, v in responses.items() if k != "Get SMS"},
+                            port_data["responses"].get("Get SMS"),
+                            recorded_at=port_data["timestamp"])
+
+    def cached_msisdn(self, iccid, ttl):
+        """MSISDN resolved for ``iccid`` less than ``ttl`` seconds ago, or None."""
+        row = self.connection().execute(
+            'SELECT msisdn FROM msisdn_cache WHERE iccid = ? AND resolved_at > ?',
+            (normalize_iccid(iccid), time.time() - ttl)).fetchone()
+        return row[0] if row else None
+
+    def save_msisdn(self, iccid, msisdn):
+        """Cache a resolved MSISDN and fill it into the SIM and its port row."""
+        iccid = normalize_iccid(iccid)
+        conn = self.connection()
+        with conn:
+            conn.execute('''INSERT INTO msisdn_cache (iccid, msisdn, resolved_at)
+                            VALUES (?, ?, ?)
+                            ON CONFLICT (iccid) DO UPDATE SET msisdn = excluded.msisdn,
+                                resolved_at = excluded.resolved_at''',
+                         (iccid, msisdn, time.time()))
+            with self.versioned(conn) as version:
+                conn.execute('UPDATE sims SET msisdn = ?, version = ? '
+                             'WHERE iccid = ? AND msisdn IS NOT ?',
+                             (msisdn, version, iccid, msisdn))
+                conn.execute('''UPDATE ports SET responses = json_set(responses, '$.MSISDN', ?),
+                                    version = ?
+                                WHERE iccid = ?
+                                    AND json_extract(responses, '$.MSISDN') IS NOT ?''',
+                             (msisdn, version, iccid, msisdn))
+
+    def replace_ports(self, data):
+        """Store a full scan: upsert every result, mark missing ports stale."""
+        conn = self.connection()
+        for port_data in data:
+            self.save_port_data(port_data, conn)
+        ports = [port_data["port"] for port_data in data]
+        with conn, self.versioned(conn) as version:
+            stale = conn.execute(f'''UPDATE ports SET stale = 1, version = ?
+                                    WHERE stale = 0
+                                    AND port NOT IN ({','.join('?' * len(ports))})
+                                    RETURNING port''',
+                                 [version] + ports).fetchall()
+        for (port,) in stale:
+            self.history.record_stale(port)
+
+    def mark_stale(self, port, stale=True):
+        """Keep a port's last result but flag it as no longer live."""
+        conn = self.connection()
+        with conn, self.versioned(conn) as version:
+            changed = conn.execute('UPDATE ports SET stale = ?, version = ? '
+                                   'WHERE port = ? AND stale != ?',
+                                   (int(stale), version, port, int(stale))).rowcount
+        if changed:
+            self.history.record_stale(port, stale)
+
+    def ports_for_iccids(self, iccids):
+        """Return ``{iccid: port}`` for the SIMs currently seen in a live port."""
+        iccids = [i for i in (normalize_iccid(i) for i in iccids) if i is not None]
+        if not iccids:
+            return {}
+        rows = self.connection().execute(
+            f'''SELECT iccid, port FROM ports WHERE stale = 0
+                AND iccid IN ({','.join('?' * len(iccids))})''', iccids).fetchall()
+        return dict(rows)
+
+    def query_sims(self, port=None, iccid=None, msisdn=None, since=None,
+                   changed_since=None, cursor=None, limit=100):
+        """Filtered page of ``sims`` rows ordered by ICCID, see ``query_messages``."""
+        query = '''SELECT iccid, imsi, msisdn, operator, port, updated_at, version
+                   FROM sims WHERE 1 = 1'''
+        params = []
+        for column, value in (('port', port), ('iccid', normalize_iccid(iccid)),
+                              ('msisdn', msisdn)):
+            if value is not None:
+                query += f' AND {column} = ?'
+                params.append(value)
+        if since is not None:
+            query += ' AND updated_at >= ?'
+            params.append(since)
+        if changed_since is not None:
+            query += ' AND version > ?'
+            params.append(changed_since)
+        query, params = page_query(query, params, 'iccid', cursor, limit)
+        rows = self.connection().execute(query, params).fetchall()
+        columns = ("iccid", "imsi", "msisdn", "operator", "port", "updated_at", "version")
+        items = [dict(zip(columns, row)) for row in rows[:limit]]
+        return items, (items[-1]["iccid"] if len(rows) > limit else None)
+
+    def export_sims(self, ports=None, since=None, until=None):
+        """Yield the SIM inventory by ``updated_at`` range and port."""
+        query, params = export_filter(
+            '''SELECT iccid, imsi, msisdn, operator, port, updated_at
+               FROM sims WHERE 1 = 1''', [],
+            'port', ports, 'updated_at', since, until)
+        columns = ("iccid", "imsi", "msisdn", "operator", "port", "updated_at")
+        for row in iter_pages(self, query, params, 'iccid'):
+            yield dict(zip(columns, row))
+
+    def live_sims(self):
+        """SIMs with a known MSISDN that are in a live port right now."""
+        rows = self.connection().execute('''
+            SELECT s.iccid, s.msisdn, s.operator, s.port FROM sims s
+            JOIN ports p ON p.port = s.port AND p.iccid = s.iccid
+            WHERE p.stale = 0 AND s.msisdn IS NOT NULL AND s.msisdn != ''
+            ORDER BY s.iccid''').fetchall()
+        return [dict(zip(("iccid", "msisdn", "operator", "port"), row)) for row in rows]
+
+    def live_sims_since(self, version):
+        """What changed in ``live_sims`` after ``version``: ``(sims, iccids, ports)``.
+
+        ``iccids`` and ``ports`` are the SIM and port rows that changed, and
+        ``sims`` the live SIMs among them; a changed SIM missing from
+        ``sims`` is no longer live. Both lookups go through the version
+        indexes, so the cost follows the number of changes.
+        """
+        conn = self.connection()
+        iccids = {row[0] for row in conn.execute(
+            'SELECT iccid FROM sims WHERE version > ?', (version,))}
+        ports = set()
+        for port, iccid in conn.execute('SELECT port, iccid FROM ports WHERE version > ?',
+                                        (version,)):
+            ports.add(port)
+            if iccid is not None:
+                iccids.add(iccid)
+        rows = conn.execute('''
+            SELECT s.iccid, s.msisdn, s.operator, s.port FROM sims s
+            JOIN ports p ON p.port = s.port AND p.iccid = s.iccid
+            WHERE s.version > ? AND p.stale = 0
+                AND s.msisdn IS NOT NULL AND s.msisdn != ''
+            UNION
+            SELECT s.iccid, s.msisdn, s.operator, s.port FROM ports p
+            JOIN sims s ON s.port = p.port AND s.iccid = p.iccid
+            WHERE p.version > ? AND p.stale = 0
+                AND s.msisdn IS NOT NULL AND s.msisdn != ''
+            ''', (version, version)).fetchall()
+        sims = [dict(zip(("iccid", "msisdn", "operator", "port"), row)) for row in rows]
+        return sims, iccids, ports
+
+    def has_ports(self):
+        return self.connection().execute(
+            'SELECT 1 FROM ports LIMIT 1').fetchone() is not None
+
+    def get_ports(self, ports=None):
+        """Rebuild ``process_single_sim_card``-shaped dicts from the tables."""
+        query = 'SELECT port, iccid, timestamp, responses, stale, timings FROM ports'
+        params = []
+        if ports is not None:
+            query += f" WHERE port IN ({','.join('?' * len(ports))})"
+            params = list(ports)
+        rows = self.connection().execute(query + ' ORDER BY port', params).fetchall()
+        messages = self.message_store.get_messages_by_iccid(
+            {row[1] for row in rows if row[1] is not None})
+        data = []
+        for port, iccid, timestamp, responses, stale, timings in rows:
+            responses = json.loads(responses)
+            if iccid is not None:
+                responses["Get SMS"] = messages.get(iccid, [])
+            data.append({"port": port, "timestamp": timestamp,
+                         "stale": bool(stale), "responses": responses,
+                         "timings": json.loads(timings) if timings else None})
+        return data
+
+    def get_port(self, port):
+        data = self.get_ports([port])
+        return data[0] if data else None
+
+    def clear(self):
+        conn = self.connection()
+        with conn, self.versioned(conn):
+            conn.execute('DELETE FROM ports')
+
+
+class LeaseStore(SqliteStore):
+    """Active number leases, so they survive a restart of the API server."""
+
+    def initialize(self, conn):
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS leases (
+                lease_id TEXT PRIMARY KEY,
+                iccid INTEGER NOT NULL UNIQUE,
+                msisdn TEXT,
+                operator TEXT,
+                port TEXT,
+                client TEXT,
+                started_at TEXT,
+                expires_at REAL NOT NULL
+            )
+        ''')
+        conn.commit()
+
+    def load(self):
+        columns = ("lease_id", "iccid", "msisdn", "operator", "port", "client",
+                   "started_at", "expires_at")
+        rows = self.connection().execute(
+            f'SELECT {", ".join(columns)} FROM leases').fetchall()
+        return [dict(zip(columns, row)) for row in rows]
+
+    def save(self, lease):
+        conn = self.connection()
+        with conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO leases (lease_id, iccid, msisdn, operator, port,
+                                               client, started_at, expires_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (lease["lease_id"], lease["iccid"], lease["msisdn"], lease["operator"],
+                  lease["port"], lease["client"], lease["started_at"],
+                  lease["expires_at"]))
+
+    def delete(self, lease_ids):
+        conn = self.connection()
+        with conn:
+            conn.executemany('DELETE FROM leases WHERE lease_id = ?',
+                             [(lease_id,) for lease_id in lease_ids])
+
+
+def normalize_iccid(value):
+    """Canonical ICCID key: the integer stored in ``sim_cards.iccid``."""
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        return int(str(value).strip())
+    except ValueError:
+        return None
+
+
+class PinDirectory(SqliteStore):
+    """ICCID -> PIN lookups over ``sim_cards`` with a write-through cache.
+
+    Nothing is loaded up front: each ICCID is fetched once through the
+    unique index and then served from memory; misses are kept for
+    ``PIN_MISS_TTL`` seconds. Writes made through ``add``/``add_many`` keep
+    the cache coherent once committed. It behaves like a
+    read-only dict, so it can be passed where the scan expects
+    ``iccid_pin_data``.
+    """
+
+    def __init__(self, db_file=None):
+        super().__init__(db_file)
+        self._cache = {}
+        self._misses = {}
+        self._cache_lock = threading.Lock()
+
+    def __reduce__(self):
+        # Scan worker processes get a fresh directory over the same database.
+        return PinDirectory, (self.db_file,)
+
+    def initialize(self, conn):
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS sim_cards (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                iccid INTEGER UNIQUE,
+                pin TEXT
+            )
+        ''')
+        conn.commit()
+
+    def get(self, iccid, default=None):
+        iccid = normalize_iccid(iccid)
+        if iccid is None:
+            return default
+        with self._cache_lock:
+            pin = self._cache.get(iccid)
+            if pin is not None:
+                return pin
+            if self._misses.get(iccid, 0.0) > time.monotonic():
+                return default
+        row = self.connection().execute(
+            'SELECT pin FROM sim_cards WHERE iccid = ?', (iccid,)).fetchone()
+        pin = row[0] if row else None
+        with self._cache_lock:
+            if pin is None:
+                self._misses[iccid] = time.monotonic() + PIN_MISS_TTL
+            else:
+                self._cache[iccid] = pin
+        return default if pin is None else pin
+
+    def __contains__(self, iccid):
+        return self.get(iccid) is not None
+
+    def __getitem__(self, iccid):
+        pin = self.get(iccid)
+        if pin is None:
+            raise KeyError(iccid)
+        return pin
+
+    def add(self, iccid, pin):
+        """Insert one SIM; raises ``sqlite3.IntegrityError`` on a duplicate."""
+        iccid = normalize_iccid(iccid)
+        if iccid is None:
+            raise ValueError("ICCID must be numeric")
+        conn = self.connection()
+        with conn:
+            conn.execute('INSERT INTO sim_cards (iccid, pin) VALUES (?, ?)',
+                         (iccid, str(pin)))
+        with self._cache_lock:
+            self._cache[iccid] = str(pin)
+            self._misses.pop(iccid, None)
+
+    def add_many(self, rows, conn=None):
+        """``INSERT OR IGNORE`` many (iccid, pin) rows, returns how many were new.
+
+        The caller owns the transaction when it passes ``conn``, and calls
+        ``forget_misses`` once it is committed: until then other threads
+        still read the old rows and would cache the new ICCIDs as misses.
+        """
+        owned = conn is None
+        conn = conn or self.connection()
+        rows = [(normalize_iccid(iccid), str(pin)) for iccid, pin in rows]
+        before = conn.total_changes
+        conn.executemany(
+            'INSERT OR IGNORE INTO sim_cards (iccid, pin) VALUES (?, ?)', rows)
+        inserted = conn.total_changes - before
+        if owned:
+            conn.commit()
+            self.forget_misses()
+        # Ignored rows keep their stored PIN, so cached PINs stay valid.
+        return inserted
+
+    def forget_misses(self):
+        with self._cache_lock:
+            self._misses.clear()
+
+    def invalidate(self, iccids=None):
+        with self._cache_lock:
+            if iccids is None:
+                self._cache.clear()
+                self._misses.clear()
+            else:
+                for iccid in iccids:
+                    self._cache.pop(iccid, None)
+                    self._misses.pop(iccid, None)
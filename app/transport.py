@@ -0,0 +1,26 @@
+import serial
+
+
+class SerialTransport:
+    """Opens real COM ports. ``SessionPool`` talks to ports only through a
+    transport, so a simulated rack (see ``modem_sim``) can stand in for it.
+
+    A transport provides ``open(port, baud_rate, timeout)`` returning a
+    ``serial.Serial``-like handle (``write``, ``read``, ``in_waiting``,
+    ``reset_input_buffer``, ``timeout``, ``is_open``, ``close``) and
+    ``list_ports()`` returning the available port names. It may provide
+    ``port_locations()`` mapping port names to USB locations such as
+    ``'1-1.4.2:1.0'``, which ``ShardedScheduler`` uses to group ports by hub.
+    """
+
+    def open(self, port, baud_rate, timeout):
+        return serial.Serial(port, baud_rate, timeout=timeout)
+
+    def list_ports(self):
+        import serial.tools.list_ports
+        return [port.device for port in serial.tools.list_ports.comports()]
+
+    def port_locations(self):
+        import serial.tools.list_ports
+        return {port.device: port.location
+                for port in serial.tools.list_ports.comports() if port.location}
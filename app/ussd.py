@@ -0,0 +1,143 @@
+import threading
+import time
+
+
+CUSD_PREFIX = b'+CUSD:'
+# Own-number request; the network answers "MSISDN:\r<number>" a few seconds
+# after the modem's OK.
+MSISDN_REQUEST = b'AT+CUSD=1,"*99#"\r'
+
+# A SIM keeps its number, so one answer per ICCID is reused for a week.
+DEFAULT_MSISDN_TTL = 7 * 24 * 3600.0
+DEFAULT_USSD_TIMEOUT = 20.0
+DEFAULT_POLL_INTERVAL = 0.1
+
+
+class UssdResolver:
+    """Collects ``+CUSD`` replies as unsolicited results instead of waiting.
+
+    ``expect(port, iccid, baud_rate)`` is called before the request is sent; the
+    scan then moves on at the modem's ``OK``. The reply is picked up by the
+    session pool's unsolicited handler, whether it lands in a later
+    command's reply or while the port is idle (a background thread polls
+    ports with a pending request and keeps them open). ``parse(line)``
+    returns ``(msisdn, text)``; a resolved MSISDN is passed to
+    ``on_resolved(iccid, msisdn)`` from that thread, so the handler running
+    under the port lock never waits on the database.
+    """
+
+    def __init__(self, session_pool, parse, on_resolved=None,
+                 timeout=DEFAULT_USSD_TIMEOUT, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.session_pool = session_pool
+        self.parse = parse
+        self.on_resolved = on_resolved
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self._pending = {}
+        self._results = {}
+        self._resolved = []
+        self._saving = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._wakeup = threading.Event()
+        self._thread = None
+        session_pool.add_unsolicited_handler(CUSD_PREFIX, self._on_cusd)
+
+    def expect(self, port, iccid, baud_rate):
+        """Register a request about to be sent; False if one is still pending."""
+        with self._lock:
+            pending = self._pending.get(port)
+            if pending is not None and pending["iccid"] == iccid:
+                return False
+            pinned = port in self.session_pool.pinned_ports()
+            self._pending[port] = {"iccid": iccid, "baud_rate": baud_rate,
+                                   "deadline": time.monotonic() + self.timeout,
+                                   "pinned": pinned}
+            self._results.pop(port, None)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="ussd-resolver",
+                                                daemon=True)
+                self._thread.start()
+        if not pinned:
+            self.session_pool.pin(port, baud_rate)
+        self._wakeup.set()
+        return True
+
+    def cancel(self, port):
+        """Drop the port's pending request and any reply kept for it."""
+        with self._idle:
+            pending = self._pending.pop(port, None)
+            self._results.pop(port, None)
+            self._idle.notify_all()
+        if pending is not None and not pending["pinned"]:
+            self.session_pool.pin(port, pending["baud_rate"], pinned=False)
+
+    def pending(self, port):
+        with self._lock:
+            return port in self._pending
+
+    def wait(self, timeout=None):
+        """Block until every request is answered (and saved) or has expired.
+
+        Returns False if some are still pending after ``timeout`` seconds,
+        by default the request timeout.
+        """
+        deadline = time.monotonic() + (self.timeout + 1.0 if timeout is None else timeout)
+        with self._idle:
+            while self._pending or self._resolved or self._saving:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def result(self, port, iccid):
+        """``(msisdn, text)`` received for the SIM in ``port``, or None."""
+        with self._lock:
+            result = self._results.get(port)
+        if result is None or result[0] != iccid:
+            return None
+        return result[1:]
+
+    def _on_cusd(self, port, line):
+        msisdn, text = self.parse(line.decode('utf-8', errors='ignore'))
+        with self._idle:
+            pending = self._pending.pop(port, None)
+            if pending is None:
+                return
+            self._results[port] = (pending["iccid"], msisdn, text)
+            if msisdn:
+                self._resolved.append((pending["iccid"], msisdn))
+            self._idle.notify_all()
+        if not pending["pinned"]:
+            self.session_pool.pin(port, pending["baud_rate"], pinned=False)
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                idle = not self._pending and not self._resolved
+            # Nothing to poll: sleep until the next request.
+            self._wakeup.wait(None if idle else self.poll_interval)
+            self._wakeup.clear()
+            with self._lock:
+                resolved, self._resolved = self._resolved, []
+                self._saving = len(resolved)
+                now = time.monotonic()
+                ports = list(self._pending)
+                expired = [port for port, p in self._pending.items() if now >= p["deadline"]]
+            for iccid, msisdn in resolved:
+                if self.on_resolved is not None:
+                    try:
+                        self.on_resolved(iccid, msisdn)
+                    except Exception as e:
+                        print(f"Error saving MSISDN {msisdn} for ICCID {iccid}: {e}")
+            with self._idle:
+                self._saving = 0
+                self._idle.notify_all()
+            for port in expired:
+                print(f"No USSD reply on port {port} within {self.timeout:.0f}s")
+                self.cancel(port)
+            for port in ports:
+                if port not in expired:
+                    self.session_pool.poll(port)
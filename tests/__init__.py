@@ -0,0 +1,169 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
+
+import serial
+
+# The app modules import each other by bare name, as when run from app/.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+
+
+class FakeSerial:
+    """``serial.Serial`` stand-in that answers from a script.
+
+    ``replies`` maps a command prefix to ``[(delay, bytes), ...]`` sent
+    after the command is written; other commands get ``OK`` at once. Ports
+    in ``broken`` fail every write. Every handle opened is kept in
+    ``opened``; ``install(test)`` patches it in and resets all three.
+    ``push`` sends unsolicited data, as a modem does for ``+CMTI``.
+    """
+
+    opened = []
+    broken = set()
+    replies = {}
+
+    def __init__(self, port, baud_rate, timeout=None):
+        self.port = port
+        self.timeout = timeout
+        self.is_open = True
+        self.written = []
+        self._ready = b''
+        self._scheduled = []
+        self._cond = threading.Condition()
+        FakeSerial.opened.append(self)
+
+    @classmethod
+    def install(cls, test):
+        cls.opened, cls.broken, cls.replies = [], set(), {}
+        patcher = mock.patch('serial.Serial', cls)
+        patcher.start()
+        test.addCleanup(patcher.stop)
+
+    def write(self, data):
+        if self.port in FakeSerial.broken:
+            raise serial.SerialException("write failed")
+        self.written.append(data)
+        command = data.decode('ascii').strip()
+        script = next((reply for prefix, reply in FakeSerial.replies.items()
+                       if command.startswith(prefix)), [(0, b'\r\nOK\r\n')])
+        now = time.monotonic()
+        with self._cond:
+            self._scheduled += [(now + delay, reply) for delay, reply in script]
+            self._scheduled.sort(key=lambda item: item[0])
+            self._cond.notify_all()
+        return len(data)
+
+    def push(self, data, delay=0):
+        with self._cond:
+            self._scheduled.append((time.monotonic() + delay, data))
+            self._scheduled.sort(key=lambda item: item[0])
+            self._cond.notify_all()
+
+    def _release(self):
+        now = time.monotonic()
+        while self._scheduled and self._scheduled[0][0] <= now:
+            self._ready += self._scheduled.pop(0)[1]
+
+    @property
+    def in_waiting(self):
+        with self._cond:
+            self._release()
+            return len(self._ready)
+
+    def read(self, size=1):
+        deadline = time.monotonic() + (self.timeout or 0)
+        with self._cond:
+            while True:
+                self._release()
+                if self._ready:
+                    data, self._ready = self._ready[:size], self._ready[size:]
+                    return data
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return b''
+                if self._scheduled:
+                    remaining = min(remaining, self._scheduled[0][0] - time.monotonic())
+                self._cond.wait(max(remaining, 0))
+
+    def reset_input_buffer(self):
+        with self._cond:
+            self._release()
+            self._ready = b''
+
+    def close(self):
+        self.is_open = False
+
+
+def patch_main(test, **values):
+    """Replace ``main`` globals until ``test`` is done."""
+    import main
+    patcher = mock.patch.multiple(main, **values)
+    patcher.start()
+    test.addCleanup(patcher.stop)
+
+
+def temp_db(test):
+    """Path of an SQLite file removed once ``test`` is done."""
+    tmp = tempfile.TemporaryDirectory()
+    test.addCleanup(tmp.cleanup)
+    return os.path.join(tmp.name, 'sims.db')
+
+
+def patch_stores(test):
+    """Point ``main``'s stores at a temporary database until ``test`` is done."""
+    from store import MessageStore, ScanStore
+    message_store = MessageStore(temp_db(test))
+    patch_main(test, message_store=message_store,
+               scan_store=ScanStore(message_store))
+    return message_store.db_file
+
+
+def patch_rack(test, modems):
+    """Scan ``modems`` (``{port: SimulatedModem}``) with fresh per-port state.
+
+    Their PINs go into the temporary database from ``patch_stores``.
+    """
+    import main
+    from at_reader import LatencyTracker
+    from health import PortHealth
+    from metrics import scanner_metrics
+    from modem_sim import SimulatedTransport
+    from scheduler import PortScheduler
+    from store import PinDirectory
+    pins = PinDirectory(patch_stores(test))
+    pins.add_many([(modem.iccid, modem.pin) for modem in modems.values() if modem.pin])
+    scheduler = PortScheduler()
+    test.addCleanup(scheduler.shutdown)
+    patch_main(test, pin_directory=pins, scheduler=scheduler,
+               latency_tracker=LatencyTracker(), modem_models={}, port_iccids={},
+               identity_cache={}, pdu_mode_ports=set(), metrics=scanner_metrics(),
+               port_health=PortHealth())
+    patcher = mock.patch.object(main.session_pool, 'transport', SimulatedTransport(modems))
+    patcher.start()
+    test.addCleanup(patcher.stop)
+    test.addCleanup(main.session_pool.close_all)
+
+    def drop_ussd_requests():
+        # Nothing may be saved once the stores are restored.
+        for port in modems:
+            main.ussd_resolver.cancel(port)
+        main.ussd_resolver.wait(timeout=1.0)
+    test.addCleanup(drop_ussd_requests)
+
+
+def record_commands(test):
+    """List every command sent through ``main.session_pool`` during ``test``."""
+    import main
+    commands = []
+    execute = main.session_pool.execute
+
+    def record(port, baud_rate, command, *args, **kwargs):
+        commands.append(command)
+        return execute(port, baud_rate, command, *args, **kwargs)
+    patcher = mock.patch.object(main.session_pool, 'execute', record)
+    patcher.start()
+    test.addCleanup(patcher.stop)
+    return commands
@@ -0,0 +1,160 @@
+import time
+import unittest
+
+import main
+from at_reader import LatencyTracker, read_response
+from modem_sim import SimulatedModem
+from tests import FakeSerial, patch_main, patch_rack, record_commands
+
+
+CUSD_REPLY = b'\r\n+CUSD: 2,"MSISDN:\r212600000001",15\r\n'
+
+
+class ReadResponseTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeSerial.install(self)
+        self.ser = FakeSerial('COM1', 115200)
+
+    def read(self, command, timeout=1.0, expect=None):
+        self.ser.write(command)
+        started = time.monotonic()
+        return read_response(self.ser, timeout, expect), time.monotonic() - started
+
+    def test_stops_at_final_result_code(self):
+        FakeSerial.replies = {'AT+CIMI': [(0.01, b'\r\n604000000000001\r\n\r\nOK\r\n'),
+                                          (0.5, b'\r\nRING\r\n')]}
+        reply, elapsed = self.read(b'AT+CIMI\r')
+        self.assertEqual(reply, b'\r\n604000000000001\r\n\r\nOK\r\n')
+        self.assertLess(elapsed, 0.3)
+
+    def test_waits_for_expected_line(self):
+        FakeSerial.replies = {'AT+CUSD': [(0.01, b'\r\nOK\r\n'), (0.1, CUSD_REPLY)]}
+        reply, _ = self.read(b'AT+CUSD=1,"*99#"\r', expect='+CUSD:')
+        self.assertTrue(reply.endswith(CUSD_REPLY))
+
+    def test_error_ends_the_wait_for_expected_line(self):
+        FakeSerial.replies = {'AT+CUSD': [(0.01, b'\r\n+CME ERROR: 30\r\n')]}
+        reply, elapsed = self.read(b'AT+CUSD=1,"*99#"\r', expect='+CUSD:')
+        self.assertEqual(reply, b'\r\n+CME ERROR: 30\r\n')
+        self.assertLess(elapsed, 0.3)
+
+
+class SendCommandTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeSerial.install(self)
+        patch_main(self, latency_tracker=LatencyTracker(), modem_models={})
+        self.addCleanup(main.session_pool.close, 'COM1')
+
+    def test_slow_reply_is_read_past_learned_timeout(self):
+        # Limit learned from fast replies: the 50ms floor.
+        for _ in range(5):
+            main.latency_tracker.record('unknown', b'AT+COPS?\r', 0.001)
+        FakeSerial.replies = {'AT+COPS?': [(0.15, b'\r\n+COPS: 0,0,"IAM"\r\n\r\nOK\r\n')]}
+        self.assertIn(b'OK', main.send_at_command('COM1', 115200, b'AT+COPS?\r'))
+        # The slow sample raises the limit for the next scans.
+        self.assertGreater(main.latency_tracker.timeout_for('unknown', b'AT+COPS?\r'), 0.4)
+
+    def test_incomplete_reply_is_a_failure(self):
+        FakeSerial.replies = {'AT+COPS?': [(0.1, b'\r\n+COPS: 0,0,"IAM"\r\n\r\nOK\r\n')]}
+        self.assertIsNone(main.send_at_command('COM1', 115200, b'AT+COPS?\r',
+                                               timeout=0.02, retry_timeout=0.02))
+
+    def test_waits_for_expected_line(self):
+        FakeSerial.replies = {'AT+CUSD': [(0.01, b'\r\nOK\r\n'), (0.1, CUSD_REPLY)]}
+        reply = main.send_at_command('COM1', 115200, b'AT+CUSD=1,"*99#"\r', expect='+CUSD:')
+        self.assertTrue(reply.endswith(CUSD_REPLY))
+
+    def test_model_is_learned_once(self):
+        FakeSerial.replies = {'AT+CGMM': [(0, b'\r\nEC25\r\n\r\nOK\r\n')]}
+        self.assertEqual(main.detect_modem_model('COM1', 115200), 'EC25')
+        self.assertEqual(main.detect_modem_model('COM1', 115200), 'EC25')
+        self.assertEqual(len(FakeSerial.opened[0].written), 1)
+
+    def test_model_is_not_cached_without_reply(self):
+        FakeSerial.broken.add('COM1')
+        self.assertEqual(main.detect_modem_model('COM1', 115200), 'unknown')
+        self.assertNotIn('COM1', main.modem_models)
+        FakeSerial.broken.clear()
+        FakeSerial.replies = {'AT+CGMM': [(0, b'\r\nEC25\r\n\r\nOK\r\n')]}
+        self.assertEqual(main.detect_modem_model('COM1', 115200), 'EC25')
+
+
+class StreamingModem(SimulatedModem):
+    """Lists its messages one line group at a time, like a full SIM."""
+
+    def list_messages(self, status):
+        replies = super().list_messages(status)
+        text = b''.join(reply for _, reply in replies)
+        chunks = text.split(b'\r\n\r\n+CMGL')
+        chunks = [chunks[0]] + [b'\r\n\r\n+CMGL' + chunk for chunk in chunks[1:]]
+        return [(self.latency + 0.03 * i, chunk) for i, chunk in enumerate(chunks)]
+
+
+class ListSmsTest(unittest.TestCase):
+
+    def setUp(self):
+        messages = [{"sender": '+212600000000', "timestamp": '2024/09/12 16:46:19+04',
+                     "message": f'Your code is {1000 + i}'} for i in range(6)]
+        patch_rack(self, {'SIM1': StreamingModem(iccid=1000000001, messages=messages,
+                                                 latency=0.01)})
+        # Limit learned on an empty SIM: the floor, far below the listing time.
+        for _ in range(5):
+            main.latency_tracker.record('unknown', b'AT+CMGL=4\r', 0.001)
+
+    def test_listing_past_learned_timeout_is_read_in_full(self):
+        self.assertEqual(len(main.list_sms('SIM1', 115200, "ALL")), 6)
+
+    def test_listing_timeout_grows_with_used_count(self):
+        self.assertEqual(len(main.list_sms('SIM1', 115200, "ALL", used_sms=6)), 6)
+        # The sized limit covered the listing, nothing ran into the timeout.
+        self.assertLess(main.latency_tracker.snapshot()['unknown']['AT+CMGL']['max'], 0.35)
+
+    def test_pdu_mode_is_set_again_after_a_modem_reset(self):
+        commands = record_commands(self)
+        main.list_sms('SIM1', 115200, "ALL")
+        main.session_pool.transport.modems['SIM1'].text_mode = True
+        self.assertEqual(len(main.list_sms('SIM1', 115200, "ALL")), 6)
+        self.assertEqual(commands.count(b'AT+CMGF=0\r'), 2)
+
+
+class FetchSmsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.modem = SimulatedModem(iccid=1000000001, latency=0.002, messages=[
+            {"sender": 'Google', "timestamp": '2024/09/12 16:46:19+04',
+             "message": 'G-123456'},
+            {"sender": 'IAM', "timestamp": '2024/09/12 16:47:00+04', "message": 'Solde'}])
+        patch_rack(self, {'SIM1': self.modem})
+        self.commands = record_commands(self)
+
+    def listings(self):
+        return [c for c in self.commands if c.startswith(b'AT+CMGL')]
+
+    def test_only_unread_messages_after_the_first_listing(self):
+        self.assertEqual(len(main.fetch_sms('SIM1', 115200, 1000000001, 2)), 2)
+        self.modem.deliver_sms('IAM', 'Recharge')
+        messages = main.fetch_sms('SIM1', 115200, 1000000001, 3)
+        self.assertEqual([m["message"] for m in messages], ['G-123456', 'Solde', 'Recharge'])
+        self.assertEqual(self.listings(), [b'AT+CMGL=4\r', b'AT+CMGL=0\r'])
+
+    def test_count_mismatch_lists_everything_again(self):
+        main.fetch_sms('SIM1', 115200, 1000000001, 2)
+        # Deleted elsewhere.
+        del self.modem.messages[1]
+        messages = main.fetch_sms('SIM1', 115200, 1000000001, 1)
+        self.assertEqual([m["message"] for m in messages], ['Solde'])
+        self.assertEqual(self.listings()[-1], b'AT+CMGL=4\r')
+
+    def test_multipart_message_is_stored_once(self):
+        self.modem.messages.clear()
+        self.modem.deliver_sms('Bank', 'Your statement is ready. ' * 10)
+        messages = main.fetch_sms('SIM1', 115200, 1000000001, 2)
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0]["message"], 'Your statement is ready. ' * 10)
+        self.assertEqual(main.message_store.count_on_sim(1000000001), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest
+
+import main
+from modem_sim import SimulatedModem
+from tests import patch_rack, record_commands
+
+
+class NoConcatModem(SimulatedModem):
+    """Rejects ``;``-concatenated command lines, as some modems do."""
+
+    def handle_line(self, line):
+        if ';' in line:
+            return [(self.latency, b'\r\nERROR\r\n')]
+        return super().handle_line(line)
+
+
+class FirstOfBatchModem(SimulatedModem):
+    """Runs only the first command of a concatenated line, then fails."""
+
+    def handle_line(self, line):
+        if ';' in line:
+            self.handle_command(line.split(';')[0])
+            return [(self.latency, b'\r\nERROR\r\n')]
+        return super().handle_line(line)
+
+
+class FailingRelistModem(SimulatedModem):
+    """Rejects the batch with slot 11, and any listing after a delete."""
+
+    deleting = False
+
+    def handle_line(self, line):
+        if '+CMGD=11' in line or (self.deleting and 'CMGL' in line):
+            return [(self.latency, b'\r\nERROR\r\n')]
+        self.deleting = self.deleting or 'CMGD' in line
+        return super().handle_line(line)
+
+
+def read_messages(count):
+    return [{"sender": 'IAM', "timestamp": '2024/09/12 16:46:19+04',
+             "message": f'Message {i}'} for i in range(count)]
+
+
+class DeleteReadSmsTest(unittest.TestCase):
+
+    def rack(self, modem):
+        self.modem = modem
+        patch_rack(self, {'SIM1': modem})
+        self.commands = record_commands(self)
+
+    def scan_and_delete(self):
+        return main.process_single_sim_card('SIM1', 115200, main.pin_directory,
+                                            False, True, True, True)
+
+    def deletes(self):
+        return [c for c in self.commands if c.startswith(b'AT+CMGD')]
+
+    def test_deletes_in_one_concatenated_batch(self):
+        self.rack(SimulatedModem(iccid=1000000001, messages=read_messages(3),
+                                 latency=0.002))
+        port_data = self.scan_and_delete()
+        self.assertEqual(port_data["deleted"], 3)
+        self.assertEqual(self.modem.messages, {})
+        self.assertEqual(self.deletes(), [b'AT+CMGD=1;+CMGD=2;+CMGD=3\r'])
+        # Kept in the store, flagged as gone from the SIM.
+        self.assertEqual(main.message_store.count_on_sim(1000000001), 0)
+        self.assertEqual(len(main.message_store.get_messages(1000000001, on_sim=False)), 3)
+
+    def test_incomplete_multipart_message_is_kept(self):
+        self.rack(SimulatedModem(iccid=1000000001, latency=0.002))
+        self.modem.deliver_sms('Bank', 'Your statement is ready. ' * 10)
+        del self.modem.messages[2]
+        self.modem.deliver_sms('IAM', 'Solde')
+        self.assertEqual(self.scan_and_delete()["deleted"], 1)
+        self.assertEqual(list(self.modem.messages), [1])
+
+    def test_rejected_batch_falls_back_to_single_deletes(self):
+        self.rack(NoConcatModem(iccid=1000000001, messages=read_messages(3),
+                                latency=0.002))
+        self.assertEqual(self.scan_and_delete()["deleted"], 3)
+        self.assertEqual(self.modem.messages, {})
+        self.assertEqual(self.deletes()[1:], [b'AT+CMGD=1\r', b'AT+CMGD=2\r',
+                                              b'AT+CMGD=3\r'])
+
+    def test_partly_deleted_multipart_message_is_finished(self):
+        self.rack(FirstOfBatchModem(iccid=1000000001, latency=0.002))
+        self.modem.deliver_sms('Bank', 'Your statement is ready. ' * 10)
+        self.modem.deliver_sms('IAM', 'Solde')
+        self.assertEqual(self.scan_and_delete()["deleted"], 2)
+        self.assertEqual(self.modem.messages, {})
+        self.assertEqual(self.deletes()[1:], [b'AT+CMGD=2\r', b'AT+CMGD=3\r'])
+        self.assertEqual(main.message_store.count_on_sim(1000000001), 0)
+
+    def test_batches_before_a_failed_listing_are_counted(self):
+        self.rack(FailingRelistModem(iccid=1000000001, messages=read_messages(12),
+                                     latency=0.002))
+        self.assertEqual(self.scan_and_delete()["deleted"], 10)
+        self.assertEqual(list(self.modem.messages), [11, 12])
+        self.assertEqual(main.message_store.count_on_sim(1000000001), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+
+from engine import ScanEngine
+from tests import patch_main, patch_stores
+
+
+class ScanEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scans = []
+
+        def scan(port, baud_rate, iccid_pin_data, full_scan=True, *args):
+            self.scans.append((port, full_scan))
+            responses = {"Get SMS": [{"index": 1, "sender": 'IAM', "timestamp": '',
+                                      "message": f'SMS {len(self.scans)}'}]}
+            if full_scan:
+                responses["Get IMSI"] = f'IMSI of {port}'
+            return {"port": port, "timestamp": f'T{len(self.scans)}',
+                    "responses": responses}
+        self.ports = ['COM1', 'COM2']
+        patch_main(self, detect_ports=lambda: self.ports,
+                   process_single_sim_card=scan)
+        patch_stores(self)
+        self.engine = ScanEngine()
+        self.addCleanup(self.engine.shutdown)
+
+    def test_scan_all(self):
+        self.assertFalse(self.engine.has_results())
+        self.engine.scan_all({})
+        self.assertEqual(sorted(self.scans), [('COM1', True), ('COM2', True)])
+        self.assertEqual(sorted(p["port"] for p in self.engine.get_results()),
+                         ['COM1', 'COM2'])
+        self.engine.reset()
+        self.assertFalse(self.engine.has_results())
+
+    def test_sms_refresh_keeps_identity(self):
+        self.engine.scan_all({})
+        port_data = self.engine.scan_port('COM1')
+        self.assertEqual(self.scans[-1], ('COM1', False))
+        self.assertEqual(port_data["responses"]["Get IMSI"], 'IMSI of COM1')
+        self.assertEqual([m["message"] for m in port_data["responses"]["Get SMS"]],
+                         ['SMS 3'])
+        self.assertEqual(port_data["timestamp"], 'T3')
+
+    def test_results_survive_a_new_engine(self):
+        self.engine.scan_all({})
+        engine = ScanEngine()
+        self.addCleanup(engine.shutdown)
+        self.assertEqual([p["port"] for p in engine.get_results()], ['COM1', 'COM2'])
+
+
+    def test_hot_plug(self):
+        self.engine.scan_all({})
+        self.ports = ['COM2', 'COM3']
+        self.engine.watcher.refresh()
+        self.engine.scheduler.submit('COM3', lambda: None).result(timeout=5)
+        self.assertEqual(self.scans[-1], ('COM3', True))
+        results = {p["port"]: p for p in self.engine.get_results()}
+        self.assertTrue(results['COM1']["stale"])
+        self.assertFalse(results['COM3']["stale"])
+        self.assertEqual(self.engine.inventory(), ['COM2', 'COM3'])
+
+    def test_inventory_does_not_start_the_watcher(self):
+        self.assertEqual(self.engine.inventory(), ['COM1', 'COM2'])
+        self.assertFalse(self.engine.watcher.is_running())
+        self.engine.start()
+        self.assertTrue(self.engine.watcher.is_running())
+        self.engine.shutdown()
+        self.assertFalse(self.engine.watcher.is_running())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import csv
+import gzip
+import io
+import json
+import unittest
+
+from export import stream_export
+from store import HistoryStore, MessageStore, ScanStore, iter_pages
+from tests import temp_db
+
+
+def message(index, sender, text):
+    return {"index": index, "sender": sender, "timestamp": '2024/09/12 16:46:19+04',
+            "message": text}
+
+
+class ExportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.messages = MessageStore(temp_db(self))
+        self.store = ScanStore(self.messages, history=HistoryStore(
+            self.messages.db_file, keyframe_interval=2))
+        self.store.replace_ports([
+            {"port": 'SIM1', "timestamp": '2024-01-01T10:00:00',
+             "responses": {"ICCID": 1000000001, "MSISDN": '212600000001'}},
+            {"port": 'SIM2', "timestamp": '2024-01-02T10:00:00',
+             "responses": {"ICCID": 1000000002, "MSISDN": '212600000002'}}])
+        self.messages.add_messages(1000000001, 'SIM1', [
+            message(i, 'Google', f'G-12345{i}') for i in range(1, 6)])
+
+    def export(self, kind, fmt='ndjson', **options):
+        return b''.join(stream_export(self.store, kind, fmt, **options))
+
+    def test_ndjson(self):
+        rows = [json.loads(line) for line in self.export('messages').splitlines()]
+        self.assertEqual([row["index"] for row in rows], [1, 2, 3, 4, 5])
+        self.assertEqual(rows[0]["code"], '123451')
+        self.assertIs(rows[0]["on_sim"], True)
+
+    def test_csv(self):
+        rows = list(csv.DictReader(io.StringIO(self.export('sims', 'csv').decode())))
+        self.assertEqual([row["msisdn"] for row in rows], ['212600000001', '212600000002'])
+        self.assertEqual(list(rows[0]), ["iccid", "imsi", "msisdn", "operator", "port",
+                                         "updated_at"])
+
+    def test_gzip(self):
+        data = self.export('scans', 'csv', compress=True)
+        self.assertEqual(gzip.decompress(data), self.export('scans', 'csv'))
+
+    def test_filters(self):
+        rows = [json.loads(line) for line in
+                self.export('scans', since='2024-01-02', until='2024-01-03').splitlines()]
+        self.assertEqual([row["port"] for row in rows], ['SIM2'])
+        self.assertEqual(self.export('messages', ports=['SIM2']), b'')
+
+    def test_scans_replay_the_history(self):
+        for day, operator in ((3, 'IAM'), (4, 'Orange'), (5, 'Orange'), (6, 'inwi')):
+            self.store.save_port_data({"port": 'SIM1', "timestamp": f'2024-01-0{day}T10:00:00',
+                                       "responses": {"ICCID": 1000000001,
+                                                     "Get Operator": operator}})
+        rows = [json.loads(line) for line in
+                self.export('scans', ports=['SIM1'], since='2024-01-05',
+                            until='2024-01-07').splitlines()]
+        # The unchanged scan on the 5th recorded nothing; the 6th is a delta
+        # on the keyframe of the 4th.
+        self.assertEqual([row["recorded_at"] for row in rows], ['2024-01-06T10:00:00'])
+        self.assertEqual(rows[0]["responses"], {"ICCID": 1000000001,
+                                                "MSISDN": '212600000001',
+                                                "Get Operator": 'inwi'})
+        self.assertEqual(rows[0]["iccid"], 1000000001)
+        rows = [json.loads(line) for line in self.export('scans', ports=['SIM1']).splitlines()]
+        self.assertEqual([row["responses"].get("Get Operator") for row in rows],
+                         [None, 'IAM', 'Orange', 'inwi'])
+
+    def test_unknown_kind_or_format(self):
+        with self.assertRaises(ValueError):
+            stream_export(self.store, 'pins')
+        with self.assertRaises(ValueError):
+            stream_export(self.store, 'sims', 'xml')
+
+    def test_pages(self):
+        rows = list(iter_pages(self.messages, 'SELECT id FROM sms_messages WHERE 1 = 1',
+                               [], 'id', batch_size=2))
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows, sorted(rows))
+
+
+if __name__ == '__main__':
+    unittest.main()
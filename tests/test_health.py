@@ -0,0 +1,99 @@
+import time
+import unittest
+
+import main
+from health import FAULT_NO_RESPONSE, FAULT_SERIAL, PortHealth
+from modem_sim import SimulatedModem
+from tests import patch_main, patch_rack, record_commands
+
+
+class PortHealthTest(unittest.TestCase):
+
+    def setUp(self):
+        self.health = PortHealth(failure_threshold=2, base_backoff=0.05, max_backoff=0.1)
+
+    def fail(self, port, reason=FAULT_NO_RESPONSE):
+        self.health.begin_scan(port)
+        self.health.fault(port, reason)
+        return self.health.end_scan(port, False)
+
+    def state(self, port):
+        return next(p for p in self.health.snapshot() if p["port"] == port)
+
+    def test_circuit_opens_after_consecutive_failures(self):
+        self.assertFalse(self.fail('COM1'))
+        self.assertTrue(self.health.allow('COM1'))
+        self.assertTrue(self.fail('COM1'))
+        self.assertEqual(self.state('COM1')["state"], 'open')
+        self.assertFalse(self.health.allow('COM1'))
+        self.assertEqual(self.health.due(), [])
+
+    def test_probe_after_backoff(self):
+        self.fail('COM1')
+        self.fail('COM1')
+        time.sleep(0.06)
+        self.assertEqual(self.health.due(), ['COM1'])
+        self.assertTrue(self.health.allow('COM1'))
+        self.assertEqual(self.state('COM1')["state"], 'half_open')
+        # Only one probe until the next backoff.
+        self.assertFalse(self.health.allow('COM1'))
+        self.health.begin_scan('COM1')
+        self.assertFalse(self.health.end_scan('COM1', True))
+        self.assertEqual(self.state('COM1')["state"], 'closed')
+        self.assertTrue(self.health.allow('COM1'))
+
+    def test_failed_probe_doubles_the_backoff(self):
+        self.fail('COM1')
+        self.fail('COM1')
+        time.sleep(0.06)
+        self.health.allow('COM1')
+        self.assertFalse(self.fail('COM1'))
+        self.assertGreater(self.state('COM1')["retry_in"], 0.05)
+
+    def test_scan_without_a_fault_is_a_success(self):
+        self.health.begin_scan('COM1')
+        self.assertFalse(self.health.end_scan('COM1', False))
+        self.assertEqual(self.state('COM1')["consecutive_failures"], 0)
+
+    def test_port_down_only_after_a_serial_fault(self):
+        self.health.begin_scan('COM1')
+        self.health.fault('COM1', FAULT_NO_RESPONSE)
+        self.assertFalse(self.health.port_down('COM1'))
+        self.health.begin_scan('COM2')
+        self.health.fault('COM2', FAULT_SERIAL)
+        self.assertTrue(self.health.port_down('COM2'))
+
+    def test_reset(self):
+        self.fail('COM1')
+        self.assertTrue(self.health.reset('COM1'))
+        self.assertFalse(self.health.reset('COM1'))
+        self.assertEqual(self.health.snapshot(), [])
+
+
+class ScanHealthTest(unittest.TestCase):
+
+    def setUp(self):
+        # SIM1 is listed but cannot be opened, as a dead modem would.
+        patch_rack(self, {'SIM2': SimulatedModem(iccid=1000000002, latency=0.001,
+                                                 ussd_latency=0.001)})
+        patch_main(self, detect_ports=lambda: ['SIM1', 'SIM2'])
+
+    def test_failing_port_is_left_out_of_full_scans(self):
+        for _ in range(main.port_health.failure_threshold):
+            self.assertIsNone(main.process_single_sim_card('SIM1', 115200,
+                                                           main.pin_directory))
+        state = main.port_health.snapshot()[0]
+        self.assertEqual((state["port"], state["state"], state["last_error"]),
+                         ('SIM1', 'open', FAULT_SERIAL))
+        self.assertIn('sim_port_circuit_opens_total{port="SIM1"} 1', main.metrics.render())
+        main.process_sim_cards()
+        self.assertEqual([p["port"] for p in main.scan_store.get_ports()], ['SIM2'])
+
+    def test_commands_stop_after_a_serial_error(self):
+        commands = record_commands(self)
+        main.process_single_sim_card('SIM1', 115200, main.pin_directory)
+        self.assertEqual(len(commands), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import io
+import threading
+import unittest
+
+from openpyxl import Workbook
+
+from importer import ImportFormatError, import_sims, iter_csv_rows, iter_xlsx_rows
+from store import PinDirectory
+from tests import temp_db
+
+
+class ImportSimsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pins = PinDirectory(temp_db(self))
+
+    def test_csv_report(self):
+        upload = io.BytesIO('﻿ICCID;PIN\n'
+                            '1000000001;0123\n'
+                            '1000000002;abc\n'
+                            '\n'
+                            '1000000001;9999\n'
+                            '89x;1234\n'
+                            '1000000003\n'.encode('utf-8'))
+        report = import_sims(iter_csv_rows(upload), self.pins, chunk_size=2)
+        self.assertEqual((report['inserted'], report['duplicates'], report['rejected']),
+                         (1, 1, 3))
+        self.assertEqual([e['row'] for e in report['errors']], [3, 6, 7])
+        self.assertFalse(report['errors_truncated'])
+        # Leading zeros survive.
+        self.assertEqual(self.pins.get(1000000001), '0123')
+
+    def test_xlsx_rows(self):
+        workbook = Workbook()
+        workbook.active.append(['PIN', 'ICCID'])
+        workbook.active.append([1234, 1000000001.0])
+        upload = io.BytesIO()
+        workbook.save(upload)
+        upload.seek(0)
+        self.assertEqual(import_sims(iter_xlsx_rows(upload), self.pins)['inserted'], 1)
+        self.assertEqual(self.pins.get(1000000001), '1234')
+
+    def test_missing_columns(self):
+        with self.assertRaises(ImportFormatError):
+            import_sims([['ICCID', 'CODE']], self.pins)
+
+    def test_lookup_during_import(self):
+        seen = []
+
+        def rows():
+            yield ['ICCID', 'PIN']
+            yield ['1000000001', '1234']
+            # A scan thread asks while the import transaction is still open.
+            lookup = threading.Thread(target=lambda: seen.append(self.pins.get(1000000001)))
+            lookup.start()
+            lookup.join()
+            yield ['1000000002', '5678']
+
+        report = import_sims(rows(), self.pins, chunk_size=1)
+        self.assertEqual(report['inserted'], 2)
+        self.assertEqual(seen, [None])
+        self.assertEqual(self.pins.get(1000000001), '1234')
+        self.assertEqual(self.pins.get(1000000002), '5678')
+
+
+if __name__ == '__main__':
+    unittest.main()
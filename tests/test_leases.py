@@ -0,0 +1,120 @@
+import time
+import unittest
+
+from leases import LeaseManager
+from store import MessageStore, ScanStore
+from tests import temp_db
+
+
+def scan(port, iccid, msisdn, operator='IAM', used=0):
+    return {"port": port, "timestamp": '2024-01-01T00:00:00',
+            "responses": {"ICCID": iccid, "Get IMSI": f'60400{iccid}', "MSISDN": msisdn,
+                          "Get Operator": operator,
+                          "SMS Count": {"used": used, "total": 30}}}
+
+
+class LeaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scan_store = ScanStore(MessageStore(temp_db(self)))
+        self.scan_store.replace_ports([
+            scan('SIM1', 1000000001, '212600000001'),
+            scan('SIM2', 1000000002, '212600000002', 'INWI')])
+        self.leases = LeaseManager(self.scan_store)
+
+    def test_each_number_is_leased_once(self):
+        first = self.leases.allocate(client='a')
+        second = self.leases.allocate(client='b')
+        self.assertEqual({first["iccid"], second["iccid"]}, {1000000001, 1000000002})
+        self.assertIsNone(self.leases.allocate())
+        self.assertEqual(len(self.leases.leases()), 2)
+
+    def test_operator_filter(self):
+        lease = self.leases.allocate(operator='INWI')
+        self.assertEqual((lease["msisdn"], lease["port"]), ('212600000002', 'SIM2'))
+        self.assertIsNone(self.leases.allocate(operator='INWI'))
+
+    def test_released_number_goes_to_the_back_of_the_rotation(self):
+        first = self.leases.allocate()
+        self.assertTrue(self.leases.release(first["lease_id"]))
+        self.assertFalse(self.leases.release(first["lease_id"]))
+        self.assertNotEqual(self.leases.allocate()["iccid"], first["iccid"])
+
+    def test_renew_and_expiry(self):
+        lease = self.leases.allocate(ttl=1)
+        renewed = self.leases.renew(lease["lease_id"], ttl=60)
+        self.assertGreater(renewed["expires_at"], lease["expires_at"] + 30)
+        self.assertIsNone(self.leases.renew('missing'))
+        short = self.leases.allocate(ttl=1)
+        deadline = time.monotonic() + 3.0
+        while short["lease_id"] in [item["lease_id"] for item in self.leases.leases()]:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+        self.assertEqual([item["lease_id"] for item in self.leases.leases()], [lease["lease_id"]])
+
+    def test_leases_survive_a_restart(self):
+        lease = self.leases.allocate()
+        restarted = LeaseManager(self.scan_store)
+        self.assertEqual([item["lease_id"] for item in restarted.leases()], [lease["lease_id"]])
+        self.assertNotEqual(restarted.allocate()["iccid"], lease["iccid"])
+        self.assertIsNone(restarted.allocate())
+
+
+class LeaseInventoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scan_store = ScanStore(MessageStore(temp_db(self)))
+        self.scan_store.replace_ports([
+            scan('SIM1', 1000000001, '212600000001'),
+            scan('SIM2', 1000000002, '212600000002', 'INWI'),
+            scan('SIM3', 1000000003, '212600000003')])
+        self.leases = LeaseManager(self.scan_store)
+        self.full_loads = 0
+        live_sims = self.scan_store.live_sims
+
+        def counted():
+            self.full_loads += 1
+            return live_sims()
+        self.scan_store.live_sims = counted
+
+    def allocate_all(self, operator=None):
+        leased = []
+        while True:
+            lease = self.leases.allocate(operator=operator)
+            if lease is None:
+                return leased
+            leased.append(lease)
+
+    def test_sms_count_changes_do_not_reload(self):
+        first = self.leases.allocate()
+        for used in range(1, 4):
+            self.scan_store.save_port_data(scan('SIM2', 1000000002, '212600000002',
+                                                'INWI', used))
+        self.assertEqual(len(self.allocate_all()), 2)
+        self.assertEqual(self.full_loads, 1)
+        self.leases.release(first["lease_id"])
+        self.assertEqual(self.leases.allocate()["iccid"], first["iccid"])
+
+    def test_inventory_changes_are_applied(self):
+        self.leases.allocate(operator='INWI')
+        self.scan_store.mark_stale('SIM1')
+        # SIM swapped in SIM3, and the new SIM is on another operator.
+        self.scan_store.save_port_data(scan('SIM3', 1000000004, '212600000004', 'INWI'))
+        self.assertEqual(self.allocate_all('IAM'), [])
+        self.assertEqual([lease["iccid"] for lease in self.allocate_all('INWI')],
+                         [1000000004])
+        self.scan_store.mark_stale('SIM1', stale=False)
+        self.assertEqual([lease["iccid"] for lease in self.allocate_all()], [1000000001])
+        self.assertEqual(self.full_loads, 1)
+
+    def test_operator_change(self):
+        self.leases.allocate(operator='INWI')
+        self.scan_store.save_port_data(scan('SIM1', 1000000001, '212600000001', 'ORANGE'))
+        self.assertEqual([lease["iccid"] for lease in self.allocate_all('ORANGE')],
+                         [1000000001])
+        self.assertEqual([lease["iccid"] for lease in self.allocate_all('IAM')],
+                         [1000000003])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import threading
+import time
+import unittest
+from datetime import datetime
+
+import main
+from at_reader import LatencyTracker
+from listener import SmsListener, parse_cmti
+from modem_sim import SimulatedModem
+from scheduler import PortScheduler
+from sessions import SessionPool
+from tests import FakeSerial, patch_main, patch_rack
+
+
+class ParseTest(unittest.TestCase):
+
+    def test_parse_cmti(self):
+        self.assertEqual(parse_cmti(b'+CMTI: "SM",3'), ('SM', 3))
+        self.assertEqual(parse_cmti(b'+CMTI: garbage'), (None, None))
+
+
+class SmsListenerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.modem = SimulatedModem(iccid=1000000001, latency=0.002)
+        patch_rack(self, {'SIM1': self.modem})
+        self.received = []
+        self.arrived = threading.Event()
+
+        def on_message(port, index, message):
+            self.received.append((port, index, message["sender"], message["message"]))
+            self.arrived.set()
+        self.listener = SmsListener(on_message, poll_interval=0.01)
+        self.addCleanup(self.listener.stop)
+
+    def test_new_sms_is_fetched_by_index(self):
+        self.assertEqual(self.listener.start(['SIM1']), ['SIM1'])
+        self.assertEqual(self.modem.deliver_sms('Google', 'G-123456'), [1])
+        self.assertTrue(self.arrived.wait(2.0))
+        self.assertEqual(self.received, [('SIM1', 1, 'Google', 'G-123456')])
+
+    def test_parts_are_held_until_the_message_is_complete(self):
+        self.listener.start(['SIM1'])
+        text = 'Your statement is ready. ' * 10
+        self.assertEqual(self.modem.deliver_sms('Bank', text), [1, 2])
+        self.assertTrue(self.arrived.wait(2.0))
+        self.listener.stop()
+        self.assertEqual(self.received, [('SIM1', 1, 'Bank', text)])
+
+    def test_stopped_listener_leaves_no_handler(self):
+        handlers = list(main.session_pool._handlers)
+        self.listener.start(['SIM1'])
+        self.listener.stop()
+        self.listener.start(['SIM1'])
+        self.assertEqual(len(main.session_pool._handlers), len(handlers) + 1)
+        self.listener.stop()
+        self.assertEqual(main.session_pool._handlers, handlers)
+
+
+class ListenerAfterRestartTest(unittest.TestCase):
+
+    def setUp(self):
+        self.modem = SimulatedModem(iccid=1000000001, latency=0.002)
+        # A restarted API server: no scan has filled main.port_iccids yet.
+        patch_rack(self, {'SIM1': self.modem})
+        self.listener = SmsListener(lambda port, index, message: None,
+                                    poll_interval=0.01)
+        self.addCleanup(self.listener.stop)
+
+    def test_code_is_stored_before_the_first_scan(self):
+        self.assertEqual(self.listener.start(['SIM1']), ['SIM1'])
+        after = datetime.now().isoformat()
+        threading.Timer(0.1, self.modem.deliver_sms,
+                        ('Google', 'G-123456 is your Google verification code.')).start()
+        started = time.monotonic()
+        found = main.message_store.wait_for_code(iccid=1000000001, after=after, timeout=3.0)
+        self.assertEqual(found["code"], '123456')
+        self.assertLess(time.monotonic() - started, 1.0)
+
+
+class RefusedIndicationsTest(unittest.TestCase):
+
+    def test_ports_that_refuse_cnmi_are_not_listened_to(self):
+        FakeSerial.install(self)
+        FakeSerial.replies['AT+CNMI'] = [(0, b'\r\nERROR\r\n')]
+        pool, scheduler = SessionPool(idle_ttl=0), PortScheduler()
+        self.addCleanup(pool.close_all)
+        self.addCleanup(scheduler.shutdown)
+        patch_main(self, session_pool=pool, scheduler=scheduler,
+                   latency_tracker=LatencyTracker(), modem_models={})
+        listener = SmsListener(lambda port, index, message: None)
+        self.addCleanup(listener.stop)
+        self.assertEqual(listener.start(['COM1']), [])
+        self.assertEqual(pool.pinned_ports(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
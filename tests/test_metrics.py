@@ -0,0 +1,84 @@
+import threading
+import unittest
+
+import main
+from metrics import Metrics
+from modem_sim import SimulatedModem
+from tests import patch_rack
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+        self.metrics.counter('jobs_total', 'Jobs run.', ('port',))
+        self.metrics.histogram('job_seconds', 'Job time.', buckets=(0.1, 1.0))
+
+    def test_render(self):
+        self.metrics.inc('jobs_total', 'COM"1')
+        self.metrics.inc('jobs_total', 'COM"1', amount=2)
+        for seconds in (0.05, 0.5, 5.0):
+            self.metrics.observe('job_seconds', seconds)
+        self.assertEqual(self.metrics.render().splitlines(), [
+            '# HELP jobs_total Jobs run.',
+            '# TYPE jobs_total counter',
+            'jobs_total{port="COM\\"1"} 3',
+            '# HELP job_seconds Job time.',
+            '# TYPE job_seconds histogram',
+            'job_seconds_bucket{le="0.1"} 1',
+            'job_seconds_bucket{le="1"} 2',
+            'job_seconds_bucket{le="+Inf"} 3',
+            'job_seconds_sum 5.55',
+            'job_seconds_count 3',
+        ])
+
+    def test_merge_samples_from_another_registry(self):
+        other = Metrics()
+        other.counter('jobs_total', 'Jobs run.', ('port',))
+        other.histogram('job_seconds', 'Job time.', buckets=(0.1, 1.0))
+        for metrics in (self.metrics, other):
+            metrics.inc('jobs_total', 'COM1')
+            metrics.observe('job_seconds', 0.5)
+        other.inc('jobs_total', 'COM2')
+        self.metrics.merge(other.samples())
+        self.assertEqual(self.metrics.render().splitlines()[2:4],
+                         ['jobs_total{port="COM1"} 2', 'jobs_total{port="COM2"} 1'])
+        self.assertIn('job_seconds_bucket{le="1"} 2', self.metrics.render())
+        self.assertIn('job_seconds_count 2', self.metrics.render())
+
+    def test_scan_timing_is_per_thread(self):
+        seen = []
+        with self.metrics.track_scan() as timing:
+            thread = threading.Thread(target=lambda: seen.append(self.metrics.current_scan()))
+            thread.start()
+            thread.join()
+            with self.metrics.phase("sms"):
+                pass
+            timing.add_command('AT+CMGL', 0.25)
+        self.assertEqual(seen, [None])
+        self.assertIsNone(self.metrics.current_scan())
+        breakdown = timing.breakdown()
+        self.assertEqual(list(breakdown["phases"]), ["sms"])
+        self.assertEqual(breakdown["commands"], {'AT+CMGL': {"count": 1, "seconds": 0.25}})
+
+
+class ScanMetricsTest(unittest.TestCase):
+
+    def test_scan_records_commands_and_timings(self):
+        patch_rack(self, {'SIM1': SimulatedModem(
+            iccid=1000000001, imsi='604000000000001', pin='1234', pin_locked=True,
+            latency=0.002, ussd_latency=0.005)})
+        port_data = main.process_single_sim_card('SIM1', 115200, main.pin_directory)
+        timings = port_data["timings"]
+        self.assertEqual(timings["kind"], 'full')
+        self.assertIn('unlock', timings["phases"])
+        self.assertEqual(timings["commands"]['AT+CIMI']["count"], 1)
+        text = main.metrics.render()
+        self.assertIn('sim_unlock_attempts_total{port="SIM1",result="success"} 1', text)
+        self.assertIn('sim_at_command_duration_seconds_count{port="SIM1",command="AT+CIMI"} 1',
+                      text)
+        self.assertIn('sim_scan_duration_seconds_count{kind="full"} 1', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
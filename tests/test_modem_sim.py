@@ -0,0 +1,44 @@
+import unittest
+
+import bench_scan
+import main
+from modem_sim import SimulatedModem, build_rack
+from tests import patch_rack
+
+
+PROFILE = {"iccid": 8921260000, "imsi": '604000000000001', "msisdn": '212600000001',
+           "operator": 'IAM',
+           "messages": [{"sender": 'Google', "timestamp": '24/09/12,16:46:19+04',
+                         "message": 'G-123456'}]}
+
+
+class SimulatedRackTest(unittest.TestCase):
+
+    def test_build_rack(self):
+        modems = build_rack(3, [PROFILE], latency=0, locked_every=2)
+        self.assertEqual(list(modems), ['SIM1', 'SIM2', 'SIM3'])
+        self.assertEqual(len({m.iccid for m in modems.values()}), 3)
+        self.assertEqual([m.pin for m in modems.values()], ['1234', None, '1234'])
+
+    def test_full_scan_unlocks_and_reads_the_sim(self):
+        patch_rack(self, {'SIM1': SimulatedModem(
+            iccid=1000000001, imsi='604000000000001', msisdn='212600000001',
+            pin='1234', pin_locked=True, messages=PROFILE["messages"],
+            latency=0.005, ussd_latency=0.01)})
+        responses = main.process_single_sim_card(
+            'SIM1', 115200, main.pin_directory, True)["responses"]
+        self.assertEqual(responses["ICCID"], 1000000001)
+        self.assertEqual(responses["Get IMSI"], '604000000000001')
+        self.assertEqual(responses["MSISDN"], '212600000001')
+        self.assertEqual([m["message"] for m in responses["Get SMS"]], ['G-123456'])
+
+    def test_benchmark_scan(self):
+        modems = build_rack(4, [PROFILE], latency=0.005, ussd_latency=0.01)
+        patch_rack(self, modems)
+        self.assertEqual(bench_scan.run_scan(list(modems), True)[1], 4)
+        elapsed, scanned = bench_scan.run_scan(list(modems), False)
+        self.assertEqual(scanned, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
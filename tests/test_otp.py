@@ -0,0 +1,41 @@
+import json
+import unittest
+
+from otp import OtpExtractor
+from tests import temp_db
+
+
+class OtpExtractorTest(unittest.TestCase):
+
+    def test_default_patterns(self):
+        extractor = OtpExtractor()
+        self.assertEqual(extractor.extract('Google', 'G-123456 is your code.'), '123456')
+        self.assertEqual(extractor.extract('google', 'G-123456 is your code.'), '123456')
+        self.assertEqual(extractor.extract('Bank', 'Your code is 4821.'), '4821')
+        # An MSISDN is not a code.
+        self.assertIsNone(extractor.extract('IAM', 'Call 22233445566 today'))
+        self.assertIsNone(extractor.extract('IAM', None))
+
+    def test_sender_without_a_rule_uses_the_catch_all(self):
+        extractor = OtpExtractor({'Google': r'G-(\d{6})'})
+        self.assertEqual(extractor.extract('Google', 'G-123456'), '123456')
+        self.assertIsNone(extractor.extract('Bank', 'Your code is 4821.'))
+
+    def test_patterns_file(self):
+        path = temp_db(self)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'*': r'code[: ]+(\d+)'}, f)
+        extractor = OtpExtractor.from_file(path)
+        self.assertEqual(extractor.extract('Bank', 'Your code: 93'), '93')
+        self.assertIsNone(extractor.extract('Bank', 'Balance 4821'))
+
+    def test_missing_or_bad_file_falls_back_to_defaults(self):
+        path = temp_db(self)
+        self.assertEqual(OtpExtractor.from_file(path).extract('Bank', 'PIN 4821'), '4821')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('{"*": "("}')
+        self.assertEqual(OtpExtractor.from_file(path).extract('Bank', 'PIN 4821'), '4821')
+
+
+if __name__ == '__main__':
+    unittest.main()
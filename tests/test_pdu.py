@@ -0,0 +1,113 @@
+import unittest
+
+from pdu import (CODING_8BIT, CODING_GSM7, CODING_UCS2, data_coding, decode_pdu,
+                 parse_cmgl, parse_cmgr, reassemble)
+
+
+# The classic "hellohello" SMS-DELIVER from the GSM 03.40 tutorials.
+HELLO = '07917283010010F5040BC87238880900F10000993092516195800AE8329BFD4697D9EC37'
+# Alphanumeric sender "Google", GSM 7-bit body using the extension table.
+ALPHA_EXTENSION = ('07912160130300F4040BD0C7F7FBCC2E030000421090616471401CC7564C36A3D56CA0'
+                   'F17B4E9F836A9B3268C383CBDFEDF7C607')
+# UCS-2 body with a character outside the BMP: 'Код 1234 😀'.
+UCS2 = ('07912160130300F4040C9112622143658700084210906164714016041A043E04340020'
+        '00310032003300340020D83DDE00')
+# Two GSM 7-bit parts, 8-bit reference 0x2A.
+CONCAT8 = [
+    '07912160130300F4440C91126221436587000042109061647140230500032A0201A061391DF476974'
+    '16F33280C62BFDD6750BB3C9F87CF651608',
+    '07912160130300F4440C91126221436587000042109061647140140500032A0202C26E32081E96D341'
+    'F4FBDB05',
+]
+# Two UCS-2 parts, 16-bit reference 0x012C, '😀' split between its surrogates.
+CONCAT16 = [
+    '07912160130300F4440C9112622143658700084210906164714017060804012C0201041F0440043804'
+    '32043504420020D83D',
+    '07912160130300F4440C9112622143658700084210906164714011060804012C0202DE000020043C04'
+    '380440',
+]
+SENDER = '+212612345678'
+TIMESTAMP = '2024/01/09 16:46:17+04'
+
+
+def cmgl_reply(entries):
+    """``AT+CMGL=4`` reply for ``(index, stat, pdu)`` entries."""
+    body = ''.join(f'\r\n+CMGL: {index},{stat},,{len(pdu) // 2 - 8}\r\n{pdu}'
+                   for index, stat, pdu in entries)
+    return (body + '\r\n\r\nOK\r\n').encode('ascii')
+
+
+class DecodePduTest(unittest.TestCase):
+
+    def test_gsm7(self):
+        part = decode_pdu(HELLO)
+        self.assertEqual(part["message"], 'hellohello')
+        self.assertEqual(part["sender"], '27838890001')
+        self.assertIsNone(part["concat"])
+
+    def test_alphanumeric_sender_and_extension_table(self):
+        part = decode_pdu(ALPHA_EXTENSION)
+        self.assertEqual(part["sender"], 'Google')
+        self.assertEqual(part["message"], 'G-123456 costs 5€ [promo]')
+        self.assertEqual(part["timestamp"], TIMESTAMP)
+
+    def test_ucs2(self):
+        part = decode_pdu(UCS2)
+        self.assertEqual(part["sender"], SENDER)
+        self.assertEqual(part["message"], 'Код 1234 😀')
+
+    def test_concatenation_headers(self):
+        self.assertEqual(decode_pdu(CONCAT8[0])["concat"], (0x2A, 2, 1))
+        self.assertEqual(decode_pdu(CONCAT8[1])["message"], 'and part two.')
+        self.assertEqual(decode_pdu(CONCAT16[1])["concat"], (0x012C, 2, 2))
+
+    def test_truncated(self):
+        with self.assertRaises(ValueError):
+            decode_pdu(HELLO[:30])
+
+    def test_data_coding(self):
+        for dcs, coding in ((0x00, CODING_GSM7), (0x04, CODING_8BIT), (0x08, CODING_UCS2),
+                            (0x18, CODING_UCS2), (0xE0, CODING_UCS2),
+                            (0xF0, CODING_GSM7), (0xF4, CODING_8BIT)):
+            self.assertEqual(data_coding(dcs), coding, hex(dcs))
+
+
+class ListingTest(unittest.TestCase):
+
+    def test_multipart_listing(self):
+        reply = cmgl_reply([(3, 1, CONCAT8[1]), (5, 0, UCS2), (7, 1, CONCAT8[0])])
+        parts = parse_cmgl(reply)
+        self.assertEqual([p["index"] for p in parts], [3, 5, 7])
+        self.assertEqual(parts[1]["status"], "REC UNREAD")
+        messages = reassemble(parts)
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(messages[0]["message"], 'Part one of a long message, and part two.')
+        self.assertEqual(messages[0]["indexes"], [7, 3])
+        self.assertTrue(messages[0]["complete"])
+        self.assertEqual(messages[1]["message"], 'Код 1234 😀')
+
+    def test_surrogate_pair_split_across_parts(self):
+        messages = reassemble(parse_cmgl(cmgl_reply([(1, 1, CONCAT16[1]),
+                                                     (2, 1, CONCAT16[0])])))
+        self.assertEqual(messages[0]["message"], 'Привет 😀 мир')
+        self.assertEqual(messages[0]["indexes"], [2, 1])
+
+    def test_missing_part(self):
+        messages = reassemble(parse_cmgl(cmgl_reply([(2, 1, CONCAT16[0])])))
+        self.assertFalse(messages[0]["complete"])
+
+    def test_unreadable_entry_is_skipped(self):
+        parts = parse_cmgl(cmgl_reply([(1, 1, HELLO[:30]), (2, 1, HELLO)]))
+        self.assertEqual([p["index"] for p in parts], [2])
+
+    def test_cmgr(self):
+        reply = f'\r\n+CMGR: 0,,{len(UCS2) // 2 - 8}\r\n{UCS2}\r\n\r\nOK\r\n'.encode('ascii')
+        part = parse_cmgr(reply, 9)
+        self.assertEqual((part["index"], part["status"]), (9, "REC UNREAD"))
+        self.assertEqual(part["message"], 'Код 1234 😀')
+        with self.assertRaises(ValueError):
+            parse_cmgr(b'\r\nOK\r\n', 9)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+
+from port_watcher import PortWatcher
+
+
+class PortWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.listed = ['COM1', 'COM2']
+        self.events = []
+        self.watcher = PortWatcher(lambda: self.listed,
+                                   lambda port: self.events.append(('added', port)),
+                                   lambda port: self.events.append(('removed', port)))
+
+    def test_first_listing_only_seeds_the_inventory(self):
+        self.assertEqual(self.watcher.ports(), ['COM1', 'COM2'])
+        self.assertEqual(self.events, [])
+
+    def test_reports_changes(self):
+        self.watcher.refresh()
+        self.listed = ['COM2', 'COM3']
+        self.assertEqual(self.watcher.refresh(), ({'COM3'}, {'COM1'}))
+        # Re-enumerated: gone for one listing, then back.
+        self.listed = ['COM3']
+        self.watcher.refresh()
+        self.listed = ['COM2', 'COM3']
+        self.watcher.refresh()
+        self.assertEqual(self.events, [('removed', 'COM1'), ('added', 'COM3'),
+                                       ('removed', 'COM2'), ('added', 'COM2')])
+        self.assertEqual(self.watcher.ports(), ['COM2', 'COM3'])
+
+    def test_listing_error_keeps_the_inventory(self):
+        self.watcher.refresh()
+
+        def fail():
+            raise OSError("no ports")
+        self.watcher.list_ports = fail
+        self.assertEqual(self.watcher.refresh(), (set(), set()))
+        self.assertEqual(self.watcher.ports(), ['COM1', 'COM2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
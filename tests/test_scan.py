@@ -0,0 +1,54 @@
+import unittest
+
+import main
+from at_reader import command_key
+from modem_sim import SimulatedModem
+from tests import patch_rack, record_commands
+
+
+def modem(iccid=1000000001):
+    return SimulatedModem(iccid=iccid, imsi='604000000000001', msisdn='212600000001',
+                          latency=0.002, ussd_latency=0.005)
+
+
+class IdentityCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.modems = {'SIM1': modem()}
+        patch_rack(self, self.modems)
+        self.commands = record_commands(self)
+
+    def scan(self, use_identity_cache=True):
+        del self.commands[:]
+        port_data = main.process_single_sim_card(
+            'SIM1', 115200, main.pin_directory, True, True, use_identity_cache)
+        main.scan_store.save_port_data(port_data)
+        return port_data["responses"]
+
+    def test_unchanged_sim_only_rereads_sms(self):
+        first = self.scan()
+        self.assertIn(b'AT+CIMI\r', self.commands)
+        second = self.scan()
+        self.assertEqual([command_key(c) for c in self.commands],
+                         ['AT+CRSM', 'AT+CPMS', 'AT+CMGL'])
+        self.assertEqual(second["Get IMSI"], first["Get IMSI"])
+        self.assertEqual(second["MSISDN"], '212600000001')
+        self.scan(use_identity_cache=False)
+        self.assertIn(b'AT+CIMI\r', self.commands)
+
+    def test_swapped_sim_gets_a_full_scan(self):
+        self.scan()
+        self.modems['SIM1'] = modem(iccid=1000000002)
+        main.session_pool.close('SIM1')
+        self.assertEqual(self.scan()["ICCID"], 1000000002)
+        self.assertIn(b'AT+CIMI\r', self.commands)
+
+    def test_cache_is_seeded_from_the_stored_scan(self):
+        self.scan()
+        main.identity_cache.clear()
+        self.scan()
+        self.assertNotIn(b'AT+CIMI\r', self.commands)
+
+
+if __name__ == '__main__':
+    unittest.main()
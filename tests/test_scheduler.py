@@ -0,0 +1,72 @@
+import threading
+import time
+import unittest
+
+from scheduler import PRIORITY_HOUSEKEEPING, PRIORITY_INTERACTIVE, PRIORITY_SCAN, PortScheduler
+
+
+class PortSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = PortScheduler(max_concurrency=4)
+        self.addCleanup(self.scheduler.shutdown)
+        self.lock = threading.Lock()
+        self.running = {}
+        self.peak = {}
+        self.order = []
+
+    def job(self, port, name, seconds=0.05):
+        with self.lock:
+            self.running[port] = self.running.get(port, 0) + 1
+            self.peak[port] = max(self.peak.get(port, 0), self.running[port])
+            self.peak["all"] = max(self.peak.get("all", 0), sum(self.running.values()))
+            self.order.append(name)
+        time.sleep(seconds)
+        with self.lock:
+            self.running[port] -= 1
+        return name
+
+    def test_one_job_per_port_at_a_time(self):
+        futures = [self.scheduler.submit(port, self.job, port, f'{port}-{i}')
+                   for port in ('COM1', 'COM2') for i in range(3)]
+        self.assertEqual([f.result(timeout=5) for f in futures][:3],
+                         ['COM1-0', 'COM1-1', 'COM1-2'])
+        self.assertEqual(self.peak["COM1"], 1)
+        self.assertEqual(self.peak["all"], 2)
+
+    def test_interactive_job_overtakes_queued_scans(self):
+        futures = [self.scheduler.submit('COM1', self.job, 'COM1', 'scan-0')]
+        while not self.order:
+            time.sleep(0.001)
+        futures += [self.scheduler.submit('COM1', self.job, 'COM1', f'scan-{i}',
+                                          priority=PRIORITY_SCAN) for i in (1, 2)]
+        futures.append(self.scheduler.submit('COM1', self.job, 'COM1', 'delete',
+                                             priority=PRIORITY_HOUSEKEEPING))
+        futures.append(self.scheduler.submit('COM1', self.job, 'COM1', 'count',
+                                             priority=PRIORITY_INTERACTIVE))
+        for future in futures:
+            future.result(timeout=5)
+        self.assertEqual(self.order, ['scan-0', 'count', 'scan-1', 'scan-2', 'delete'])
+
+    def test_concurrency_limit(self):
+        futures = [self.scheduler.submit(f'COM{i}', self.job, f'COM{i}', i)
+                   for i in range(10)]
+        for future in futures:
+            future.result(timeout=5)
+        self.assertEqual(self.peak["all"], 4)
+
+    def test_cancel_drops_queued_jobs(self):
+        started = self.scheduler.submit('COM1', self.job, 'COM1', 'running', 0.2)
+        queued = [self.scheduler.submit('COM1', self.job, 'COM1', f'queued-{i}')
+                  for i in range(2)]
+        while not self.order:
+            time.sleep(0.001)
+        self.assertEqual(self.scheduler.pending('COM1'), 3)
+        self.assertEqual(self.scheduler.cancel('COM1'), 2)
+        self.assertEqual(started.result(timeout=5), 'running')
+        self.assertTrue(all(f.cancelled() for f in queued))
+        self.assertEqual(self.scheduler.pending(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
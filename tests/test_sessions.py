@@ -0,0 +1,124 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+import serial
+
+import main
+from modem_sim import SimulatedModem, SimulatedTransport, encode_iccid_record
+from sessions import SessionPool
+from tests import FakeSerial, patch_rack
+from ussd import CUSD_PREFIX, MSISDN_REQUEST
+
+
+ICCID_REQUEST = b'AT+CRSM=176,12258,0,0,10\r'
+
+
+def modem():
+    # The +CUSD answer (80 ms after the request) lands while the next
+    # command, sent at the request's OK (50 ms), is still waiting for its
+    # own reply (100 ms).
+    return SimulatedModem(iccid=1234567890, msisdn='212600000001', latency=0.05,
+                          ussd_latency=0.08)
+
+
+class SessionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeSerial.install(self)
+        self.pool = SessionPool(idle_ttl=60)
+        self.addCleanup(self.pool.close_all)
+
+    def test_one_handle_per_port(self):
+        for command in (b'AT+CPIN?\r', b'AT+CIMI\r'):
+            self.assertEqual(self.pool.execute('COM1', 115200, command, 0.1), b'\r\nOK\r\n')
+        self.pool.execute('COM2', 115200, b'AT+CIMI\r', 0.1)
+        self.assertEqual([s.port for s in FakeSerial.opened], ['COM1', 'COM2'])
+        self.assertEqual(FakeSerial.opened[0].written, [b'AT+CPIN?\r', b'AT+CIMI\r'])
+
+    def test_reconnects_once_after_serial_error(self):
+        self.pool.execute('COM1', 115200, b'AT\r', 0.1)
+        FakeSerial.opened[0].write = mock.Mock(side_effect=serial.SerialException)
+        self.assertEqual(self.pool.execute('COM1', 115200, b'AT+CIMI\r', 0.1), b'\r\nOK\r\n')
+        self.assertEqual(len(FakeSerial.opened), 2)
+        self.assertFalse(FakeSerial.opened[0].is_open)
+        FakeSerial.broken.add('COM1')
+        with self.assertRaises(serial.SerialException):
+            self.pool.execute('COM1', 115200, b'AT+CIMI\r', 0.1)
+        self.assertEqual(len(FakeSerial.opened), 3)
+
+    def test_idle_handles_are_closed(self):
+        self.pool.idle_ttl = 0.05
+        self.pool.execute('COM1', 115200, b'AT\r', 0.1)
+        self.pool.execute('COM2', 115200, b'AT\r', 0.1)
+        held, release = threading.Event(), threading.Event()
+
+        def hold():
+            with self.pool.lock('COM2', 115200):
+                held.set()
+                release.wait()
+        thread = threading.Thread(target=hold)
+        thread.start()
+        held.wait()
+        time.sleep(0.06)
+        self.pool.close_idle()
+        release.set()
+        thread.join()
+        self.assertFalse(FakeSerial.opened[0].is_open)
+        # Busy with another caller: the next sweep gets it.
+        self.assertTrue(FakeSerial.opened[1].is_open)
+
+    def test_unsolicited_lines_go_to_handlers(self):
+        seen = []
+        self.pool.add_unsolicited_handler(b'+CMTI:', lambda port, line: seen.append((port, line)))
+        self.pool.execute('COM1', 115200, b'AT\r', 0.1)
+        # Between commands, split over two reads.
+        FakeSerial.opened[0].push(b'\r\n+CMTI: "SM",')
+        self.pool.poll('COM1')
+        FakeSerial.opened[0].push(b'3\r\n')
+        self.pool.poll('COM1')
+        # Inside a reply.
+        FakeSerial.replies['AT+CSQ'] = [(0, b'\r\n+CMTI: "SM",4\r\n\r\n+CSQ: 20,0\r\n\r\nOK\r\n')]
+        self.assertIn(b'+CSQ: 20,0', self.pool.execute('COM1', 115200, b'AT+CSQ\r', 0.1))
+        self.assertEqual(seen, [('COM1', b'+CMTI: "SM",3'), ('COM1', b'+CMTI: "SM",4')])
+
+
+class UnsolicitedReplyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = SessionPool(transport=SimulatedTransport({'SIM1': modem()}))
+        self.addCleanup(self.pool.close_all)
+
+    def test_late_cusd_is_taken_out_of_the_next_reply(self):
+        seen = []
+        self.pool.add_unsolicited_handler(CUSD_PREFIX, lambda port, line: seen.append(line))
+        self.assertIn(b'OK', self.pool.execute('SIM1', 115200, MSISDN_REQUEST, 1.0))
+        reply = self.pool.execute('SIM1', 115200, ICCID_REQUEST, 1.0)
+        self.assertEqual(len(seen), 1)
+        self.assertTrue(seen[0].startswith(b'+CUSD: 2,"MSISDN:'))
+        self.assertNotIn(b'+CUSD', reply)
+        self.assertIn(encode_iccid_record(1234567890).encode('ascii'), reply)
+
+    def test_expected_line_stays_in_the_reply(self):
+        self.pool.add_unsolicited_handler(CUSD_PREFIX, lambda port, line: None)
+        reply = self.pool.execute('SIM1', 115200, MSISDN_REQUEST, 1.0, expect=CUSD_PREFIX)
+        self.assertIn(b'+CUSD: 2,"MSISDN:', reply)
+
+
+class ReadIccidTest(unittest.TestCase):
+
+    def test_read_iccid_after_msisdn_request(self):
+        patch_rack(self, {'SIM1': modem()})
+        self.assertTrue(main.ussd_resolver.expect('SIM1', 1234567890, 115200))
+        main.send_at_command('SIM1', 115200, MSISDN_REQUEST)
+        self.assertEqual(main.read_iccid('SIM1', 115200), 1234567890)
+        self.assertEqual(main.ussd_resolver.result('SIM1', 1234567890)[0],
+                         '212600000001')
+        # Saved from the resolver thread, shortly after.
+        self.assertTrue(main.ussd_resolver.wait(timeout=1.0))
+        self.assertEqual(main.scan_store.cached_msisdn(1234567890, 60), '212600000001')
+
+
+if __name__ == '__main__':
+    unittest.main()
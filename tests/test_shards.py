@@ -0,0 +1,143 @@
+import os
+import time
+import unittest
+
+import main
+from health import FAULT_SERIAL, PortHealth
+from metrics import scanner_metrics
+from modem_sim import SimulatedModem, SimulatedTransport
+from scheduler import PRIORITY_SCAN
+from shards import ShardedScheduler, hub_key, job_function
+from tests import patch_main, temp_db
+
+
+def rack(count):
+    """Transport factory run inside each worker: the same modems every time."""
+    return SimulatedTransport({
+        f'SIM{i}': SimulatedModem(iccid=1000000000 + i, imsi=f'60400000000000{i}',
+                                  msisdn=f'21260000000{i}', latency=0.001,
+                                  ussd_latency=0.001)
+        for i in range(1, count + 1)})
+
+
+def worker_pid(port):
+    return os.getpid()
+
+
+def idle_ttl(port):
+    return main.session_pool.idle_ttl
+
+
+def crash(port):
+    os._exit(3)
+
+
+def crash_once(port, marker):
+    """Kill the first worker that runs it; return the pid of the next."""
+    if not os.path.exists(marker):
+        open(marker, 'w').close()
+        os._exit(3)
+    return os.getpid()
+
+
+def tick(port):
+    time.sleep(0.01)
+
+
+class HelperTest(unittest.TestCase):
+
+    def test_hub_key(self):
+        self.assertEqual(hub_key('1-1.4.2:1.0'), '1-1.4')
+        self.assertEqual(hub_key('1-3:1.0'), '1-3')
+
+    def test_job_function(self):
+        self.assertEqual(job_function(main.process_single_sim_card),
+                         ('main', 'process_single_sim_card'))
+        self.assertEqual(job_function(worker_pid), (__name__, 'worker_pid'))
+
+
+class ShardedSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db_file = temp_db(self)
+        # Hubs 1-1 and 2-1 hash to different workers.
+        locations = {'SIM1': '1-1.1:1.0', 'SIM2': '1-1.2:1.0', 'SIM3': '2-1.1:1.0'}
+        self.scheduler = ShardedScheduler(workers=2, transport=(rack, (3,)),
+                                          db_file=self.db_file, quiet=True,
+                                          locations=lambda: locations, idle_ttl=7.0)
+        self.addCleanup(self.scheduler.shutdown)
+
+    def test_ports_on_one_hub_share_a_worker(self):
+        pids = {port: self.scheduler.submit(port, worker_pid, port).result(timeout=30)
+                for port in ('SIM1', 'SIM2', 'SIM3')}
+        self.assertEqual(pids['SIM1'], pids['SIM2'])
+        self.assertNotIn(os.getpid(), pids.values())
+        assignment = self.scheduler.assignment()
+        self.assertEqual(assignment['SIM1'], assignment['SIM2'])
+        self.assertNotEqual(assignment['SIM1'], assignment['SIM3'])
+        self.assertEqual(self.scheduler.pending(), 0)
+
+    def test_scans_run_in_the_workers(self):
+        futures = [self.scheduler.submit(port, main.process_single_sim_card, port,
+                                         115200, main.pin_directory, True,
+                                         priority=PRIORITY_SCAN)
+                   for port in ('SIM1', 'SIM2', 'SIM3')]
+        results = [future.result(timeout=30) for future in futures]
+        self.assertEqual(sorted(r["responses"]["ICCID"] for r in results),
+                         [1000000001, 1000000002, 1000000003])
+
+    def test_workers_get_the_session_ttl(self):
+        self.assertEqual(self.scheduler.submit('SIM1', idle_ttl, 'SIM1').result(timeout=30),
+                         7.0)
+
+    def test_metrics_add_up_the_workers(self):
+        patch_main(self, metrics=scanner_metrics())
+        for port in ('SIM1', 'SIM3'):
+            self.scheduler.submit(port, main.process_single_sim_card, port, 115200,
+                                  main.pin_directory).result(timeout=30)
+        rendered = self.scheduler.metrics().render()
+        self.assertIn('sim_scan_duration_seconds_count{kind="full"} 2', rendered)
+        self.assertIn('sim_at_command_duration_seconds_count{port="SIM3",command="AT+CIMI"} 1',
+                      rendered)
+
+    def test_scan_outcomes_reach_the_coordinators_health(self):
+        patch_main(self, port_health=PortHealth(failure_threshold=2))
+        # SIM9 is not in the rack: every scan of it fails to open the port.
+        for _ in range(2):
+            self.assertIsNone(self.scheduler.submit(
+                'SIM9', main.process_single_sim_card, 'SIM9', 115200,
+                main.pin_directory).result(timeout=30))
+        self.scheduler.submit('SIM1', main.process_single_sim_card, 'SIM1', 115200,
+                              main.pin_directory).result(timeout=30)
+        health = {p["port"]: p for p in main.port_health.snapshot()}
+        self.assertEqual((health['SIM9']["state"], health['SIM9']["last_error"]),
+                         ('open', FAULT_SERIAL))
+        self.assertEqual(health['SIM1']["state"], 'closed')
+        self.assertFalse(main.port_health.allow('SIM9'))
+
+    def test_dead_worker_is_replaced(self):
+        before = self.scheduler.submit('SIM3', worker_pid, 'SIM3').result(timeout=30)
+        # The job is resent once to the other worker, which dies as well.
+        with self.assertRaises(RuntimeError):
+            self.scheduler.submit('SIM3', crash, 'SIM3').result(timeout=30)
+        after = self.scheduler.submit('SIM3', worker_pid, 'SIM3').result(timeout=30)
+        self.assertNotEqual(before, after)
+
+
+    def test_dead_worker_is_noticed_while_results_stream_in(self):
+        self.scheduler.submit('SIM3', worker_pid, 'SIM3').result(timeout=30)
+        self.scheduler.submit('SIM1', worker_pid, 'SIM1').result(timeout=30)
+        ticks = [self.scheduler.submit('SIM1', tick, 'SIM1') for _ in range(300)]
+        ticks[10].result(timeout=30)
+        started = time.monotonic()
+        # SIM3's worker dies; the job is resent to SIM1's busy worker.
+        pid = self.scheduler.submit('SIM3', crash_once, 'SIM3',
+                                    temp_db(self)).result(timeout=30)
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertFalse(ticks[-1].done())
+        self.assertEqual(pid, self.scheduler.submit('SIM1', worker_pid,
+                                                    'SIM1').result(timeout=30))
+
+
+if __name__ == '__main__':
+    unittest.main()
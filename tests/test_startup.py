@@ -0,0 +1,17 @@
+import unittest
+
+from bench_startup import TARGETS, probe
+
+
+class ImportTest(unittest.TestCase):
+
+    def test_imports_open_no_database_and_load_no_lazy_module(self):
+        for label, module in TARGETS.items():
+            with self.subTest(label):
+                _, _, connections, loaded = probe(module)
+                self.assertEqual(connections, 0)
+                self.assertEqual(loaded, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
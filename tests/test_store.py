@@ -0,0 +1,319 @@
+import sqlite3
+import threading
+import time
+import unittest
+from unittest import mock
+
+import store
+from store import HistoryStore, MessageStore, PinDirectory, ScanStore
+from tests import temp_db
+
+
+def message(index, sender, text):
+    return {"index": index, "sender": sender, "timestamp": '2024/09/12 16:46:19+04',
+            "message": text}
+
+
+class MessageStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = MessageStore(temp_db(self))
+
+    def test_listing_twice_stores_once(self):
+        messages = [message(1, 'Google', 'G-123456'), message(2, 'IAM', 'Solde')]
+        self.assertEqual(self.store.add_messages(1000000001, 'COM1', messages), 2)
+        self.store.add_messages(1000000001, 'COM2', messages)
+        self.assertEqual(self.store.count_on_sim(1000000001), 2)
+        self.assertEqual([m["sender"] for m in self.store.get_messages(1000000001)],
+                         ['Google', 'IAM'])
+
+    def test_full_listing_flags_missing_messages(self):
+        self.store.add_messages(1000000001, 'COM1', [message(1, 'Google', 'G-123456'),
+                                                     message(2, 'IAM', 'Solde')])
+        self.store.add_messages(1000000001, 'COM1', [message(2, 'IAM', 'Solde')],
+                                full_listing=True)
+        self.assertEqual([m["index"] for m in self.store.get_messages(1000000001)], [2])
+        self.assertEqual(len(self.store.get_messages(1000000001, on_sim=False)), 2)
+        self.store.mark_deleted(1000000001, [2])
+        self.assertEqual(self.store.count_on_sim(1000000001), 0)
+
+
+class OtpTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = MessageStore(temp_db(self))
+
+    def test_code_is_extracted_when_stored(self):
+        self.store.add_messages(1000000001, 'COM1', [
+            message(1, 'Google', 'G-123456 is your Google verification code.'),
+            message(2, 'IAM', 'Solde: 10 DH')])
+        found = self.store.find_code(iccid=1000000001)
+        self.assertEqual((found["sender"], found["code"]), ('Google', '123456'))
+        self.assertIsNone(self.store.find_code(iccid=1000000001, sender='IAM'))
+        items, _ = self.store.query_messages(iccid=1000000001)
+        self.assertEqual([m["code"] for m in items], ['123456', None])
+
+    def test_find_code_after(self):
+        self.store.add_messages(1000000001, 'COM1', [message(1, 'Google', 'G-123456')])
+        self.assertIsNone(self.store.find_code(iccid=1000000001, after='9999'))
+
+    def test_wait_for_code_returns_when_a_code_is_stored(self):
+        threading.Timer(0.1, self.store.add_messages, (
+            1000000001, 'COM1', [message(1, 'Google', 'G-654321')])).start()
+        started = time.monotonic()
+        found = self.store.wait_for_code(iccid=1000000001, sender='Google', timeout=3.0)
+        self.assertEqual(found["code"], '654321')
+        self.assertLess(time.monotonic() - started, 1.0)
+
+    def test_code_stored_by_another_process(self):
+        # A second store stands in for a scan worker process: its write
+        # cannot notify this store's waiters.
+        worker = MessageStore(self.store.db_file)
+        threading.Timer(0.1, worker.add_messages, (
+            1000000001, 'SIM1', [message(1, 'Google', 'G-123456 is your code')])).start()
+        started = time.monotonic()
+        found = self.store.wait_for_code(iccid=1000000001, timeout=3.0)
+        self.assertEqual(found["code"], '123456')
+        self.assertLess(time.monotonic() - started, 1.0)
+
+    def test_waiters_query_outside_the_lock_and_only_when_needed(self):
+        queries = []
+        find_code = self.store.find_code
+
+        def counted(*args):
+            # A store running now (another thread) must not wait on this query.
+            lock_free = []
+            probe = threading.Thread(
+                target=lambda: lock_free.append(self.store._stored.acquire(timeout=0.1)
+                                                and self.store._stored.release() is None))
+            probe.start()
+            probe.join()
+            queries.append((time.monotonic(), lock_free == [True]))
+            return find_code(*args)
+        self.store.find_code = counted
+        self.assertIsNone(self.store.wait_for_code(iccid=1000000001, timeout=0.6))
+        # The first query plus one per CODE_POLL_INTERVAL.
+        self.assertLessEqual(len(queries), 4)
+        self.assertTrue(all(lock_free for _, lock_free in queries))
+        queries.clear()
+        # A store in this process wakes the waiter for a query before the
+        # next poll is due.
+        started = time.monotonic()
+        threading.Timer(0.05, self.store.add_messages, (
+            1000000002, 'COM2', [message(1, 'IAM', 'Solde: 10 DH')])).start()
+        self.assertIsNone(self.store.wait_for_code(iccid=1000000001, timeout=0.2))
+        self.assertLess(queries[1][0] - started, 0.15)
+
+    def test_wait_for_code_times_out(self):
+        self.assertIsNone(self.store.wait_for_code(iccid=1000000001, timeout=0.05))
+
+
+class ScanStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.messages = MessageStore(temp_db(self))
+        self.store = ScanStore(self.messages)
+
+    def save(self, port, timestamp, **responses):
+        self.store.save_port_data({"port": port, "timestamp": timestamp,
+                                   "responses": responses})
+
+    def test_sms_refresh_keeps_identity(self):
+        self.save('COM1', 'T1', ICCID=1000000001, **{"Get IMSI": '604000000000001'})
+        self.messages.add_messages(1000000001, 'COM1', [message(1, 'Google', 'G-123456')])
+        self.save('COM1', 'T2', **{"Get SMS": [message(1, 'Google', 'G-123456')]})
+        port_data = self.store.get_port('COM1')
+        self.assertEqual(port_data["timestamp"], 'T2')
+        self.assertEqual(port_data["responses"]["Get IMSI"], '604000000000001')
+        # Served from sms_messages, not stored twice.
+        self.assertEqual([m["sender"] for m in port_data["responses"]["Get SMS"]],
+                         ['Google'])
+        self.assertNotIn('Get SMS', self.store.connection().execute(
+            'SELECT responses FROM ports').fetchone()[0])
+
+    def test_new_sim_replaces_the_old_identity(self):
+        self.save('COM1', 'T1', ICCID=1000000001, **{"Get IMSI": '604000000000001'})
+        self.save('COM1', 'T2', ICCID=1000000002)
+        self.assertEqual(self.store.get_port('COM1')["responses"],
+                         {"ICCID": 1000000002, "Get SMS": []})
+
+    def test_full_scan_marks_missing_ports_stale(self):
+        self.save('COM1', 'T1')
+        self.save('COM2', 'T1')
+        self.store.replace_ports([{"port": 'COM2', "timestamp": 'T2', "responses": {}}])
+        self.assertEqual([(p["port"], p["stale"]) for p in self.store.get_ports()],
+                         [('COM1', True), ('COM2', False)])
+        self.save('COM1', 'T3')
+        self.assertFalse(self.store.get_port('COM1')["stale"])
+
+    def test_ports_for_iccids(self):
+        self.save('COM1', 'T1', ICCID=1000000001)
+        self.save('COM2', 'T1', ICCID=1000000002)
+        self.store.mark_stale('COM2')
+        self.assertEqual(self.store.ports_for_iccids(['1000000001', 1000000002, 'x']),
+                         {1000000001: 'COM1'})
+        self.store.clear()
+        self.assertFalse(self.store.has_ports())
+
+
+class QueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.messages = MessageStore(temp_db(self))
+        self.store = ScanStore(self.messages)
+        self.store.save_port_data({"port": 'COM1', "timestamp": 'T1', "responses": {
+            "ICCID": 1000000001, "MSISDN": '212600000001'}})
+        self.messages.add_messages(1000000001, 'COM1',
+                                   [message(i, 'IAM', f'Message {i}') for i in range(1, 6)],
+                                   full_listing=True)
+
+    def test_pages_follow_the_cursor(self):
+        seen, cursor = [], None
+        while True:
+            rows, cursor = self.messages.query_messages(msisdn='212600000001',
+                                                        cursor=cursor, limit=2)
+            seen += [row["index"] for row in rows]
+            if cursor is None:
+                break
+        self.assertEqual(seen, [1, 2, 3, 4, 5])
+
+    def test_unchanged_rescan_keeps_versions(self):
+        version = self.messages.max_version('sms_messages')
+        sims_version = self.store.max_version('sims')
+        self.messages.add_messages(1000000001, 'COM1',
+                                   [message(i, 'IAM', f'Message {i}') for i in range(1, 6)],
+                                   full_listing=True)
+        self.store.save_port_data({"port": 'COM1', "timestamp": 'T2', "responses": {
+            "ICCID": 1000000001, "MSISDN": '212600000001'}})
+        self.assertEqual(self.messages.max_version('sms_messages'), version)
+        self.assertEqual(self.store.max_version('sims'), sims_version)
+        self.assertEqual(self.messages.query_messages(changed_since=version)[0], [])
+
+    def test_changed_since_includes_removals(self):
+        version = self.messages.max_version('sms_messages')
+        self.messages.add_messages(1000000001, 'COM1',
+                                   [message(i, 'IAM', f'Message {i}') for i in range(2, 7)],
+                                   full_listing=True)
+        rows, _ = self.messages.query_messages(changed_since=version)
+        self.assertEqual([(row["index"], row["on_sim"]) for row in rows],
+                         [(1, False), (6, True)])
+
+    def test_counter_moves_on_every_change_only(self):
+        version = self.store.current_version()
+        self.messages.add_messages(1000000001, 'COM1',
+                                   [message(i, 'IAM', f'Message {i}') for i in range(1, 6)],
+                                   full_listing=True)
+        self.store.mark_stale('COM2')
+        self.assertEqual(self.store.current_version(), version)
+        self.messages.mark_deleted(1000000001, [5])
+        self.assertEqual(self.store.current_version(), version + 1)
+        # Deleting every port row leaves no newer row version behind.
+        ports_version = self.store.max_version('ports')
+        self.store.clear()
+        self.assertLess(self.store.max_version('ports'), ports_version)
+        self.assertEqual(self.store.current_version(), version + 2)
+
+    def test_query_sims(self):
+        self.store.save_port_data({"port": 'COM2', "timestamp": 'T1',
+                                   "responses": {"ICCID": 1000000002}})
+        rows, cursor = self.store.query_sims(limit=1)
+        self.assertEqual([row["iccid"] for row in rows], [1000000001])
+        rows, cursor = self.store.query_sims(cursor=cursor, limit=1)
+        self.assertEqual([(row["iccid"], row["port"]) for row in rows],
+                         [(1000000002, 'COM2')])
+        self.assertIsNone(cursor)
+        self.assertEqual(self.store.query_sims(msisdn='212600000001')[0][0]["port"], 'COM1')
+
+
+class HistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db_file = temp_db(self)
+        self.history = HistoryStore(self.db_file, keyframe_interval=3)
+
+    def test_unchanged_scan_writes_nothing(self):
+        self.assertTrue(self.history.record('SIM1', {"Get Operator": 'IAM'}, []))
+        self.assertFalse(self.history.record('SIM1', {"Get Operator": 'IAM'}, []))
+        self.assertEqual(len(self.history.changes('SIM1')), 1)
+
+    def test_state_at_replays_deltas_from_the_keyframe(self):
+        for minute, operator in enumerate(['IAM', 'INWI', 'ORANGE', 'IAM', 'INWI']):
+            self.history.record('SIM1', {"Get Operator": operator},
+                                [message(minute + 1, 'Google', f'G-{minute}')],
+                                recorded_at=f'2024-01-01T00:0{minute}:00')
+        self.assertEqual([c["keyframe"] for c in self.history.changes('SIM1')],
+                         [True, False, False, True, False])
+        self.assertEqual(self.history.changes('SIM1')[1]["data"]["responses"],
+                         {"Get Operator": 'INWI'})
+        state = self.history.state_at('SIM1', '2024-01-01T00:02:30')
+        self.assertEqual(state["responses"], {"Get Operator": 'ORANGE'})
+        self.assertEqual([m["message"] for m in state["messages"]], ['G-2'])
+        self.assertEqual(self.history.state_at('SIM1')["responses"],
+                         {"Get Operator": 'INWI'})
+        self.assertIsNone(self.history.state_at('SIM1', '2023-12-31'))
+
+    def test_two_writers(self):
+        # The API server and the CLI record the same port.
+        api, cli = self.history, HistoryStore(self.db_file)
+        self.assertTrue(api.record('SIM1', {"Get Operator": 'IAM'}, [],
+                                   recorded_at='2024-01-01T00:00:00'))
+        self.assertTrue(cli.record('SIM1', {"Get Operator": 'INWI'}, [],
+                                   recorded_at='2024-01-01T00:01:00'))
+        self.assertTrue(api.record('SIM1', {"Get Operator": 'IAM'}, [],
+                                   recorded_at='2024-01-01T00:02:00'))
+        self.assertEqual(api.state_at('SIM1')["responses"], {"Get Operator": 'IAM'})
+        self.assertEqual(cli.state_at('SIM1', '2024-01-01T00:01:30')["responses"],
+                         {"Get Operator": 'INWI'})
+        self.assertTrue(cli.record_stale('SIM1', recorded_at='2024-01-01T00:03:00'))
+        self.assertFalse(api.record_stale('SIM1', recorded_at='2024-01-01T00:04:00'))
+        self.assertTrue(api.state_at('SIM1')["stale"])
+
+    def test_scan_store_records_scans_and_stale_ports(self):
+        scans = ScanStore(MessageStore(self.db_file), history=self.history)
+        scans.save_port_data({"port": 'SIM1', "timestamp": '2024-01-01T00:00:00',
+                              "responses": {"ICCID": 1000000001,
+                                            "Get SMS": [message(1, 'IAM', 'Solde')]}})
+        scans.mark_stale('SIM1')
+        state = self.history.state_at('SIM1')
+        self.assertTrue(state["stale"])
+        self.assertEqual(state["responses"], {"ICCID": 1000000001})
+        self.assertEqual([m["sender"] for m in state["messages"]], ['IAM'])
+
+
+class PinDirectoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db_file = temp_db(self)
+        self.pins = PinDirectory(self.db_file)
+
+    def test_each_iccid_is_read_once(self):
+        self.pins.add_many([(1000000001, '1234')])
+        queries = []
+        self.pins.connection().set_trace_callback(queries.append)
+        self.assertEqual(self.pins.get('1000000001'), '1234')
+        self.assertEqual(self.pins[1000000001], '1234')
+        self.assertNotIn(1000000009, self.pins)
+        self.assertNotIn(1000000009, self.pins)
+        self.assertEqual(len(queries), 2)
+
+    @mock.patch.object(store, 'PIN_MISS_TTL', 0.05)
+    def test_miss_expires(self):
+        self.assertIsNone(self.pins.get(1000000001))
+        # Imported by another process.
+        PinDirectory(self.db_file).add_many([(1000000001, '1234')])
+        self.assertIsNone(self.pins.get(1000000001))
+        time.sleep(0.06)
+        self.assertEqual(self.pins.get(1000000001), '1234')
+
+    def test_add_many_commits_and_forgets_misses(self):
+        self.assertIsNone(self.pins.get(1000000001))
+        self.assertEqual(self.pins.add_many([(1000000001, '1234'),
+                                             (1000000001, '9999')]), 1)
+        self.assertEqual(self.pins.get(1000000001), '1234')
+        self.assertEqual(PinDirectory(self.db_file).get(1000000001), '1234')
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.pins.add(1000000001, '5678')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+
+import main
+from modem_sim import SimulatedModem
+from tests import patch_main, patch_rack
+
+
+class MsisdnResolutionTest(unittest.TestCase):
+
+    def setUp(self):
+        # The +CUSD answers come well after each port's scan is done.
+        patch_rack(self, {
+            f'SIM{i}': SimulatedModem(iccid=1000000000 + i, imsi=f'60400000000000{i}',
+                                      msisdn=f'21260000000{i}', latency=0.005,
+                                      ussd_latency=0.5)
+            for i in (1, 2)})
+        patch_main(self, detect_ports=lambda: ['SIM1', 'SIM2'])
+
+    def test_cli_scan_waits_for_late_replies(self):
+        main.process_sim_cards(use_identity_cache=False)
+        ports = {p["port"]: p["responses"] for p in main.scan_store.get_ports()}
+        self.assertEqual(ports["SIM1"].get("MSISDN"), '212600000001')
+        self.assertEqual(ports["SIM2"].get("MSISDN"), '212600000002')
+        self.assertEqual(main.scan_store.cached_msisdn(1000000002, 60), '212600000002')
+        self.assertFalse(main.ussd_resolver.pending('SIM1'))
+
+    def test_cached_msisdn_skips_the_request(self):
+        main.scan_store.save_msisdn(1000000001, '212600000001')
+        self.assertEqual(main.resolve_msisdn('SIM1', 115200, 1000000001), '212600000001')
+        self.assertFalse(main.ussd_resolver.pending('SIM1'))
+
+    def test_forget_port_drops_the_request(self):
+        self.assertIsNone(main.resolve_msisdn('SIM1', 115200, 1000000001))
+        self.assertTrue(main.ussd_resolver.pending('SIM1'))
+        main.forget_port('SIM1')
+        self.assertFalse(main.ussd_resolver.pending('SIM1'))
+        self.assertNotIn('SIM1', main.session_pool.pinned_ports())
+
+
+if __name__ == '__main__':
+    unittest.main()